@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""騰落率データの集計処理とリスク指標の計算"""
+import warnings
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from market_data import slice_period
+
+
+def peer_averages(returns):
+    """各銘柄を除いた残り銘柄の平均（ピア平均）を全銘柄分まとめて計算する
+
+    (行合計 − 自銘柄) / (有効銘柄数 − 1) で求め、NaNは合計・件数の両方から除外する。
+    比較相手がいない行はNaNになる。
+    """
+    values = returns.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    own = np.where(valid, values, 0.0)
+    row_sum = own.sum(axis=1, keepdims=True)
+    peer_count = valid.sum(axis=1, keepdims=True) - valid
+    with np.errstate(invalid="ignore", divide="ignore"):
+        peers = (row_sum - own) / peer_count
+    peers[peer_count == 0] = np.nan
+    return pd.DataFrame(peers, index=returns.index, columns=returns.columns)
+
+
+def comparison_domains(comparison_returns, peer_avgs, nikkei_returns, fixed_domains=None):
+    """騰落率推移チャートの期間ごとのY軸範囲 [最小, 最大] を求める
+
+    fixed_domains にある期間はその範囲を使う。それ以外は全銘柄・ピア平均・日経平均を含む範囲に
+    5%の余白を付け、0を含むように広げる。データがない期間は [-10, 10]。
+    """
+    fixed_domains = fixed_domains or {}
+    domains = {}
+    for period_label, period_data in comparison_returns.items():
+        if period_label in fixed_domains:
+            domains[period_label] = fixed_domains[period_label]
+            continue
+        if period_data.empty:
+            domains[period_label] = [-10, 10]
+            continue
+
+        lows = [period_data.min().min()]
+        highs = [period_data.max().max()]
+        # 比較対象の銘柄が複数ある場合にのみピア平均を考慮
+        if len(period_data.columns) > 1:
+            lows.append(peer_avgs[period_label].min().min())
+            highs.append(peer_avgs[period_label].max().max())
+        nikkei = nikkei_returns.get(period_label)
+        if nikkei is not None and not nikkei.empty:
+            lows.append(nikkei.min())
+            highs.append(nikkei.max())
+
+        low, high = min(lows), max(highs)
+        padding = (high - low) * 0.05
+        domains[period_label] = [min(low - padding, 0), max(high + padding, 0)]
+    return domains
+
+
+def period_returns(closes, periods):
+    """期間ごとの騰落率（%）を銘柄×期間の表で返す
+
+    closes は日付×ティッカーの終値行列。期間内の最初の有効値から最後の有効値までの騰落率を、
+    期間ごとに全銘柄まとめて計算する。
+    """
+    returns = {}
+    for label, period in periods.items():
+        window = slice_period(closes, period)
+        returns[label] = (window.ffill().iloc[-1] / window.bfill().iloc[0] - 1) * 100
+    return pd.DataFrame(returns)
+
+
+def sector_overview(returns, sectors):
+    """銘柄×期間の騰落率から、セクター平均とセクター平均に対する超過騰落率を求める
+
+    sectors はティッカー→セクター名のSeries。戻り値は (セクター×期間の平均, 銘柄×期間の超過騰落率)。
+    """
+    sector = sectors.reindex(returns.index)
+    sector_avg = returns.groupby(sector, sort=False).mean()
+    excess = returns - sector_avg.reindex(sector.to_numpy()).to_numpy()
+    return sector_avg, excess
+
+
+# ローリング計算の窓（営業日数）と年率換算に使う年間営業日数
+RISK_WINDOWS = (20, 60, 250)
+TRADING_DAYS = 250
+
+
+@dataclass(frozen=True)
+class RiskMetrics:
+    volatility: dict                # 窓 → 日付×ティッカーの年率ボラティリティ（%）
+    beta: dict                      # 窓 → 日付×ティッカーの日経平均に対するベータ
+    correlation: dict               # 窓 → 日付×ティッカーの日経平均との相関係数
+    max_drawdown: pd.Series         # ティッカー → 表示期間内の最大ドローダウン（%）
+    correlation_matrix: pd.DataFrame  # 表示期間内の日次リターンの銘柄間相関
+
+
+def risk_metrics(closes, benchmark, period, windows=RISK_WINDOWS):
+    """終値行列とベンチマーク（日経平均）の終値からリスク指標をまとめて計算する
+
+    日次リターンとその2乗・積の累積和を1回だけ求め、各窓のローリング和は累積和の差で得る
+    （窓の数や期間の長さによらず O(日数 × 銘柄数)）。窓内に欠損がある日はNaNにする。
+    ローリング指標は closes の全期間で計算してから period で切り出すので、
+    表示期間が窓より短くても値が出る。最大ドローダウンと相関行列は表示期間内で計算する。
+    """
+    prices = closes.to_numpy(dtype=float)
+    bench = benchmark.reindex(closes.index).ffill().to_numpy(dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        r = prices[1:] / prices[:-1] - 1
+        b = np.broadcast_to((bench[1:] / bench[:-1] - 1)[:, None], r.shape)
+
+    valid = ~np.isnan(r) & ~np.isnan(b)
+    x = np.where(valid, r, 0.0)
+    y = np.where(valid, b, 0.0)
+    terms = np.stack([valid, x, x * x, y, y * y, x * y]).astype(float)
+    cumulative = np.concatenate([np.zeros((6, 1) + r.shape[1:]), terms.cumsum(axis=1)], axis=1)
+
+    volatility, beta, correlation = {}, {}, {}
+    for window in windows:
+        n, sx, sxx, sy, syy, sxy = cumulative[:, window:] - cumulative[:, :-window]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var_x = (sxx - sx * sx / n) / (n - 1)
+            var_y = (syy - sy * sy / n) / (n - 1)
+            cov = (sxy - sx * sy / n) / (n - 1)
+            metrics = {
+                "volatility": np.sqrt(var_x * TRADING_DAYS) * 100,
+                "beta": cov / var_y,
+                "correlation": cov / np.sqrt(var_x * var_y),
+            }
+        # 先頭（リターンのない初日と窓が埋まらない日）はNaNで埋めて終値の日付に揃える
+        pad = np.full((min(window, len(prices)),) + r.shape[1:], np.nan)
+        for name, target in (("volatility", volatility), ("beta", beta), ("correlation", correlation)):
+            values = np.where(n == window, metrics[name], np.nan)
+            frame = pd.DataFrame(np.concatenate([pad, values]), index=closes.index, columns=closes.columns)
+            target[window] = slice_period(frame, period)
+
+    window_prices = slice_period(closes, period).to_numpy(dtype=float)
+    return RiskMetrics(
+        volatility=volatility,
+        beta=beta,
+        correlation=correlation,
+        max_drawdown=pd.Series(_max_drawdown(window_prices), index=closes.columns),
+        correlation_matrix=pd.DataFrame(
+            _correlation_matrix(window_prices), index=closes.columns, columns=closes.columns,
+        ),
+    )
+
+
+def _max_drawdown(prices):
+    # 各日の高値更新（それまでの最大値）からの下落率の最小値
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        # 全期間欠損の銘柄はNaNのままにする
+        warnings.simplefilter("ignore", RuntimeWarning)
+        running_max = np.fmax.accumulate(prices, axis=0)
+        return np.nanmin(prices / running_max - 1, axis=0) * 100
+
+
+def _correlation_matrix(prices):
+    # 欠損を除いたペアごとの相関を行列積で一括計算する
+    with np.errstate(invalid="ignore", divide="ignore"):
+        r = prices[1:] / prices[:-1] - 1
+        valid = (~np.isnan(r)).astype(float)
+        x = np.where(valid > 0, r, 0.0)
+        n = valid.T @ valid
+        sx = x.T @ valid
+        sxx = (x * x).T @ valid
+        sxy = x.T @ x
+        cov = n * sxy - sx * sx.T
+        return cov / np.sqrt((n * sxx - sx * sx) * (n * sxx - sx * sx).T)
@@ -1,9 +1,29 @@
 # -*- coding: utf-8 -*-
+import io
+import time
+
+# 最初の意味のある表示までの時間の起点（モジュールの読み込みも含めて測る）
+RUN_STARTED = time.perf_counter()
+
 import streamlit as st
-import yfinance as yf
 import pandas as pd
 import altair as alt
-import datetime
+
+from analytics import comparison_domains, peer_averages, period_returns, sector_overview
+from charts import comparison_grid_chart, comparison_long_data, price_grid_chart
+from data_cache import PRICE_POLICY, cache_stats, cached, refresh_status, track_stale
+from downsample import melt_downsampled
+from export_catalog import DATASETS, FORMATS, missing_sectors
+from fetch_scheduler import RateLimitedError, scheduler
+from fundamentals import load_fundamentals, snapshot_store
+from instrumentation import begin_run, current_run, export_metrics, record_first_paint, recorder, stage
+from intraday import INTRADAY_INTERVAL, IntradayFeed, default_source
+from loaders import (
+    load_data, load_nikkei, load_nikkei_returns, load_returns, load_risk_metrics, load_shareholder_metrics,
+)
+from market_data import canonical_tickers, history_period, load_closes, price_store
+from screener import CRITERIA, ScreeningThresholds, screen
+from universe import load_universe, sectors_from_universe
 
 # --- ページ設定 ---
 st.set_page_config(
@@ -15,91 +35,14 @@ st.set_page_config(
 # --- ページタイトル ---
 st.title("セクター別分析")
 
-# --- セクター辞書 ---
-SECTORS = {
-    "エネルギー": {
-        "1605.T": "1605 INPEX",
-        "1662.T": "1662 JAPEX",
-        "5020.T": "5020 ENEOS",
-        "5019.T": "5019 出光興産",
-        "5021.T": "5021 コスモエネルギー",
-    },
-    "商社": {
-        "8001.T": "8001 伊藤忠商事",
-        "8002.T": "8002 丸紅",
-        "8015.T": "8015 豊田通商",
-        "8031.T": "8031 三井物産",
-        "8053.T": "8053 住友商事",
-        "8058.T": "8058 三菱商事",
-    },
-    "通信": {
-        "9432.T": "9432 NTT",
-        "9433.T": "9433 KDDI",
-        "9434.T": "9434 ソフトバンク",
-        "9435.T": "9435 光通信",
-    },
-    "電気製品": {
-        "6503.T": "6503 三菱電機",
-        "6758.T": "6758 ソニーG",
-        "6752.T": "6752 パナソニックHD",
-        "6701.T": "6701 NEC",
-        "6702.T": "6702 富士通",
-    },
-    "自動車": {
-        "7201.T": "7201 日産自動車",
-        "7202.T": "7202 いすゞ自動車",
-        "7203.T": "7203 トヨタ自動車",
-        "7267.T": "7267 ホンダ",
-        "7269.T": "7269 スズキ",
-        "7270.T": "7270 SUBARU",
-    },
-    "銀行": {
-        "5838.T": "5838 楽天銀行",
-        "7182.T": "7182 ゆうちょ銀行",
-        "8306.T": "8306 三菱UFJ FG",
-        "8316.T": "8316 三井住友 FG",
-        "8411.T": "8411 みずほ FG",
-        "8309.T": "8309 三井住友トラストHD",
-        "8410.T": "8410 セブン銀行",
-    },
-    "化学": {
-        "3402.T": "3402 東レ",
-        "3407.T": "3407 旭化成",
-        "4004.T": "4004 昭和電工",
-        "4005.T": "4005 住友化学",
-        "4063.T": "4063 信越化学工業",
-        "4188.T": "4188 三菱ケミカルG",
-        "4208.T": "4208 ＵＢＥ",
-        "5201.T": "5201 ＡＧＣ",
-    },
-    "医薬品": {
-        "4502.T": "4502 武田薬品工業",
-        "4503.T": "4503 アステラス製薬",
-        "4519.T": "4519 中外製薬",
-        "4543.T": "4543 テルモ",
-        "4568.T": "4568 第一三共",
-    },
-    "流通": {
-        "3382.T": "3382 セブン&アイ",
-        "3391.T": "3391 ツルハＨＤ",
-        "7453.T": "7453 良品計画",
-        "8267.T": "8267 イオン",
-        "9843.T": "9843 ニトリ",
-    },
-    "住宅": {
-        "1928.T": "1928 積水ハウス",
-        "1925.T": "1925 大和ハウス工業",
-        "1926.T": "1926 ライト工業",
-        "1963.T": "1963 日揮HD",
-    },
-    "建設": {
-        "1802.T": "1802 大林組",
-        "1803.T": "1803 清水建設",
-        "1801.T": "1801 大成建設",
-        "1812.T": "1812 鹿島建設",
-        "1821.T": "1821 三井住友建設",
-    },
-}
+# バックグラウンド更新の状況はタイトルの下に表示する（内容はスクリプトの最後で書き込む）
+refresh_status_area = st.container()
+
+# --- セクター辞書（ユニバースファイルから読み込む） ---
+SECTORS = sectors_from_universe(load_universe())
+
+# 全セクターのティッカー→銘柄名
+STOCK_NAMES = {t: name for stocks in SECTORS.values() for t, name in stocks.items()}
 
 # 騰落率平均比較チャートで使用する固定期間
 COMPARISON_PERIODS = {
@@ -131,6 +74,255 @@ period_map = {
     "20年": "20y",
 }
 
+# チャート1本・1系列あたりの最大描画点数（LTTBで間引く）
+COMPARISON_CHART_POINTS = 250
+RETURN_CHART_POINTS = 600
+PRICE_CHART_POINTS = 400
+
+# 表示モード
+VIEWS = ["セクター別", "全セクター概観", "割安株スクリーニング"]
+
+# 騰落率推移チャートで1ページに表示する銘柄数
+COMPANIES_PER_PAGE = 4
+
+# チャートの描画方式
+RENDER_MODES = ["まとめて描画", "銘柄ごとに描画"]
+
+# リスク指標のローリング窓（営業日数）
+RISK_WINDOW_LABELS = {"20日": 20, "60日": 60, "250日": 250}
+
+# バックグラウンド更新中に完了を確認する間隔（秒）
+REFRESH_POLL_INTERVAL = 2
+
+# 場中モードで自動更新する騰落率チャートの期間
+INTRADAY_PERIODS = ["5日", "1か月"]
+
+# -----------------------------------------------------------------------
+## バックグラウンド更新の状況
+# -----------------------------------------------------------------------
+# 期限切れのキャッシュは前回の値を表示しつつ裏で取り直す。この実行で前回の値を表示したデータの
+# 取り直しが完了したらページ全体を再実行して反映する（他のセッションの取り直しは対象にしない）
+served_stale = track_stale()
+
+def show_refresh_status():
+    refreshing, _ = refresh_status(served_stale)
+
+    @st.fragment(run_every=REFRESH_POLL_INTERVAL if refreshing else None)
+    def refresh_notice():
+        refreshing, updated = refresh_status(served_stale)
+        if updated:
+            st.rerun()
+        if refreshing:
+            st.caption(f"🔄 {refreshing}件のデータをバックグラウンドで更新中です（表示中は前回取得したデータです）")
+
+    with refresh_status_area:
+        refresh_notice()
+
+# -----------------------------------------------------------------------
+## キャッシュ統計・パフォーマンス計測（サイドバー）
+# -----------------------------------------------------------------------
+begin_run()
+
+def performance_panel():
+    with st.sidebar.expander("パフォーマンス計測", expanded=True):
+        st.caption("今回の実行（段階ごと）")
+        st.dataframe(
+            pd.DataFrame([{
+                "段階": r.name,
+                "時間（ms）": r.seconds * 1000,
+                "行数": r.rows,
+                "データ量（KB）": r.bytes / 1024 if r.bytes is not None else None,
+                "ヒット": r.cache_hits,
+                "ミス": r.cache_misses,
+            } for r in current_run()]).style.format({
+                "時間（ms）": "{:.1f}",
+                "行数": "{:,.0f}",
+                "データ量（KB）": "{:,.1f}",
+            }, na_rep='-'),
+            hide_index=True,
+        )
+        st.caption("プロセス全体（全セッション）")
+        summary = pd.DataFrame(recorder.summary())
+        if not summary.empty:
+            st.dataframe(
+                pd.DataFrame({
+                    "段階": summary["stage"],
+                    "回数": summary["count"],
+                    "p50（ms）": summary["p50"] * 1000,
+                    "p95（ms）": summary["p95"] * 1000,
+                    "ヒット": summary["cache_hits"],
+                    "ミス": summary["cache_misses"],
+                }).style.format({"p50（ms）": "{:.1f}", "p95（ms）": "{:.1f}"}),
+                hide_index=True,
+            )
+        st.download_button(
+            "Prometheus形式でダウンロード", recorder.prometheus(), file_name="metrics.prom", mime="text/plain",
+        )
+
+def finish_page():
+    # 各表示モードの最後に呼ぶ（計測はこの時点までの段階が対象）
+    with st.sidebar.expander("キャッシュ統計"):
+        st.dataframe(
+            cache_stats().style.format({
+                "使用量（MB）": "{:.1f}",
+                "上限（MB）": "{:.0f}",
+                "TTL（分）": "{:.0f}",
+                "ヒット率（%）": "{:.1f}",
+            }, na_rep='-'),
+            hide_index=True,
+        )
+        if price_store.matrix is not None:
+            mapped = "（メモリマップ）" if price_store.matrix.mmap else ""
+            st.caption(f"共有株価行列: {price_store.matrix.nbytes / 1e6:.1f} MB{mapped}")
+    if st.sidebar.checkbox("パフォーマンス計測を表示", key="performance_panel"):
+        performance_panel()
+    export_metrics()
+    show_refresh_status()
+
+# -----------------------------------------------------------------------
+## 表示モード（セクター別 / 全セクター概観）
+# -----------------------------------------------------------------------
+view = st.radio("表示モード", VIEWS, horizontal=True, label_visibility="collapsed", key="view")
+
+# --- 全セクターの騰落率（全銘柄と日経平均を一括取得して計算） ---
+@cached(PRICE_POLICY)
+def load_sector_overview():
+    sector_of = pd.Series({t: sector for sector, stocks in SECTORS.items() for t in stocks})
+    closes = load_closes(list(sector_of.index) + ["^N225"], history_period("5y")).ffill()
+    returns = period_returns(closes, COMPARISON_PERIODS)
+    nikkei_returns = returns.loc["^N225"] if "^N225" in returns.index else None
+    stock_returns = returns.reindex(sector_of.index)
+    sector_avg, excess = sector_overview(stock_returns, sector_of)
+    return stock_returns, sector_avg, excess, nikkei_returns, sector_of
+
+def overview_section():
+    st.subheader("セクター平均騰落率 %")
+    try:
+        with stage("overview.load"):
+            stock_returns, sector_avg, excess, nikkei_returns, sector_of = load_sector_overview()
+    except RateLimitedError:
+        st.warning("YFinanceの制限が発生しました。時間をおいて再試行してください。")
+        return
+    except Exception as e:
+        st.error(f"データ取得中にエラーが発生しました: {e}")
+        return
+
+    period_format = {label: "{:+.1f}" for label in COMPARISON_PERIODS}
+    summary = sector_avg.copy()
+    if nikkei_returns is not None:
+        summary.loc["日経平均"] = nikkei_returns
+    st.dataframe(summary.style.format(period_format, na_rep='-'), width='stretch')
+
+    st.subheader("セクター内ランキング")
+    period_label = st.radio(
+        "ランキング期間",
+        options=list(COMPARISON_PERIODS),
+        index=list(COMPARISON_PERIODS).index("1年"),
+        horizontal=True,
+        key="overview_period",
+        label_visibility="collapsed",
+    )
+    ranking = pd.DataFrame({
+        "銘柄": [STOCK_NAMES.get(t, t) for t in stock_returns.index],
+        "セクター": sector_of.reindex(stock_returns.index).to_numpy(),
+        "騰落率（%）": stock_returns[period_label].to_numpy(),
+        "セクター平均（%）": (stock_returns[period_label] - excess[period_label]).to_numpy(),
+        "セクター平均との差（%）": excess[period_label].to_numpy(),
+    })
+    ranking["セクター内順位"] = ranking.groupby("セクター")["騰落率（%）"].rank(ascending=False, method="min")
+    ranking = ranking.sort_values("セクター平均との差（%）", ascending=False, ignore_index=True)
+    st.dataframe(
+        ranking.style.format({
+            "騰落率（%）": "{:+.1f}",
+            "セクター平均（%）": "{:+.1f}",
+            "セクター平均との差（%）": "{:+.1f}",
+            "セクター内順位": "{:.0f}",
+        }, na_rep='-'),
+        width='stretch',
+        hide_index=True,
+    )
+
+# --- 割安株スクリーニング（ユニバース全銘柄の財務データに条件を一括適用） ---
+def screener_section():
+    st.subheader("優良な割安株スクリーニング")
+    st.caption("README の「優良な割安株を見つけるチェックリスト」の条件をユニバース全銘柄に適用し、満たした条件数の多い順に並べます。")
+
+    defaults = ScreeningThresholds()
+    with st.expander("条件"):
+        col1, col2, col3, col4 = st.columns(4)
+        max_per = col1.number_input("PER 上限", value=defaults.max_per, step=1.0)
+        per_below_sector_median = col1.checkbox("セクター中央値より低い", value=defaults.per_below_sector_median)
+        max_pbr = col2.number_input("PBR 上限（未満）", value=defaults.max_pbr, step=0.1)
+        min_roe = col2.number_input("ROE 下限（%）", value=defaults.min_roe, step=1.0)
+        max_debt_to_equity = col3.number_input("D/Eレシオ 上限（%）", value=defaults.max_debt_to_equity, step=10.0)
+        min_equity_ratio = col3.number_input("自己資本比率 下限（%）", value=defaults.min_equity_ratio, step=5.0)
+        min_growth_years = col4.number_input("連続増益年数 下限", value=defaults.min_growth_years, min_value=0, step=1)
+    thresholds = ScreeningThresholds(
+        max_per=max_per,
+        per_below_sector_median=per_below_sector_median,
+        max_pbr=max_pbr,
+        min_roe=min_roe,
+        max_debt_to_equity=max_debt_to_equity,
+        min_equity_ratio=min_equity_ratio,
+        min_growth_years=min_growth_years,
+    )
+
+    universe = load_universe()
+    with stage("screener.load") as timing:
+        fundamentals, errors = load_fundamentals(tuple(universe["ticker"]), with_statements=True)
+        timing.observe(fundamentals)
+    if errors:
+        with st.expander(f"{len(errors)}銘柄の財務データを取得できませんでした"):
+            for error in errors:
+                st.write(error)
+    if fundamentals.empty:
+        st.warning("財務データを取得できませんでした。")
+        return
+
+    sectors = universe.set_index("ticker")["sector"]
+    with stage("screener.screen") as timing:
+        result = timing.observe(screen(fundamentals, thresholds, sectors))
+    table = pd.DataFrame({
+        "銘柄": [STOCK_NAMES.get(t, t) for t in result.index],
+        "セクター": sectors.reindex(result.index).to_numpy(),
+        "スコア": result["スコア"].to_numpy(),
+        "PER（予想）": result["forwardPE"].to_numpy(),
+        "PBR": result["priceToBook"].to_numpy(),
+        "ROE（%）": (result["returnOnEquity"] * 100).to_numpy(),
+        "負債比率（D/E）": result["debtToEquity"].to_numpy(),
+        "FCF（億円）": (result["freeCashflow"] / 1e8).to_numpy(),
+        "自己資本比率（%）": (result["equityRatio"] * 100).to_numpy(),
+        "連続増益年数": result["operatingIncomeGrowthYears"].to_numpy(),
+    })
+    for criterion in CRITERIA:
+        table[criterion] = result[criterion].to_numpy()
+
+    st.dataframe(
+        table.style.format({
+            "PER（予想）": "{:.1f}",
+            "PBR": "{:.2f}",
+            "ROE（%）": "{:.1f}",
+            "負債比率（D/E）": "{:.2f}",
+            "FCF（億円）": "{:,.0f}",
+            "自己資本比率（%）": "{:.1f}",
+            "連続増益年数": "{:.0f}",
+        }, na_rep='-'),
+        width='stretch',
+        hide_index=True,
+    )
+
+if view == "全セクター概観":
+    overview_section()
+    record_first_paint(RUN_STARTED)
+    finish_page()
+    st.stop()
+
+if view == "割安株スクリーニング":
+    screener_section()
+    record_first_paint(RUN_STARTED)
+    finish_page()
+    st.stop()
+
 # -----------------------------------------------------------------------
 ## セクターと銘柄の選択
 # -----------------------------------------------------------------------
@@ -157,6 +349,59 @@ with col_tickers:
     )
 
 st.session_state.tickers_input = tickers
+
+# チャートの描画方式（まとめて描画: セクションごとに1つのチャート仕様で描画）
+render_mode = st.sidebar.radio(
+    "チャートの描画方式",
+    options=RENDER_MODES,
+    key="render_mode",
+)
+
+# 場中モード（5日・1か月の騰落率チャートを分足で自動更新）
+intraday_mode = st.sidebar.toggle(
+    "場中モード",
+    key="intraday_mode",
+    help=f"騰落率チャートの{'・'.join(INTRADAY_PERIODS)}を{INTRADAY_INTERVAL:.0f}秒ごとに分足で更新します",
+)
+
+# データのエクスポート（ファイルはボタンを押したときに、事前計算済みの結果・ストアの株価・保存済みの
+# スナップショットから作る。Yahooには問い合わせない）
+# Streamlit はダウンロードする内容をメモリに置くので、ユニバース全体×長期間などの大きな出力は
+# export.py でファイルや標準出力に直接書き出す
+@st.fragment
+def export_section(sector):
+    # エクスポートの設定を変えてもこのセクションだけを再実行する
+    with st.expander("データのエクスポート"):
+        export_dataset = st.selectbox("データ", list(DATASETS), format_func=DATASETS.get, key="export_dataset")
+        export_period = st.selectbox("期間", list(period_map), index=list(period_map).index("1年"), key="export_period")
+        export_scope = st.radio("範囲", [sector, "ユニバース全体"], horizontal=True, key="export_scope")
+        export_format = st.radio("形式", list(FORMATS), horizontal=True, key="export_format")
+        export_sector = None if export_scope == "ユニバース全体" else sector
+
+        def export_file():
+            # 書き出し（pyarrow など）はダウンロードのときに読み込み、アプリの起動を遅くしない
+            from export import export
+
+            buffer = io.BytesIO()
+            export(export_dataset, period_map[export_period], export_format, buffer, sector=export_sector)
+            return buffer
+
+        missing = missing_sectors(export_dataset, export_sector)
+        if missing:
+            st.caption(f"保存済みのデータがないため含まれないセクター: {'、'.join(missing)}")
+        extension, mime = FORMATS[export_format]
+        scope_label = "universe" if export_sector is None else sector
+        st.download_button(
+            "ダウンロード",
+            data=export_file,
+            file_name=f"{export_dataset}_{scope_label}_{period_map[export_period]}{extension}",
+            mime=mime,
+            on_click="ignore",
+            key="export_download",
+        )
+
+with st.sidebar:
+    export_section(sector)
 tickers = [t.upper() for t in tickers]
 
 if not tickers:
@@ -167,42 +412,23 @@ if not tickers:
 ## YFinanceデータの計算 (関数定義)
 # -----------------------------------------------------------------------
 
-# --- Financeデータの取得 ---
-@st.cache_data(show_spinner=False)
-def load_data(tickers, period):
-    tickers_obj = yf.Tickers(tickers)
-    data = tickers_obj.history(period=period)
-    if data is None:
-        raise RuntimeError("YFinance returned no data.")
-    # 複数カラムがある場合は"Close"を選択、1銘柄の場合はそのまま
-    if isinstance(data.columns, pd.MultiIndex):
-        data = data["Close"]
-    data = data.ffill().dropna(how="all", axis=1)
-    return data
-
-# FutureWarningを解消するため、auto_adjust=Falseを明示的に指定
-@st.cache_data(show_spinner=False)
-def load_nikkei(period):
-    data = yf.download("^N225", period=period, auto_adjust=False)["Close"].ffill()
-    return data.squeeze()
-
 # --- 固定期間のデータ取得と騰落率計算 ---
-@st.cache_data(show_spinner=False)
+@cached(PRICE_POLICY)
 def load_comparison_returns(tickers):
     comparison_returns = {}
     nikkei_comparison_returns = {}
     for label, period in COMPARISON_PERIODS.items():
         try:
-            # 銘柄データ
-            data = load_data(tickers, period)
-            returns = (data / data.iloc[0] - 1) * 100
+            # 銘柄データ（事前計算済みの騰落率があればそれを使う）
+            returns = load_returns(tickers, period)
             # カラム名をティッカーから会社名に変換
             returns.columns = [STOCKS.get(t, t) for t in returns.columns]
             comparison_returns[label] = returns
             # 日経平均データ
-            nikkei_data = load_nikkei(period)
-            nikkei_returns = (nikkei_data / nikkei_data.iloc[0] - 1) * 100
-            nikkei_comparison_returns[label] = nikkei_returns
+            nikkei_comparison_returns[label] = load_nikkei_returns(period)
+        except RateLimitedError:
+            # 制限による欠損をキャッシュしないよう呼び出し側に伝える
+            raise
         except Exception as e:
             # 警告を少し控えめにする
             # st.warning(f"期間 {label} のデータ取得中にエラー: {e}") 
@@ -226,140 +452,150 @@ st.markdown(
 if len(tickers) <= 1:
     st.warning("2銘柄以上を選択してください")
 
-# 固定期間の騰落率データを取得
-comparison_returns_data, nikkei_comparison_returns_data = load_comparison_returns(tickers)
+if scheduler.limited:
+    st.info("YFinanceの制限中のため、取得済みのデータを表示しています。")
 
-# len(tickers) <= 1 の場合はここでチャート描画をスキップ
-if len(tickers) > 1 and comparison_returns_data:
-    # --- 期間ごとの全体のY軸範囲を計算 (目盛統一のため) ---
-    period_domains = {}
+# 固定期間の騰落率データを取得
+try:
+    with stage("comparison.load") as timing:
+        comparison_returns_data, nikkei_comparison_returns_data = load_comparison_returns(canonical_tickers(tickers))
+        timing.observe(comparison_returns_data)
+except RateLimitedError:
+    st.warning("YFinanceの制限が発生しました。時間をおいて再試行してください。")
+    comparison_returns_data, nikkei_comparison_returns_data = {}, {}
 
-    for period_label, period_data in comparison_returns_data.items():
-        
-        # ★ 修正箇所2: 固定目盛を優先的に使用
-        if period_label in FIXED_DOMAINS:
-            period_domains[period_label] = FIXED_DOMAINS[period_label]
-            continue
-        # ★ 修正箇所2: ここまで
-        
-        if not period_data.empty:
-            
-            # 1. 全銘柄の最小・最大
-            min_return = period_data.min().min()
-            max_return = period_data.max().max()
-            
-            # 2. ピア平均の最小・最大（すべての銘柄をドロップして平均を計算）
-            all_peers_min = float('inf')
-            all_peers_max = float('-inf')
-            
-            # 比較対象の銘柄が複数ある場合にのみピア平均を考慮
-            if len(period_data.columns) > 1:
-                for current_company in period_data.columns:
-                    # 自分の銘柄を除いた平均 (ピア平均) を計算
-                    peers = period_data.drop(columns=[current_company], errors='ignore')
-                    if not peers.empty:
-                        peer_avg = peers.mean(axis=1)
-                        all_peers_min = min(all_peers_min, peer_avg.min())
-                        all_peers_max = max(all_peers_max, peer_avg.max())
-
-            # 3. 日経平均の最小・最大
-            nikkei_data = nikkei_comparison_returns_data.get(period_label)
-            nikkei_min = nikkei_data.min() if nikkei_data is not None and not nikkei_data.empty else float('inf')
-            nikkei_max = nikkei_data.max() if nikkei_data is not None and not nikkei_data.empty else float('-inf')
-
-            # 4. 全体の最小・最大を決定
-            current_min = min(min_return, all_peers_min if all_peers_min != float('inf') else min_return, nikkei_min)
-            current_max = max(max_return, all_peers_max if all_peers_max != float('-inf') else max_return, nikkei_max)
-
-            # 5. グラフの見栄えを良くするため、少し余裕を持たせる（5%）
-            padding = (current_max - current_min) * 0.05
-            current_min -= padding
-            current_max += padding
-
-            # 6. 0ラインをまたぐ場合は0を含めるように調整
-            if current_min > 0: current_min = 0
-            if current_max < 0: current_max = 0
-            
-            period_domains[period_label] = [current_min, current_max]
-        else:
-            # データがない場合のデフォルト
-            period_domains[period_label] = [-10, 10] 
+@st.fragment
+def comparison_charts(tickers, comparison_returns_data, nikkei_comparison_returns_data, peer_avg_data, period_domains):
+    # 表示中のページの銘柄だけを計算・描画する（ページ切替時はこの部分だけを再実行する）
+    num_pages = -(-len(tickers) // COMPANIES_PER_PAGE)
+    if num_pages > 1:
+        if st.session_state.get("comparison_page", 1) > num_pages:
+            st.session_state.comparison_page = 1
+        page = st.radio(
+            "表示する銘柄",
+            options=list(range(1, num_pages + 1)),
+            format_func=lambda p: " / ".join(
+                STOCKS.get(t, t) for t in tickers[(p - 1) * COMPANIES_PER_PAGE:p * COMPANIES_PER_PAGE]
+            ),
+            horizontal=True,
+            key="comparison_page",
+        )
+        page_tickers = tickers[(page - 1) * COMPANIES_PER_PAGE:page * COMPANIES_PER_PAGE]
+    else:
+        page_tickers = tickers
 
-    # 会社ごとの比較チャートを描画
-    for company_ticker in tickers:
-        company_name = STOCKS.get(company_ticker, company_ticker)
+    if render_mode == "まとめて描画":
+        # ページ内の全銘柄・全期間を共有データ1つのチャートとして描画
+        company_names = [STOCKS.get(t, t) for t in page_tickers]
+        with stage("comparison.melt") as timing:
+            grid_data = timing.observe(comparison_long_data(
+                comparison_returns_data, peer_avg_data, nikkei_comparison_returns_data,
+                company_names, COMPARISON_CHART_POINTS,
+            ))
+        with stage("comparison.render") as timing:
+            timing.observe(grid_data)
+            st.altair_chart(
+                comparison_grid_chart(grid_data, list(comparison_returns_data), period_domains, company_names),
+                use_container_width=False,
+            )
+    else:
+        # 会社ごとの比較チャートを描画
+        for company_ticker in page_tickers:
+            company_name = STOCKS.get(company_ticker, company_ticker)
         
-        st.markdown(f"### {company_name}") # 会社名の見出し
+            st.markdown(f"### {company_name}") # 会社名の見出し
 
-        NUM_COLS = len(COMPARISON_PERIODS) # 4つ（1か月, 1年, 3年, 5年）
-        cols = st.columns(NUM_COLS)
+            NUM_COLS = len(COMPARISON_PERIODS) # 4つ（1か月, 1年, 3年, 5年）
+            cols = st.columns(NUM_COLS)
 
-        # 固定期間ごとにチャートを描画
-        for i, (period_label, period_data) in enumerate(comparison_returns_data.items()):
+            # 固定期間ごとにチャートを描画
+            for i, (period_label, period_data) in enumerate(comparison_returns_data.items()):
             
-            # 選択された銘柄がその期間のデータに存在するか確認
-            if company_name not in period_data.columns:
-                # データがない場合はスキップ
-                cell = cols[i % NUM_COLS].container()
-                cell.markdown(f"**{period_label}**\n\n_データなし_")
-                continue
+                # 選択された銘柄がその期間のデータに存在するか確認
+                if company_name not in period_data.columns:
+                    # データがない場合はスキップ
+                    cell = cols[i % NUM_COLS].container()
+                    cell.markdown(f"**{period_label}**\n\n_データなし_")
+                    continue
                 
-            # 銘柄データと日経平均データ
-            company_returns = period_data[company_name]
-            nikkei_returns_data = nikkei_comparison_returns_data[period_label]
+                # 銘柄データと日経平均データ
+                company_returns = period_data[company_name]
+                nikkei_returns_data = nikkei_comparison_returns_data[period_label]
             
-            # ピア平均（比較対象の銘柄の平均）を計算
-            peers = period_data.drop(columns=[company_name], errors='ignore') 
-            peer_avg = peers.mean(axis=1)
+                # ピア平均（比較対象の銘柄の平均）
+                peer_avg = peer_avg_data[period_label][company_name]
 
-            # 期間ごとの全体のY軸範囲を取得 (統一された目盛)
-            all_min_comp, all_max_comp = period_domains.get(period_label, [None, None])
+                # 期間ごとの全体のY軸範囲を取得 (統一された目盛)
+                all_min_comp, all_max_comp = period_domains.get(period_label, [None, None])
 
-            # プロット用データの整形
-            nikkei_df = nikkei_returns_data.to_frame(name="Nikkei 225").reindex(company_returns.index, fill_value=None)
+                # プロット用データの整形
+                nikkei_df = nikkei_returns_data.to_frame(name="Nikkei 225").reindex(company_returns.index, fill_value=None)
             
-            plot_data = pd.DataFrame({
-                company_name: company_returns,
-                "Peer average": peer_avg,
-                "Nikkei 225": nikkei_df["Nikkei 225"].values
-            }, index=company_returns.index).reset_index().rename(columns={'index': 'Date'})
+                plot_data = pd.DataFrame({
+                    company_name: company_returns,
+                    "Peer average": peer_avg,
+                    "Nikkei 225": nikkei_df["Nikkei 225"].values
+                }, index=company_returns.index)
             
-            plot_data_melted = plot_data.melt(id_vars=["Date"], var_name="Series", value_name="Return (%)")
+                # 系列ごとに間引いてから縦持ちに変換
+                plot_data_melted = melt_downsampled(plot_data, "Series", "Return (%)", COMPARISON_CHART_POINTS)
 
 
-            # --- チャートの描画ロジック ---
-            base = alt.Chart(plot_data_melted).encode(
-                x=alt.X("Date:T", axis=alt.Axis(title=None)),
-                y=alt.Y(
-                    "Return (%):Q",
-                    axis=alt.Axis(title=None),
-                    scale=alt.Scale(domain=[all_min_comp, all_max_comp]) 
-                ),
-                tooltip=["Date", "Series", alt.Tooltip("Return (%):Q", format=".2f")]
-            )
-
-            other_lines = base.transform_filter(
-                alt.datum.Series != company_name
-            ).mark_line().encode(
-                color=alt.Color(
-                    "Series:N",
-                    scale=alt.Scale(
-                        domain=["Nikkei 225", "Peer average"],
-                        range=["#9BB7D0", "#D3D3D3"]
+                # --- チャートの描画ロジック ---
+                base = alt.Chart(plot_data_melted).encode(
+                    x=alt.X("Date:T", axis=alt.Axis(title=None)),
+                    y=alt.Y(
+                        "Return (%):Q",
+                        axis=alt.Axis(title=None),
+                        scale=alt.Scale(domain=[all_min_comp, all_max_comp]) 
                     ),
-                    legend=None
+                    tooltip=["Date", "Series", alt.Tooltip("Return (%):Q", format=".2f")]
                 )
-            )
 
-            company_line = base.transform_filter(
-                alt.datum.Series == company_name
-            ).mark_line(color="#C70025")
+                other_lines = base.transform_filter(
+                    alt.datum.Series != company_name
+                ).mark_line().encode(
+                    color=alt.Color(
+                        "Series:N",
+                        scale=alt.Scale(
+                            domain=["Nikkei 225", "Peer average"],
+                            range=["#9BB7D0", "#D3D3D3"]
+                        ),
+                        legend=None
+                    )
+                )
 
-            chart = (other_lines + company_line).properties(title=f"{period_label}", height=300)
+                company_line = base.transform_filter(
+                    alt.datum.Series == company_name
+                ).mark_line(color="#C70025")
 
-            # cols[i]にチャートを描画
-            cell = cols[i % NUM_COLS].container()
-            cell.altair_chart(chart, use_container_width=True)
+                chart = (other_lines + company_line).properties(title=f"{period_label}", height=300)
+
+                # cols[i]にチャートを描画
+                cell = cols[i % NUM_COLS].container()
+                cell.altair_chart(chart, use_container_width=True)
+
+# len(tickers) <= 1 の場合はここでチャート描画をスキップ
+if len(tickers) > 1 and comparison_returns_data:
+    # 期間ごとに全銘柄のピア平均（自分の銘柄を除いた平均）をまとめて計算
+    with stage("comparison.peer_averages") as timing:
+        peer_avg_data = timing.observe({
+            period_label: peer_averages(period_data)
+            for period_label, period_data in comparison_returns_data.items()
+        })
+
+    # 期間ごとの全体のY軸範囲（目盛統一のため、固定目盛がある期間はそれを優先）
+    with stage("comparison.domains"):
+        period_domains = comparison_domains(
+            comparison_returns_data, peer_avg_data, nikkei_comparison_returns_data, FIXED_DOMAINS,
+        )
+
+    comparison_charts(
+        tickers, comparison_returns_data, nikkei_comparison_returns_data, peer_avg_data, period_domains
+    )
+
+# 選択欄と最初のチャート（騰落率推移チャート）までを表示した時点
+record_first_paint(RUN_STARTED)
 
 # --- 騰落率チャートと株価推移チャートの期間選択を独立させるため、セクションを分割 ---
 
@@ -368,68 +604,160 @@ if len(tickers) > 1 and comparison_returns_data:
 # -----------------------------------------------------------------------
 st.subheader("騰落率チャート %") 
 
-# 騰落率チャート専用のラジオボタン
-horizon_return = st.radio(
-    "騰落率チャート期間", 
-    options=list(period_map.keys()),
-    index=list(period_map.keys()).index("5年"),
-    horizontal=True,
-    key="return_period", # 独立したキーを設定
-    label_visibility="collapsed"
-)
+# --- 場中モード（新しいバーだけを追記し、変わった末尾の行だけ騰落率・ピア平均を計算する） ---
+def intraday_state(tickers, period):
+    # 銘柄の組×期間ごとに1つ（前回の状態から差分で更新する）。組や期間が変わったら読み込み直す
+    key = (canonical_tickers(tickers), period)
+    state = st.session_state.get("intraday")
+    if state is None or state["key"] != key:
+        closes = pd.concat([load_data(tickers, period), load_nikkei(period).rename("^N225")], axis=1)
+        feed = IntradayFeed(closes, default_source(), benchmark="^N225")
+        state = {"key": key, "feed": feed, "chart_data": intraday_long(feed.returns)}
+        st.session_state.intraday = state
+    return state
 
-# -----------------------------------------------------------------------
-## YFinanceデータの計算 (騰落率用)
-# -----------------------------------------------------------------------
-try:
-    # 選択された期間のデータをロード
-    data_return = load_data(tickers, period_map[horizon_return])
-    nikkei_data_return = load_nikkei(period_map[horizon_return])
-except yf.exceptions.YFRateLimitError:
-    st.warning("YFinanceの制限が発生しました。時間をおいて再試行してください。")
-    load_data.clear_cache()
-    load_nikkei.clear_cache()
-    st.stop()
-except Exception as e:
-    st.error(f"データ取得中にエラーが発生しました: {e}")
-    st.stop()
+def intraday_long(returns):
+    names = {**STOCKS, "^N225": "日経平均"}
+    return (
+        returns.rename(columns=lambda t: names.get(t, t))
+        .rename_axis(index="Date", columns="Stock")
+        .stack()
+        .rename("Return (%)")
+        .reset_index()
+    )
 
-# データ欠損チェック (騰落率用)
-empty_columns_return = data_return.columns[data_return.isna().all()].tolist()
-if empty_columns_return:
-    st.error(f"騰落率チャート用データを取得できなかった銘柄: {', '.join(empty_columns_return)}")
-    st.stop()
+def intraday_return_section(tickers, horizon):
+    try:
+        state = intraday_state(tickers, period_map[horizon])
+    except RateLimitedError:
+        st.warning("YFinanceの制限が発生しました。時間をおいて再試行してください。")
+        return
+    except Exception as e:
+        st.error(f"データ取得中にエラーが発生しました: {e}")
+        return
+    feed = state["feed"]
 
-# --- 騰落率計算 ---
-returns = (data_return / data_return.iloc[0] - 1) * 100
-returns = returns.rename(columns=STOCKS)
-nikkei_returns = (nikkei_data_return / nikkei_data_return.iloc[0] - 1) * 100
+    @st.fragment(run_every=INTRADAY_INTERVAL if feed.source.is_open() else None)
+    def intraday_chart():
+        if feed.source.is_open():
+            # 取得に失敗しても前回までのデータは表示する（次の更新で再試行）
+            try:
+                with stage("intraday.poll") as timing:
+                    delta = feed.poll()
+                    timing.observe(delta.closes)
+            except RateLimitedError:
+                st.warning("YFinanceの制限が発生しました。前回までのデータを表示しています。")
+                delta = None
+            except Exception as e:
+                st.error(f"データ取得中にエラーが発生しました: {e}")
+                delta = None
+            if delta is not None and not delta.empty:
+                # 描画用の縦持ちデータも変わった末尾の行だけを置き換える
+                with stage("intraday.melt") as timing:
+                    chart_data = state["chart_data"]
+                    state["chart_data"] = timing.observe(pd.concat(
+                        [chart_data[chart_data["Date"] < delta.start], intraday_long(delta.returns)],
+                        ignore_index=True,
+                    ))
+        else:
+            st.caption("取引時間外のため、自動更新を停止しています")
 
-# --- 全体Y軸範囲を算出 (騰落率チャート用) ---
-all_min_return = min(returns.min().min(), nikkei_returns.min())
-all_max_return = max(returns.max().max(), nikkei_returns.max())
+        if feed.closes.empty:
+            st.info("表示できるデータがありません")
+            return
+        last = feed.closes.index[-1]
+        st.caption(f"最終バー: {last:%m/%d %H:%M}（場中の追加 {feed.bars}本）")
+        with stage("intraday.render") as timing:
+            chart_data = timing.observe(state["chart_data"])
+            st.altair_chart(
+                alt.Chart(chart_data)
+                .mark_line()
+                .encode(
+                    alt.X("Date:T", axis=alt.Axis(title=None)),
+                    alt.Y("Return (%):Q", axis=alt.Axis(title=None), scale=alt.Scale(zero=False)),
+                    alt.Color("Stock:N", legend=alt.Legend(title=None)),
+                    tooltip=["Date", "Stock", alt.Tooltip("Return (%):Q", format=".2f")]
+                )
+                .properties(height=400),
+                use_container_width=True
+            )
 
-# -----------------------------------------------------------------------
-## 騰落率チャートの描画
-# -----------------------------------------------------------------------
-st.altair_chart(
-    alt.Chart(
-        returns.reset_index().melt(id_vars=["Date"], var_name="Stock", value_name="Return (%)")
-    )
-    .mark_line()
-    .encode(
-        alt.X("Date:T", axis=alt.Axis(title=None)),
-        alt.Y(
-            "Return (%):Q",
-            axis=alt.Axis(title=None),
-            scale=alt.Scale(domain=[all_min_return, all_max_return])
-        ),
-        alt.Color("Stock:N", legend=alt.Legend(title=None)),
-        tooltip=["Date", "Stock", alt.Tooltip("Return (%):Q", format=".2f")]
+            # 最新バー時点の騰落率とピア平均
+            latest = pd.DataFrame({
+                "銘柄": [STOCKS.get(t, t) for t in feed.peers],
+                "騰落率（%）": feed.returns[feed.peers].iloc[-1].to_numpy(),
+                "ピア平均（%）": feed.peer_averages.iloc[-1].to_numpy(),
+            })
+            latest["差（pt）"] = latest["騰落率（%）"] - latest["ピア平均（%）"]
+            st.dataframe(latest.style.format(precision=2, na_rep="-"), hide_index=True)
+
+    intraday_chart()
+
+@st.fragment
+def return_chart_section(tickers):
+    # 騰落率チャート専用のラジオボタン（変更時はこのセクションだけを再実行する）
+    horizon_return = st.radio(
+        "騰落率チャート期間", 
+        options=list(period_map.keys()),
+        index=list(period_map.keys()).index("5年"),
+        horizontal=True,
+        key="return_period", # 独立したキーを設定
+        label_visibility="collapsed"
     )
-    .properties(height=400),
-    use_container_width=True
-)
+
+    if intraday_mode and horizon_return in INTRADAY_PERIODS:
+        intraday_return_section(tickers, horizon_return)
+        return
+
+    # --- YFinanceデータの計算 (騰落率用) ---
+    try:
+        # 選択された期間のデータをロード
+        with stage("returns.load") as timing:
+            returns = timing.observe(load_returns(tickers, period_map[horizon_return]))
+            nikkei_returns = load_nikkei_returns(period_map[horizon_return])
+    except RateLimitedError:
+        # 取得済みのキャッシュは消さずに残し、時間をおいて再試行してもらう
+        st.warning("YFinanceの制限が発生しました。時間をおいて再試行してください。")
+        return
+    except Exception as e:
+        st.error(f"データ取得中にエラーが発生しました: {e}")
+        return
+
+    # データ欠損チェック (騰落率用)。取得できなかった銘柄は除いて残りを描画する
+    empty_columns_return = returns.columns[returns.isna().all()].tolist()
+    if empty_columns_return:
+        st.warning(f"騰落率チャート用データを取得できなかった銘柄: {', '.join(empty_columns_return)}")
+        returns = returns.drop(columns=empty_columns_return)
+
+    returns = returns.rename(columns=STOCKS)
+
+    # --- 全体Y軸範囲を算出 (騰落率チャート用) ---
+    all_min_return = min(returns.min().min(), nikkei_returns.min())
+    all_max_return = max(returns.max().max(), nikkei_returns.max())
+
+    # --- 騰落率チャートの描画 ---
+    with stage("returns.melt") as timing:
+        returns_long = timing.observe(melt_downsampled(returns, "Stock", "Return (%)", RETURN_CHART_POINTS))
+    with stage("returns.render") as timing:
+        timing.observe(returns_long)
+        st.altair_chart(
+            alt.Chart(returns_long)
+            .mark_line()
+            .encode(
+                alt.X("Date:T", axis=alt.Axis(title=None)),
+                alt.Y(
+                    "Return (%):Q",
+                    axis=alt.Axis(title=None),
+                    scale=alt.Scale(domain=[all_min_return, all_max_return])
+                ),
+                alt.Color("Stock:N", legend=alt.Legend(title=None)),
+                tooltip=["Date", "Stock", alt.Tooltip("Return (%):Q", format=".2f")]
+            )
+            .properties(height=400),
+            use_container_width=True
+        )
+
+return_chart_section(tickers)
 
 
 # -----------------------------------------------------------------------
@@ -437,159 +765,288 @@ st.altair_chart(
 # -----------------------------------------------------------------------
 st.subheader("株価推移チャート")
 
-# 株価推移チャート専用のラジオボタン
-horizon_price = st.radio(
-    "株価推移チャート期間", 
-    options=list(period_map.keys()),
-    index=list(period_map.keys()).index("5年"),
-    horizontal=True,
-    key="price_period", # 独立したキーを設定
-    label_visibility="collapsed"
-)
+# 画面下部のセクション（株価推移・リスク指標・財務データ）は並列に実行し、上のチャートの表示を待たせない
+# （期間の切替など、セクション内の操作による再実行は通常どおり逐次）
+@st.fragment(parallel=True)
+def price_chart_section(tickers):
+    # 株価推移チャート専用のラジオボタン（変更時はこのセクションだけを再実行する）
+    horizon_price = st.radio(
+        "株価推移チャート期間", 
+        options=list(period_map.keys()),
+        index=list(period_map.keys()).index("5年"),
+        horizontal=True,
+        key="price_period", # 独立したキーを設定
+        label_visibility="collapsed"
+    )
 
-# -----------------------------------------------------------------------
-## YFinanceデータの計算 (株価用)
-# -----------------------------------------------------------------------
-try:
-    # 選択された期間のデータをロード
-    data_price = load_data(tickers, period_map[horizon_price])
-    nikkei_data_price = load_nikkei(period_map[horizon_price])
-except yf.exceptions.YFRateLimitError:
-    st.warning("YFinanceの制限が発生しました。時間をおいて再試行してください。")
-    load_data.clear_cache()
-    load_nikkei.clear_cache()
-    st.stop()
-except Exception as e:
-    st.error(f"データ取得中にエラーが発生しました: {e}")
-    st.stop()
-    
-# データ欠損チェック (株価用)
-empty_columns_price = data_price.columns[data_price.isna().all()].tolist()
-if empty_columns_price:
-    st.error(f"株価推移チャート用データを取得できなかった銘柄: {', '.join(empty_columns_price)}")
-    st.stop()
+    # --- YFinanceデータの計算 (株価用) ---
+    try:
+        # 選択された期間のデータをロード
+        with stage("prices.load") as timing:
+            data_price = timing.observe(load_data(tickers, period_map[horizon_price]))
+            nikkei_data_price = load_nikkei(period_map[horizon_price])
+    except RateLimitedError:
+        # 取得済みのキャッシュは消さずに残し、時間をおいて再試行してもらう
+        st.warning("YFinanceの制限が発生しました。時間をおいて再試行してください。")
+        return
+    except Exception as e:
+        st.error(f"データ取得中にエラーが発生しました: {e}")
+        return
+
+    # データ欠損チェック (株価用)
+    empty_columns_price = data_price.columns[data_price.isna().all()].tolist()
+    if empty_columns_price:
+        st.error(f"株価推移チャート用データを取得できなかった銘柄: {', '.join(empty_columns_price)}")
+        return
+
+    # --- 株価推移チャートの描画 ---
+    # 株価は共有の株価行列のビューなので列を足さず（コピーせず）、日経平均は日付を揃えた別の系列として扱う
+    price_series = {"^N225": nikkei_data_price.reindex(data_price.index)}
+    price_series.update((t, data_price[t]) for t in data_price.columns)
+
+    STOCKS_WITH_NIKKEI = STOCKS.copy()
+    STOCKS_WITH_NIKKEI["^N225"] = "日経平均"
+
+    # 描画順を日経平均を先頭にする
+    cols_ordered = list(price_series)
+
+    NUM_COLS_PRICE = 2
+
+    if render_mode == "まとめて描画":
+        with stage("prices.melt") as timing:
+            price_long = pd.concat([
+                melt_downsampled(price_series[t].to_frame(t), "Ticker", "Price", PRICE_CHART_POINTS)
+                for t in cols_ordered
+            ], ignore_index=True)
+            price_long["Name"] = price_long["Ticker"].map(lambda t: STOCKS_WITH_NIKKEI.get(t, t))
+            timing.observe(price_long)
+        price_names = [STOCKS_WITH_NIKKEI.get(t, t) for t in cols_ordered]
+        with stage("prices.render") as timing:
+            timing.observe(price_long)
+            st.altair_chart(
+                price_grid_chart(price_long, price_names, horizon_price, columns=NUM_COLS_PRICE),
+                use_container_width=False,
+            )
+    else:
+        price_cols = st.columns(NUM_COLS_PRICE)
+
+        for i, ticker in enumerate(cols_ordered):
+            company_name = STOCKS_WITH_NIKKEI.get(ticker, ticker)
+            plot_data = melt_downsampled(price_series[ticker].to_frame(ticker), "Ticker", "Price", PRICE_CHART_POINTS)
+            chart = (
+                alt.Chart(plot_data)
+                .mark_line(color="#D3D3D3" if ticker != "^N225" else "#9BB7D0")
+                .encode(
+                    alt.X("Date:T", axis=alt.Axis(title=None)),
+                    # 株価は銘柄ごとに目盛が異なって自然なので、ここでは統一しません
+                    alt.Y("Price:Q", axis=alt.Axis(title=None), scale=alt.Scale(zero=False)),
+                    alt.Tooltip(["Date", "Price"]),
+                )
+                .properties(
+                    title=f"{company_name} ({horizon_price})", # 選択期間をタイトルに表示
+                    height=250
+                )
+            )
+            cell = price_cols[i % NUM_COLS_PRICE].container()
+            cell.altair_chart(chart, use_container_width=True)
+
+price_chart_section(tickers)
 
 # -----------------------------------------------------------------------
-## 株価推移チャートの描画
+## リスク指標（ボラティリティ・日経平均に対するベータと相関・最大ドローダウン）
 # -----------------------------------------------------------------------
-data_with_nikkei = data_price.copy()
-# 日経平均データをDataFrameに追加する際は、インデックス（日付）を揃える
-data_with_nikkei["^N225"] = nikkei_data_price.reindex(data_with_nikkei.index, fill_value=None)
-
-STOCKS_WITH_NIKKEI = STOCKS.copy()
-STOCKS_WITH_NIKKEI["^N225"] = "日経平均"
+st.subheader("リスク指標")
 
-# 描画順を日経平均を先頭にする
-cols_ordered = ["^N225"] + [c for c in data_with_nikkei.columns if c != "^N225"]
+@st.fragment(parallel=True)
+def risk_section(tickers):
+    # 期間ごとに全窓の指標をまとめて計算・キャッシュするので、窓の切替は表示の切替だけで済む
+    col_period, col_window = st.columns([3, 1])
+    with col_period:
+        horizon_risk = st.radio(
+            "リスク指標の期間",
+            options=list(period_map.keys()),
+            index=list(period_map.keys()).index("1年"),
+            horizontal=True,
+            key="risk_period",
+            label_visibility="collapsed",
+        )
+    with col_window:
+        window_label = st.radio(
+            "ローリング窓",
+            options=list(RISK_WINDOW_LABELS),
+            index=1,
+            horizontal=True,
+            key="risk_window",
+            label_visibility="collapsed",
+        )
+    window = RISK_WINDOW_LABELS[window_label]
 
-NUM_COLS_PRICE = 2
-price_cols = st.columns(NUM_COLS_PRICE)
+    try:
+        with stage("risk.load"):
+            metrics = load_risk_metrics(canonical_tickers(tickers), period_map[horizon_risk])
+    except RateLimitedError:
+        st.warning("YFinanceの制限が発生しました。時間をおいて再試行してください。")
+        return
+    except Exception as e:
+        st.error(f"データ取得中にエラーが発生しました: {e}")
+        return
 
-for i, ticker in enumerate(cols_ordered):
-    company_name = STOCKS_WITH_NIKKEI.get(ticker, ticker)
-    plot_data = pd.DataFrame({
-        "Date": data_with_nikkei.index,
-        "Price": data_with_nikkei[ticker]
+    columns = [t for t in tickers if t in metrics.max_drawdown.index]
+    volatility = metrics.volatility[window][columns]
+    summary = pd.DataFrame({
+        "銘柄": [STOCKS.get(t, t) for t in columns],
+        f"ボラティリティ（年率%・{window_label}）": volatility.ffill().iloc[-1].to_numpy(),
+        f"ベータ（{window_label}）": metrics.beta[window][columns].ffill().iloc[-1].to_numpy(),
+        f"日経平均との相関（{window_label}）": metrics.correlation[window][columns].ffill().iloc[-1].to_numpy(),
+        "最大ドローダウン（%）": metrics.max_drawdown[columns].to_numpy(),
     })
-    chart = (
-        alt.Chart(plot_data)
-        .mark_line(color="#D3D3D3" if ticker != "^N225" else "#9BB7D0")
-        .encode(
-            alt.X("Date:T", axis=alt.Axis(title=None)),
-            # 株価は銘柄ごとに目盛が異なって自然なので、ここでは統一しません
-            alt.Y("Price:Q", axis=alt.Axis(title=None), scale=alt.Scale(zero=False)),
-            alt.Tooltip(["Date", "Price"]),
+    st.dataframe(
+        summary.style.format({
+            f"ボラティリティ（年率%・{window_label}）": "{:.1f}",
+            f"ベータ（{window_label}）": "{:.2f}",
+            f"日経平均との相関（{window_label}）": "{:.2f}",
+            "最大ドローダウン（%）": "{:.1f}",
+        }, na_rep='-'),
+        width='stretch',
+        hide_index=True,
+    )
+
+    col_volatility, col_heatmap = st.columns([3, 2])
+    with col_volatility:
+        st.altair_chart(
+            alt.Chart(
+                melt_downsampled(volatility.rename(columns=STOCKS), "Stock", "Volatility (%)", RETURN_CHART_POINTS)
+            )
+            .mark_line()
+            .encode(
+                alt.X("Date:T", axis=alt.Axis(title=None)),
+                alt.Y("Volatility (%):Q", axis=alt.Axis(title=f"ボラティリティ（年率%・{window_label}）")),
+                alt.Color("Stock:N", legend=alt.Legend(title=None, orient="bottom")),
+                tooltip=["Date", "Stock", alt.Tooltip("Volatility (%):Q", format=".1f")],
+            )
+            .properties(height=350),
+            use_container_width=True,
         )
-        .properties(
-            title=f"{company_name} ({horizon_price})", # 選択期間をタイトルに表示
-            height=250
+    with col_heatmap:
+        # セクター内の日次リターンの相関
+        names = [STOCKS.get(t, t) for t in columns]
+        heatmap_data = (
+            metrics.correlation_matrix.loc[columns, columns]
+            .set_axis(names, axis=0).set_axis(names, axis=1)
+            .rename_axis("Stock").reset_index()
+            .melt("Stock", var_name="Other", value_name="Correlation")
+        )
+        base = alt.Chart(heatmap_data).encode(
+            alt.X("Other:N", sort=names, axis=alt.Axis(title=None, labelAngle=-45)),
+            alt.Y("Stock:N", sort=names, axis=alt.Axis(title=None)),
+        )
+        st.altair_chart(
+            (
+                base.mark_rect().encode(
+                    alt.Color("Correlation:Q", scale=alt.Scale(scheme="redblue", domain=[-1, 1], reverse=True),
+                              legend=None),
+                    tooltip=["Stock", "Other", alt.Tooltip("Correlation:Q", format=".2f")],
+                )
+                + base.mark_text(fontSize=10).encode(alt.Text("Correlation:Q", format=".2f"))
+            ).properties(height=350),
+            use_container_width=True,
         )
-    )
-    cell = price_cols[i % NUM_COLS_PRICE].container()
-    cell.altair_chart(chart, use_container_width=True)
+
+risk_section(tickers)
 
 # -----------------------------------------------------------------------
 ## 株主視点の主要指標テーブル
 # -----------------------------------------------------------------------
 st.subheader("株主向けファンダメンタル指標")
 
-# 最終更新日時を保持するセッションステート
-if "shareholder_metrics_last_updated" not in st.session_state:
-    st.session_state.shareholder_metrics_last_updated = "未取得"
+# 財務データ（銘柄ごとのリクエスト）の取得も並列に実行する
+@st.fragment(parallel=True)
+def shareholder_section(tickers):
+    # 最終更新日時を保持するセッションステート
+    if "shareholder_metrics_last_updated" not in st.session_state:
+        st.session_state.shareholder_metrics_last_updated = "未取得"
 
-@st.cache_data(show_spinner=False)
-def load_shareholder_metrics(tickers):
-    import datetime
-    import yfinance as yf
+    with stage("fundamentals.load") as timing:
+        shareholder_df, shareholder_errors, fetched_at = load_shareholder_metrics(canonical_tickers(tickers))
+        timing.observe(shareholder_df)
+    if fetched_at is not None:
+        st.session_state.shareholder_metrics_last_updated = fetched_at.strftime("%Y年%m月%d日 %H:%M")
 
-    data = []
-    
-    for t in tickers:
-        try:
-            ticker_obj = yf.Ticker(t)
-            info = ticker_obj.info
-            
-            if not info:
-                 st.warning(f"{t} の財務データが空です（データなし）")
-                 continue
-            
-            market_cap_trillion = info.get("marketCap", 0) / 1e12 if info.get("marketCap") else None
-            
-            # 配当利回り（%）は、yfinanceの戻り値（比率）に100を掛けてパーセント表示に修正
-            dividend_yield_percent = info.get("dividendYield", 0) * 100 if info.get("dividendYield") else None
-            
-            data.append({
-                "銘柄": STOCKS.get(t, t),
-                "PER（予想）": info.get("forwardPE"),
-                "PBR": info.get("priceToBook"),
-                "PSR": info.get("priceToSalesTrailing12Months"),
-                "ROE（%）": info.get("returnOnEquity", 0) * 100 if info.get("returnOnEquity") else None,
-                "営業利益率（%）": info.get("operatingMargins", 0) * 100 if info.get("operatingMargins") else None,
-                "純利益率（%）": info.get("profitMargins", 0) * 100 if info.get("profitMargins") else None,
-                "売上成長率（%）": info.get("revenueGrowth", 0) * 100 if info.get("revenueGrowth") else None,
-                "利益成長率（%）": info.get("earningsGrowth", 0) * 100 if info.get("earningsGrowth") else None,
-                
-                "配当利回り（%）": dividend_yield_percent, # 修正後の値を使用
-                
-                "配当性向（%）": info.get("payoutRatio", 0) * 100 if info.get("payoutRatio") else None,
-                "負債比率（D/E）": info.get("debtToEquity"),
-                "流動比率": info.get("currentRatio"),
-                "時価総額（兆円）": market_cap_trillion,
-            })
-        except Exception as e:
-            st.warning(f"{t} の財務データ取得中に例外が発生しました: {e}")
-            
-    df = pd.DataFrame(data)
-    
-    st.session_state.shareholder_metrics_last_updated = datetime.datetime.now().strftime("%Y年%m月%d日 %H:%M")
-    
-    return df
+    # 表の行は選択順に並べる
+    if not shareholder_df.empty:
+        ticker_order = {STOCKS.get(t, t): i for i, t in enumerate(tickers)}
+        shareholder_df = shareholder_df.sort_values("銘柄", key=lambda s: s.map(ticker_order), ignore_index=True)
 
-shareholder_df = load_shareholder_metrics(tickers)
+    for error in shareholder_errors:
+        st.warning(error)
 
-# ★ データ取得日時を表示する
-st.caption(f"データ取得日時（キャッシュ最終更新）: **{st.session_state.shareholder_metrics_last_updated}**")
+    # ★ データ取得日時を表示する
+    shareholder_state = load_shareholder_metrics.state(canonical_tickers(tickers))
+    shareholder_state_label = {"refreshing": "（更新中）", "stale": "（期限切れ）"}.get(shareholder_state, "")
+    st.caption(
+        f"データ取得日時（キャッシュ最終更新）: **{st.session_state.shareholder_metrics_last_updated}**"
+        f"{shareholder_state_label}"
+    )
 
-if shareholder_df.empty:
-    st.warning("株主向け指標データを取得できませんでした。")
-else:
-    st.dataframe(
-        shareholder_df.style.format({
-            "PER（予想）": "{:.1f}",
-            "PBR": "{:.2f}",
-            "PSR": "{:.2f}",
-            "ROE（%）": "{:.1f}",
-            "営業利益率（%）": "{:.1f}",
-            "純利益率（%）": "{:.1f}",
-            "売上成長率（%）": "{:.1f}",
-            "利益成長率（%）": "{:.1f}",
+    if shareholder_df.empty:
+        st.warning("株主向け指標データを取得できませんでした。")
+    else:
+        st.dataframe(
+            shareholder_df.style.format({
+                "PER（予想）": "{:.1f}",
+                "PBR": "{:.2f}",
+                "PSR": "{:.2f}",
+                "ROE（%）": "{:.1f}",
+                "営業利益率（%）": "{:.1f}",
+                "純利益率（%）": "{:.1f}",
+                "売上成長率（%）": "{:.1f}",
+                "利益成長率（%）": "{:.1f}",
             
-            "配当利回り（%）": "{:.2f}", # *100したため、単なる数値としてフォーマット
+                "配当利回り（%）": "{:.2f}", # *100したため、単なる数値としてフォーマット
             
-            "配当性向（%）": "{:,.0f}",
-            "負債比率（D/E）": "{:.2f}",
-            "流動比率": "{:.1f}",
-            "時価総額（兆円）": "{:,.2f}",
-        }, na_rep='-'),
-        width='stretch',
-    )
\ No newline at end of file
+                "配当性向（%）": "{:,.0f}",
+                "負債比率（D/E）": "{:.2f}",
+                "流動比率": "{:.1f}",
+                "時価総額（兆円）": "{:,.2f}",
+            }, na_rep='-'),
+            width='stretch',
+        )
+
+    # 日次スナップショットから指標の推移と前回からの変化を表示する
+    SNAPSHOT_FIELDS = {
+        "PER（予想）": "forwardPE",
+        "PBR": "priceToBook",
+        "ROE（%）": "returnOnEquity",
+        "配当利回り（%）": "dividendYield",
+    }
+
+    with st.expander("指標の推移（日次スナップショット）"):
+        field_label = st.selectbox("指標", list(SNAPSHOT_FIELDS), key="snapshot_field")
+        field = SNAPSHOT_FIELDS[field_label]
+        snapshot_history = snapshot_store.history(tickers, field)
+        if snapshot_history.empty:
+            st.info("スナップショットがまだありません。")
+        else:
+            if field_label.endswith("（%）"):
+                snapshot_history = snapshot_history * 100
+            snapshot_history = snapshot_history.rename(columns=STOCKS).rename_axis("日付").reset_index()
+            st.altair_chart(
+                alt.Chart(snapshot_history.melt("日付", var_name="銘柄", value_name=field_label))
+                .mark_line(point=True)
+                .encode(x="日付:T", y=alt.Y(f"{field_label}:Q", scale=alt.Scale(zero=False)), color="銘柄:N"),
+                width='stretch',
+            )
+
+        snapshot_changes = snapshot_store.changes(pd.Timestamp.now())
+        snapshot_changes = snapshot_changes[snapshot_changes["ticker"].isin(tickers)]
+        if not snapshot_changes.empty:
+            st.caption("本日のスナップショットで前回から変化した項目")
+            st.dataframe(
+                snapshot_changes.assign(ticker=snapshot_changes["ticker"].map(lambda t: STOCKS.get(t, t)))
+                .rename(columns={"ticker": "銘柄", "field": "項目", "old": "前回", "new": "今回"}),
+                hide_index=True,
+            )
+
+shareholder_section(tickers)
+
+finish_page()
\ No newline at end of file
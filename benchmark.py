@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""Yahooに接続せずに処理段階ごとの所要時間を測るベンチマーク
+
+    python benchmark.py --sizes 5 60 500 2000 --horizons 1y 5y 20y --repeat 3
+    python benchmark.py --sizes 60 --latency 0.2 --rate-limit-rate 0.05
+
+yfinance は fake_yfinance.FakeYahoo に置き換え、ストアは一時ディレクトリに向ける（実際のストアには触れない）。
+銘柄数×期間ごとに各段階を repeat 回実行して中央値を記録し、benchmarks/results.jsonl に追記する。
+同じ条件の前回の別バージョンの結果があれば、その比も表示する。
+アプリのコールドスタート（新しいプロセスで app.py を初めて実行し、最初のチャートを表示するまで）も
+--cold-start 回測る（cold_first_paint・cold_run）。
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import altair as alt
+import pandas as pd
+
+from analytics import comparison_domains, peer_averages, risk_metrics
+from charts import comparison_grid_chart, comparison_long_data, price_grid_chart
+from data_cache import FUNDAMENTALS_POLICY, PRICE_POLICY, get_cache
+from fake_yfinance import FakeRateLimitError, FakeYahoo
+from fetch_scheduler import scheduler
+from fundamentals import load_fundamentals, snapshot_store
+from loaders import load_history, load_nikkei_history, load_nikkei_returns, load_returns, precomputed_store
+from market_data import HISTORY_PERIODS, history_period, load_closes, price_store
+from screener import screen
+from universe import load_universe, sectors_from_universe
+
+RESULTS_PATH = Path(__file__).resolve().parent / "benchmarks" / "results.jsonl"
+APP_PATH = Path(__file__).resolve().parent / "app.py"
+
+# app.py と同じ比較期間と1ページの銘柄数
+COMPARISON_PERIODS = {"1か月": "1mo", "1年": "1y", "3年": "3y", "5年": "5y"}
+COMPANIES_PER_PAGE = 4
+CHART_POINTS = 250
+
+
+def fake_universe(size):
+    """ベンチマーク用のティッカーとセクター（11セクターに均等に割り振る）"""
+    tickers = [f"{1000 + i}.T" for i in range(size)]
+    sectors = pd.Series([f"セクター{i % 11:02d}" for i in range(size)], index=tickers)
+    return tickers, sectors
+
+
+def clear_caches():
+    get_cache(PRICE_POLICY).clear()
+    get_cache(FUNDAMENTALS_POLICY).clear()
+
+
+def clear_store():
+    clear_caches()
+    shutil.rmtree(price_store.root, ignore_errors=True)
+
+
+def use_temporary_stores():
+    """株価・財務データ・事前計算のストアを一時ディレクトリに向け、そのディレクトリを返す"""
+    root = Path(tempfile.mkdtemp(prefix="stock-benchmark-"))
+    price_store.root = root / "prices"
+    snapshot_store.root = root / "fundamentals"
+    precomputed_store.root = root / "precomputed"
+    return root
+
+
+def timed(fn, repeat, setup=None):
+    """setup → fn を repeat 回繰り返し、fn の所要時間（秒）の中央値と最後の戻り値を返す"""
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds), result
+
+
+def horizon_stages(tickers, horizon):
+    """表示期間によって処理量が変わる段階"""
+    history = history_period(horizon)
+    yield "download", lambda: load_closes(tickers + ["^N225"], history), clear_store
+    yield "store_read", lambda: load_closes(tickers + ["^N225"], history), clear_caches
+    yield "returns", lambda: (load_returns(tickers, horizon), load_nikkei_returns(horizon)), clear_caches
+    closes = load_history(tuple(tickers), history)
+    nikkei = load_nikkei_history(history)
+    yield "risk_metrics", lambda: risk_metrics(closes, nikkei, horizon), None
+
+
+def universe_stages(tickers, sectors):
+    """騰落率推移チャート（固定期間）・財務データ・スクリーニングの段階"""
+    def comparison_returns():
+        returns = {label: load_returns(tickers, period) for label, period in COMPARISON_PERIODS.items()}
+        nikkei = {label: load_nikkei_returns(period) for label, period in COMPARISON_PERIODS.items()}
+        return returns, nikkei
+
+    yield "comparison_returns", comparison_returns, clear_caches
+    returns, nikkei = comparison_returns()
+    yield "peer_averages", lambda: {label: peer_averages(data) for label, data in returns.items()}, None
+    peers = {label: peer_averages(data) for label, data in returns.items()}
+    yield "domains", lambda: comparison_domains(returns, peers, nikkei), None
+
+    page = tickers[:COMPANIES_PER_PAGE]
+
+    def charts():
+        # Streamlit はデータを別に送るので、Altair の行数上限は外して仕様の生成だけを測る
+        with alt.data_transformers.disable_max_rows():
+            return _charts()
+
+    def _charts():
+        domains = comparison_domains(returns, peers, nikkei)
+        data = comparison_long_data(returns, peers, nikkei, page, CHART_POINTS)
+        grid = comparison_grid_chart(data, list(returns), domains, page).to_dict()
+        prices = load_closes(page, "5y").reset_index().melt("Date", var_name="Ticker", value_name="Price")
+        prices["Name"] = prices["Ticker"]
+        return grid, price_grid_chart(prices, page, "5y").to_dict()
+
+    yield "charts", charts, None
+
+    def clear_snapshots():
+        clear_caches()
+        shutil.rmtree(snapshot_store.root, ignore_errors=True)
+
+    yield "fundamentals", lambda: load_fundamentals(tuple(tickers), with_statements=True), clear_snapshots
+    table, _ = load_fundamentals(tuple(tickers), with_statements=True)
+    yield "screen", lambda: screen(table, sectors=sectors), None
+
+
+# コールドスタートを測る子プロセス（Streamlit 本体の読み込みはサーバー起動時に済んでいるので含めない）
+COLD_START_SCRIPT = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=300)
+start = time.perf_counter()
+at.run()
+seconds = time.perf_counter() - start
+from instrumentation import recorder
+first_paint = [s["p50"] for s in recorder.summary() if s["stage"] == "startup.first_paint.cold"]
+print(json.dumps({
+    "first_paint": first_paint[0] if first_paint else None,
+    "run": seconds,
+    "errors": [e.message for e in at.exception],
+}))
+"""
+
+
+def cold_start(store_root, repeat):
+    """初期表示のセクターで app.py をコールドスタートし、最初の表示までと1回の実行の所要時間の中央値を返す
+
+    株価と当日の財務データのスナップショットはストアに入れておき、子プロセスはYahooに問い合わせない
+    （STOCK_TAIL_REFRESH=0）。ネットワークを除いた、読み込みと計算・描画の時間になる。
+    """
+    tickers = list(next(iter(sectors_from_universe(load_universe()).values())))
+    load_closes(tickers + ["^N225"], HISTORY_PERIODS[-1])
+    load_fundamentals(tuple(tickers))
+
+    env = {**os.environ, "STOCK_STORE_DIR": str(store_root), "STOCK_TAIL_REFRESH": "0"}
+    first_paints, runs = [], []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", COLD_START_SCRIPT, str(APP_PATH)],
+            capture_output=True, text=True, env=env, cwd=APP_PATH.parent,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "子プロセスが失敗しました")
+        measured = json.loads(result.stdout.strip().splitlines()[-1])
+        if measured["errors"] or measured["first_paint"] is None:
+            raise RuntimeError(f"アプリの実行に失敗しました: {measured['errors']}")
+        first_paints.append(measured["first_paint"])
+        runs.append(measured["run"])
+    return len(tickers), statistics.median(first_paints), statistics.median(runs)
+
+
+def run(sizes, horizons, repeat, fake, cold_start_runs=0, store_root=None):
+    results = []
+
+    def record(stage, size, horizon, fn, setup):
+        try:
+            seconds, _ = timed(fn, repeat, setup)
+            error = None
+        except Exception as e:
+            seconds, error = None, f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+        results.append({"stage": stage, "tickers": size, "horizon": horizon, "seconds": seconds, "error": error})
+        shown = f"{seconds * 1000:10.1f} ms" if seconds is not None else f"失敗 ({error})"
+        print(f"{stage:<20}{size:>6}{horizon:>6} {shown}", flush=True)
+
+    with fake.installed():
+        for size in sizes:
+            tickers, sectors = fake_universe(size)
+            for horizon in horizons:
+                try:
+                    for stage, fn, setup in horizon_stages(tickers, horizon):
+                        record(stage, size, horizon, fn, setup)
+                except Exception as e:
+                    print(f"{size}銘柄・{horizon}の準備に失敗しました: {e}", flush=True)
+            try:
+                for stage, fn, setup in universe_stages(tickers, sectors):
+                    record(stage, size, "-", fn, setup)
+            except Exception as e:
+                print(f"{size}銘柄の準備に失敗しました: {e}", flush=True)
+
+        if cold_start_runs:
+            clear_store()
+            try:
+                size, first_paint, app_run = cold_start(store_root, cold_start_runs)
+            except Exception as e:
+                print(f"コールドスタートの計測に失敗しました: {e}", flush=True)
+            else:
+                for stage, seconds in (("cold_first_paint", first_paint), ("cold_run", app_run)):
+                    results.append({"stage": stage, "tickers": size, "horizon": "-", "seconds": seconds, "error": None})
+                    print(f"{stage:<20}{size:>6}{'-':>6} {seconds * 1000:10.1f} ms", flush=True)
+    return results
+
+
+def code_version():
+    """結果に記録するバージョン（git のコミット、取れなければ None）"""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path=RESULTS_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def save_results(records, path=RESULTS_PATH):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def compare(records, previous):
+    """同じ条件（段階・銘柄数・期間・フェイクの設定）の、別バージョンの直近の結果との比を表示する"""
+    def condition(r):
+        return (r["stage"], r["tickers"], r["horizon"], json.dumps(r["config"], sort_keys=True))
+
+    baseline = {}
+    for r in previous:
+        if r.get("version") != records[0]["version"] and r.get("seconds") is not None:
+            baseline[condition(r)] = r
+    rows = []
+    for r in records:
+        base = baseline.get(condition(r))
+        if base is None or r["seconds"] is None:
+            continue
+        rows.append(f"{r['stage']:<20}{r['tickers']:>6}{r['horizon']:>6} "
+                    f"{r['seconds'] / base['seconds']:6.2f}x（{base['version']} 比）")
+    if rows:
+        print("\n前回の結果との比（1より大きいほど遅い）")
+        print("\n".join(rows))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Yahooに接続せずに処理段階ごとの所要時間を測る")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 60, 500, 2000], help="銘柄数")
+    parser.add_argument("--horizons", nargs="+", default=["1y", "5y", "20y"], help="表示期間（yfinance形式）")
+    parser.add_argument("--repeat", type=int, default=3, help="各段階の実行回数（中央値を記録）")
+    parser.add_argument("--latency", type=float, default=0.0, help="フェイクの応答遅延（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="フェイクが例外を送出する確率")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="フェイクが429を返す確率")
+    parser.add_argument("--seed", type=int, default=0, help="失敗を発生させる乱数のシード")
+    parser.add_argument("--cold-start", type=int, default=3, help="アプリのコールドスタートの計測回数（0で省略）")
+    parser.add_argument("--no-save", action="store_true", help="結果を保存しない")
+    args = parser.parse_args(argv)
+
+    config = {"latency": args.latency, "error_rate": args.error_rate, "rate_limit_rate": args.rate_limit_rate}
+    fake = FakeYahoo(args.latency, args.error_rate, args.rate_limit_rate, seed=args.seed)
+    # 流量制限はかけず、429の再試行待ちは短くして処理時間を測る
+    scheduler.set_rate(1e6, burst=1000)
+    scheduler.rate_limit_errors += (FakeRateLimitError,)
+    scheduler.base_delay, scheduler.max_delay, scheduler.cooldown = 0.01, 0.1, 0.1
+
+    store_root = use_temporary_stores()
+    print(f"{'stage':<20}{'tickers':>6}{'horizon':>6}")
+    try:
+        results = run(args.sizes, args.horizons, args.repeat, fake, args.cold_start, store_root)
+    finally:
+        shutil.rmtree(store_root, ignore_errors=True)
+
+    version = code_version()
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+    records = [
+        {"timestamp": timestamp, "version": version, "repeat": args.repeat, "config": config, **r}
+        for r in results
+    ]
+    print(f"\nフェイクへのリクエスト: {fake.stats}、スケジューラ: {scheduler.stats}")
+    if records:
+        compare(records, load_results())
+        if not args.no_save:
+            save_results(records)
+    return 1 if any(r["error"] for r in records) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""セクション全体を1つのVega-Lite仕様で描画するためのチャート生成"""
+import altair as alt
+import pandas as pd
+
+from downsample import melt_downsampled
+
+COMPANY_COLOR = "#C70025"
+NIKKEI_COLOR = "#9BB7D0"
+PEER_COLOR = "#D3D3D3"
+
+
+def comparison_long_data(comparison_returns, peer_avgs, nikkei_returns, companies, max_points):
+    """騰落率推移チャート用に、全銘柄・全期間の系列を1つの縦持ちデータにまとめる
+
+    列は Date / Series / Return (%) / Company / Period。Series は
+    "Company"（自銘柄）・"Peer average"・"Nikkei 225" のいずれか。
+    """
+    parts = []
+    for period_label, period_data in comparison_returns.items():
+        nikkei = nikkei_returns.get(period_label)
+        for company in companies:
+            if company not in period_data.columns:
+                continue
+            frame = pd.DataFrame({
+                "Company": period_data[company],
+                "Peer average": peer_avgs[period_label][company],
+            }, index=period_data.index)
+            if nikkei is not None:
+                frame["Nikkei 225"] = nikkei.reindex(period_data.index)
+            part = melt_downsampled(frame, "Series", "Return (%)", max_points)
+            part["Company"] = company
+            part["Period"] = period_label
+            parts.append(part)
+    if not parts:
+        return pd.DataFrame(columns=["Date", "Series", "Return (%)", "Company", "Period"])
+    return pd.concat(parts, ignore_index=True)
+
+
+def comparison_grid_chart(data, period_labels, domains, companies, width=260, height=220):
+    """銘柄（行）× 期間（列）の比較チャートを、共有データ1つの仕様で生成する
+
+    期間ごとに目盛が異なるため、期間単位のファセットを横に連結する（セルの絞り込みはファセットと
+    Period 列のフィルタで行う）。
+    """
+    columns = []
+    for i, period_label in enumerate(period_labels):
+        base = alt.Chart().transform_filter(
+            alt.datum.Period == period_label
+        ).encode(
+            x=alt.X("Date:T", axis=alt.Axis(title=None)),
+            y=alt.Y(
+                "Return (%):Q",
+                axis=alt.Axis(title=None),
+                scale=alt.Scale(domain=domains.get(period_label)),
+            ),
+            tooltip=["Date:T", "Company:N", "Series:N", alt.Tooltip("Return (%):Q", format=".2f")],
+        )
+        other_lines = base.transform_filter(
+            alt.datum.Series != "Company"
+        ).mark_line().encode(
+            color=alt.Color(
+                "Series:N",
+                scale=alt.Scale(domain=["Nikkei 225", "Peer average"], range=[NIKKEI_COLOR, PEER_COLOR]),
+                legend=None,
+            )
+        )
+        company_line = base.transform_filter(
+            alt.datum.Series == "Company"
+        ).mark_line(color=COMPANY_COLOR)
+
+        # 銘柄名の見出しは左端の列にだけ表示する
+        header = alt.Header(title=None, labelAngle=0, labelAlign="left", labelOrient="top", labelFontSize=14,
+                            labelFontWeight="bold", labels=(i == 0))
+        columns.append(
+            alt.layer(other_lines, company_line)
+            .properties(width=width, height=height)
+            .facet(row=alt.Row("Company:N", sort=companies, header=header), data=data, title=period_label)
+        )
+    # 同じデータは仕様内の datasets に1つだけ格納され、各セルから参照される
+    return alt.hconcat(*columns)
+
+
+def price_grid_chart(data, names, title_suffix, columns=2, width=520, height=250):
+    """株価推移チャートを銘柄ごとのファセットにまとめた1つの仕様で生成する
+
+    data は Date / Ticker / Price / Name の縦持ち。目盛は銘柄ごとに独立させる。
+    """
+    return (
+        alt.Chart(data)
+        .mark_line()
+        .encode(
+            alt.X("Date:T", axis=alt.Axis(title=None)),
+            # 株価は銘柄ごとに目盛が異なって自然なので、ここでは統一しません
+            alt.Y("Price:Q", axis=alt.Axis(title=None), scale=alt.Scale(zero=False)),
+            color=alt.condition(alt.datum.Ticker == "^N225", alt.value(NIKKEI_COLOR), alt.value(PEER_COLOR)),
+            tooltip=["Date:T", "Name:N", "Price:Q"],
+        )
+        .properties(width=width, height=height)
+        .facet(
+            facet=alt.Facet(
+                "Name:N",
+                sort=names,
+                title=None,
+                header=alt.Header(labelFontSize=14, labelExpr=f"datum.label + ' ({title_suffix})'"),
+            ),
+            columns=columns,
+        )
+        .resolve_scale(y="independent")
+    )
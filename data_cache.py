@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""データ種別ごとのキャッシュポリシー（TTL・件数上限・メモリ上限）
+
+プロセス内の全セッションで共有するLRUキャッシュ。キャッシュした値はコピーせずに返すので、
+呼び出し側で変更しないこと。
+期限切れから stale_ttl 秒以内の値は、そのまま返しつつバックグラウンドのスレッドで取り直す
+（stale-while-revalidate）。取得を待つのは値が一度もないときだけになる。
+"""
+import contextvars
+import dataclasses
+import functools
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import pandas as pd
+
+from fetch_scheduler import SingleFlight
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    name: str
+    ttl: float            # 秒
+    max_entries: int
+    max_bytes: int
+    stale_ttl: float = 0  # 秒（期限切れ後、取り直しの間に古い値を返してよい時間）
+
+
+# 株価は場中に更新されるので短め、財務データは1日
+PRICE_POLICY = CachePolicy(
+    "株価", ttl=15 * 60, max_entries=128, max_bytes=256 * 1024**2, stale_ttl=24 * 60 * 60,
+)
+FUNDAMENTALS_POLICY = CachePolicy(
+    "財務データ", ttl=24 * 60 * 60, max_entries=64, max_bytes=32 * 1024**2, stale_ttl=7 * 24 * 60 * 60,
+)
+
+# バックグラウンドでの取り直しに失敗したとき、次に試すまでの秒数
+REVALIDATE_RETRY_DELAY = 60
+
+# スレッドごとの状態（取り直し中のスレッドでは入れ子のキャッシュも古い値を返さずに計算する。
+# ヒット/ミスの累計は instrumentation の計測に使う）
+_local = threading.local()
+
+# 実行ごとに古い値を返したキャッシュの記録（track_stale で記録し始める。並列のフラグメントにも引き継がれる）
+_served_stale = contextvars.ContextVar("served_stale", default=None)
+
+
+def estimate_size(value):
+    """キャッシュ値のおおよそのメモリ使用量（バイト）"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum() if isinstance(value, pd.DataFrame) else usage)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        # RiskMetrics など、DataFrame を保持するデータクラスは各フィールドを数える
+        return sys.getsizeof(value) + sum(estimate_size(getattr(value, f.name)) for f in dataclasses.fields(value))
+    return sys.getsizeof(value)
+
+
+def _count_thread(name):
+    setattr(_local, name, getattr(_local, name, 0) + 1)
+
+
+def thread_cache_counts():
+    """このスレッドでのキャッシュのヒット数とミス数の累計（計測用）"""
+    return getattr(_local, "hits", 0), getattr(_local, "misses", 0)
+
+
+class _Entry:
+    __slots__ = ("value", "size", "expires", "retry_at")
+
+    def __init__(self, value, size, expires):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.retry_at = expires
+
+
+class DataCache:
+    def __init__(self, policy, clock=time.monotonic):
+        self.policy = policy
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.bytes = 0
+        self.refreshing = set()
+        self.generation = 0  # バックグラウンドでの取り直しが完了するたびに増える
+        self.stats = {
+            "hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+            "stale_hits": 0, "revalidations": 0, "revalidation_errors": 0,
+        }
+
+    def get_or_compute(self, key, compute, keep=None):
+        """key の値を返す（なければ compute() で計算する）
+
+        keep を渡すと、keep(値) が偽の値（一部の取得に失敗した結果など）は保持せず、次の呼び出しで計算し直す。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                now = self._clock()
+                if entry.expires > now:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    _count_thread("hits")
+                    return entry.value
+                if entry.expires + self.policy.stale_ttl > now and not getattr(_local, "revalidating", False):
+                    self._entries.move_to_end(key)
+                    self.stats["stale_hits"] += 1
+                    _count_thread("hits")
+                    served = _served_stale.get()
+                    if served is not None:
+                        served.append((self, key, entry))
+                    if key not in self.refreshing and entry.retry_at <= now:
+                        self.refreshing.add(key)
+                        threading.Thread(target=self._revalidate, args=(key, compute, keep), daemon=True).start()
+                    return entry.value
+                self._remove(key)
+                self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            _count_thread("misses")
+        return self._flight.do(key, lambda: self._compute(key, compute, keep))
+
+    def state(self, key):
+        """"fresh" / "refreshing"（古い値を返しつつ取り直し中） / "stale" / None（値なし）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if key in self.refreshing:
+                return "refreshing"
+            return "fresh" if entry.expires > self._clock() else "stale"
+
+    def _revalidate(self, key, compute, keep=None):
+        _local.revalidating = True
+        try:
+            value = self._flight.do(key, lambda: self._compute(key, compute, keep))
+            if keep is not None and not keep(value):
+                raise ValueError("保持しない値が返りました")
+        except Exception:
+            # 古い値を残し、少し待ってから次のアクセスで取り直す
+            with self._lock:
+                self.stats["revalidation_errors"] += 1
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.retry_at = self._clock() + REVALIDATE_RETRY_DELAY
+        else:
+            with self._lock:
+                self.stats["revalidations"] += 1
+                self.generation += 1
+        finally:
+            with self._lock:
+                self.refreshing.discard(key)
+
+    def _compute(self, key, compute, keep=None):
+        value = compute()
+        if keep is not None and not keep(value):
+            return value
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, size, self._clock() + self.policy.ttl)
+            self.bytes += size
+            # 上限を超えた分は最も長く使われていないものから捨てる（最新の1件は残す）
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.policy.max_entries or self.bytes > self.policy.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+        return value
+
+    def _remove(self, key):
+        self.bytes -= self._entries.pop(key).size
+
+    def clear(self, prefix=None):
+        with self._lock:
+            for key in [k for k in self._entries if prefix is None or k[0] == prefix]:
+                self._remove(key)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(policy):
+    """ポリシーごとのキャッシュ（同じ名前のポリシーは1つを共有）"""
+    with _caches_lock:
+        if policy.name not in _caches:
+            _caches[policy.name] = DataCache(policy)
+        return _caches[policy.name]
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def cached(policy, keep=None):
+    """関数の戻り値をポリシーに従ってキャッシュするデコレータ
+
+    キャッシュは関数名で識別するので、Streamlitの再実行で関数が定義し直されても引き継がれる。
+    keep(戻り値) が偽の戻り値はキャッシュしない（DataCache.get_or_compute を参照）。
+    """
+    cache = get_cache(policy)
+
+    def decorator(fn):
+        name = f"{fn.__module__}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (name, _freeze(args), _freeze(kwargs))
+            return cache.get_or_compute(key, lambda: fn(*args, **kwargs), keep)
+
+        wrapper.clear = lambda: cache.clear(name)
+        wrapper.state = lambda *args, **kwargs: cache.state((name, _freeze(args), _freeze(kwargs)))
+        return wrapper
+
+    return decorator
+
+
+def track_stale():
+    """以降にこの実行で古い値を返したキャッシュを記録し始め、記録先のリストを返す"""
+    served = []
+    _served_stale.set(served)
+    return served
+
+
+def refresh_status(served):
+    """track_stale() の記録のうち (バックグラウンドで取り直し中の件数, 取り直して値が新しくなった件数)"""
+    refreshing = updated = 0
+    # 同じ値を何度返しても1件と数える
+    for cache, key, entry in {(id(c), k): (c, k, e) for c, k, e in list(served)}.values():
+        with cache._lock:
+            if key in cache.refreshing:
+                refreshing += 1
+            elif cache._entries.get(key) is not entry:
+                updated += 1
+    return refreshing, updated
+
+
+def cache_stats():
+    """ポリシーごとのヒット・ミス・追い出し件数とメモリ使用量"""
+    rows = []
+    for cache in list(_caches.values()):
+        stats = cache.stats
+        lookups = stats["hits"] + stats["misses"]
+        rows.append({
+            "キャッシュ": cache.policy.name,
+            "件数": len(cache._entries),
+            "使用量（MB）": cache.bytes / 1024**2,
+            "上限（MB）": cache.policy.max_bytes / 1024**2,
+            "TTL（分）": cache.policy.ttl / 60,
+            "ヒット": stats["hits"],
+            "ミス": stats["misses"],
+            "追い出し": stats["evictions"],
+            "期限切れ": stats["expirations"],
+            "期限切れ配信": stats["stale_hits"],
+            "更新中": len(cache.refreshing),
+            "ヒット率（%）": stats["hits"] / lookups * 100 if lookups else None,
+        })
+    return pd.DataFrame(rows)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""チャート描画前の時系列の間引き（Largest-Triangle-Three-Buckets）"""
+import numpy as np
+import pandas as pd
+
+
+def lttb_indices(x, y, threshold):
+    """LTTBで残す点のインデックスを返す（先頭と末尾は必ず残る）
+
+    各バケットから、前に選んだ点と次バケットの平均点で作る三角形の面積が最大の点を選ぶので、
+    山や谷などの見た目上の極値が残りやすい。
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(area.argmax())
+        indices[i + 1] = a
+    return indices
+
+
+def melt_downsampled(frame, var_name, value_name, max_points, id_name="Date"):
+    """各列を max_points 点までLTTBで間引いてから縦持ち（melt形式）に変換する
+
+    NaNの点は列ごとに除いてから間引く。
+    """
+    parts = []
+    for column in frame.columns:
+        series = frame[column].dropna()
+        if series.empty:
+            continue
+        x = series.index.to_numpy().astype("datetime64[ns]").astype(np.int64)
+        values = series.to_numpy(dtype=float)
+        keep = lttb_indices(x - x[0], values, max_points)
+        parts.append(pd.DataFrame({
+            id_name: series.index[keep],
+            var_name: column,
+            value_name: values[keep],
+        }))
+    if not parts:
+        return pd.DataFrame(columns=[id_name, var_name, value_name])
+    return pd.concat(parts, ignore_index=True)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""騰落率・ピア平均・日経平均・株主向け指標を Parquet / Arrow IPC / CSV で一括エクスポートする
+
+    python export.py returns --period 20y --format parquet --output returns_20y.parquet
+    python export.py fundamentals --sector 化学 --format csv --output - > chemicals.csv
+
+騰落率は事前計算済みの結果（precompute.py）を使い（なければストアの株価から計算する）、
+財務データは保存済みのスナップショットを使う。いずれもYahooには問い合わせないので、
+保存済みのデータがないセクターは書き出さない（export_catalog.missing_sectors で確認できる）。
+セクターごとのチャンクに分けて縦持ちの表として順に書き出すので、全銘柄×20年でも全体をメモリに載せない。
+"""
+import argparse
+import logging
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from analytics import peer_averages
+from export_catalog import DATASETS, FORMATS, missing_sectors, sector_groups
+from fundamentals import snapshot_store
+from loaders import shareholder_table, stored_nikkei, stored_nikkei_returns, stored_period_returns
+from market_data import canonical_tickers
+from precompute import PERIODS
+from universe import UNIVERSE_PATH, load_universe
+
+logger = logging.getLogger("export")
+
+
+# --- データセットごとのチャンク ---
+def returns_chunks(groups, period):
+    """セクターごとの騰落率（%）とピア平均（%）（Date・Sector・Ticker の縦持ち）"""
+    for sector, code, tickers in groups:
+        try:
+            returns = stored_period_returns(canonical_tickers(tickers), period, code).astype(float)
+        except Exception:
+            # 1セクターの失敗でエクスポート全体を止めない
+            logger.exception("騰落率を読み込めませんでした: %s %s", sector, period)
+            continue
+        if returns.empty:
+            continue
+        peers = peer_averages(returns)
+        chunk = pd.DataFrame({
+            "Return (%)": returns.rename_axis(index="Date", columns="Ticker").stack(),
+            "Peer Average (%)": peers.rename_axis(index="Date", columns="Ticker").stack(),
+        }).dropna(subset=["Return (%)"]).reset_index()
+        chunk.insert(1, "Sector", sector)
+        yield chunk
+
+
+def nikkei_chunks(period):
+    closes = stored_nikkei(period).astype(float)
+    if closes.empty:
+        return
+    returns = stored_nikkei_returns(period).astype(float)
+    yield pd.DataFrame({"Close": closes, "Return (%)": returns}).rename_axis("Date").reset_index()
+
+
+def fundamentals_chunks(groups):
+    """セクターごとの株主向け指標（アプリの表と同じ列）と取得日時"""
+    latest = snapshot_store.latest()
+    for sector, _, tickers in groups:
+        table = latest[latest.index.isin(tickers)]
+        if table.empty:
+            continue
+        chunk = shareholder_table(table)
+        # 全銘柄で欠損の列も型がそろうように数値にする
+        chunk = chunk.set_index("銘柄").astype(float).reset_index()
+        chunk.insert(0, "セクター", sector)
+        chunk.insert(1, "ティッカー", list(table.index))
+        chunk["取得日時"] = pd.to_datetime(table["fetchedAt"]).to_numpy()
+        yield chunk
+
+
+def dataset_chunks(dataset, period, sector=None, universe=None):
+    """データセットをチャンク（DataFrame）ごとに返すジェネレーター"""
+    if universe is None:
+        universe = load_universe()
+    if dataset == "returns":
+        return returns_chunks(sector_groups(universe, sector), period)
+    if dataset == "nikkei":
+        return nikkei_chunks(period)
+    if dataset == "fundamentals":
+        return fundamentals_chunks(sector_groups(universe, sector))
+    raise ValueError(f"不明なデータセットです: {dataset}")
+
+
+# --- 書き出し ---
+def _open_writer(sink, schema, fmt):
+    if fmt == "parquet":
+        return pq.ParquetWriter(sink, schema)
+    if fmt == "arrow":
+        return pa.ipc.new_file(sink, schema)
+    if fmt == "csv":
+        return pa_csv.CSVWriter(sink, schema)
+    raise ValueError(f"不明な形式です: {fmt}")
+
+
+def write_chunks(chunks, sink, fmt):
+    """チャンクを順に sink（パスかバイナリのファイル）へ書き出し、書き出した行数を返す
+
+    列の型は最初のチャンクに合わせる。チャンクは書き出したら保持しない。
+    """
+    writer = schema = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = _open_writer(sink, schema, fmt)
+            writer.write_table(table)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def export(dataset, period, fmt, sink, sector=None, universe=None):
+    """データセットを sink に書き出し、書き出した行数を返す"""
+    return write_chunks(dataset_chunks(dataset, period, sector, universe), sink, fmt)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="騰落率・ピア平均・日経平均・株主向け指標を一括エクスポートする")
+    parser.add_argument("dataset", choices=list(DATASETS), help="データセット")
+    parser.add_argument("--period", choices=PERIODS, default="1y", help="表示期間（yfinance形式）")
+    parser.add_argument("--sector", help="セクター名かセクターコード（省略するとユニバース全体）")
+    parser.add_argument("--universe", default=UNIVERSE_PATH, help="ユニバースファイル（CSV / JSON）")
+    parser.add_argument("--market", help="市場区分で絞り込む（例: プライム）")
+    parser.add_argument("--format", choices=list(FORMATS), default="parquet", help="出力形式")
+    parser.add_argument("--output", default="-", help="出力ファイル（- なら標準出力）")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", stream=sys.stderr)
+    universe = load_universe(args.universe, args.market)
+    sink = sys.stdout.buffer if args.output == "-" else args.output
+    try:
+        missing = missing_sectors(args.dataset, args.sector, universe)
+        rows = export(args.dataset, args.period, args.format, sink, args.sector, universe)
+    except ValueError as e:
+        logger.error(e)
+        return 1
+    if missing:
+        logger.warning("保存済みのデータがないセクターは書き出しませんでした: %s", "、".join(missing))
+    if rows == 0:
+        logger.warning("書き出すデータがありませんでした")
+        return 1
+    logger.info("%d 行を書き出しました", rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
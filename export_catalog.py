@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""エクスポートできるデータセット・形式と、保存済みのデータがないセクターの確認
+
+アプリのエクスポート欄の表示に使う部分だけを export.py から分けたもの。書き出し（pyarrow など）は
+ダウンロードのときに export.py を読み込んで行うので、アプリの起動時には読み込まない。
+"""
+from fundamentals import snapshot_store
+from market_data import price_store
+from universe import load_universe
+
+DATASETS = {
+    "returns": "銘柄ごとの騰落率とピア平均",
+    "nikkei": "日経平均の終値と騰落率",
+    "fundamentals": "株主向け指標（保存済みのスナップショット）",
+}
+
+# 形式 → (拡張子, MIMEタイプ)
+FORMATS = {
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "arrow": (".arrow", "application/vnd.apache.arrow.file"),
+    "csv": (".csv", "text/csv"),
+}
+
+
+def sector_groups(universe, sector=None):
+    """(セクター名, セクターコード, ティッカーのリスト) をセクターごとに返す（sector はセクター名かセクターコード）"""
+    if sector is not None:
+        universe = universe[(universe["sector"] == sector) | (universe["sector_code"] == sector)]
+        if universe.empty:
+            raise ValueError(f"セクターが見つかりません: {sector}")
+    for code, group in universe.groupby("sector_code", sort=False):
+        yield group["sector"].iloc[0], code, list(group["ticker"])
+
+
+def missing_sectors(dataset, sector=None, universe=None):
+    """保存済みのデータが1銘柄分もないセクター名のリスト（エクスポートでは書き出されない）"""
+    if universe is None:
+        universe = load_universe()
+    if dataset == "returns":
+        stored = set(price_store.coverage())
+    elif dataset == "fundamentals":
+        stored = set(snapshot_store.latest().index)
+    else:
+        return []
+    return [name for name, _, tickers in sector_groups(universe, sector) if stored.isdisjoint(tickers)]
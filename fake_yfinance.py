@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Yahooに接続しない yfinance の代替（ベンチマーク・動作確認用）
+
+yf.Tickers().history / yf.download / yf.Ticker（info・balance_sheet・income_stmt）を置き換える。
+株価はティッカー名から決まる乱数で生成するので、同じ条件なら毎回同じ値になる。
+interval に分足（"5m" など）を指定すると、立会時間中の分足を東京時間で返す。
+応答の遅延・例外・レート制限（429）を指定した確率で発生させられる。
+
+    with FakeYahoo(latency=0.2, rate_limit_rate=0.05).installed():
+        ...  # この中では yfinance の呼び出しがフェイクに向く
+"""
+import contextlib
+import random
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+from market_data import period_offset
+
+
+class FakeRateLimitError(Exception):
+    """yfinance のレート制限エラーの代わり（fetch_scheduler が429として扱う）"""
+
+    status_code = 429
+
+
+class FakeYahoo:
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=0, today=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.today = pd.Timestamp(today or pd.Timestamp.today()).normalize()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+    # --- 応答の遅延・失敗 ---
+    def _request(self):
+        with self._lock:
+            self.stats["requests"] += 1
+            draw = self._rng.random()
+        if self.latency:
+            time.sleep(self.latency)
+        if draw < self.rate_limit_rate:
+            with self._lock:
+                self.stats["rate_limited"] += 1
+            raise FakeRateLimitError("Too Many Requests. Rate limited. Try after a while.")
+        if draw < self.rate_limit_rate + self.error_rate:
+            with self._lock:
+                self.stats["errors"] += 1
+            raise RuntimeError("fake upstream error")
+
+    # --- 生成するデータ ---
+    @staticmethod
+    def _seed(ticker):
+        return zlib.crc32(ticker.encode("utf-8"))
+
+    def closes(self, tickers, period=None, start=None):
+        """日付×ティッカーの終値（幾何ブラウン運動、ティッカーごとに固定の乱数列）"""
+        start = pd.Timestamp(start) if start is not None else self.today - period_offset(period)
+        # 系列は固定の起点から生成して切り出すので、期間が違っても同じ日の値は一致する
+        origin = self.today - pd.DateOffset(years=25)
+        dates = pd.bdate_range(origin, self.today)
+        columns = {}
+        for t in tickers:
+            rng = np.random.default_rng(self._seed(t))
+            columns[t] = 1000 * np.exp(np.cumsum(rng.normal(0.0002, 0.015, len(dates))))
+        closes = pd.DataFrame(columns, index=dates)
+        closes.index.name = "Date"
+        return closes[closes.index >= start]
+
+    def intraday(self, tickers, day=None, interval="5m", until=None):
+        """day の立会時間中の分足の終値（前日の終値から始まる乱数列。until より後のバーは含めない）"""
+        day = pd.Timestamp(day or self.today).normalize()
+        freq = pd.Timedelta(interval.replace("m", "min"))
+        times = pd.DatetimeIndex([
+            t for start, end in (("09:00:00", "11:30:00"), ("12:30:00", "15:30:00"))
+            for t in pd.date_range(day + pd.Timedelta(start), day + pd.Timedelta(end), freq=freq, inclusive="left")
+        ], name="Date")
+        previous = self.closes(tickers, start=day - pd.Timedelta(days=10))
+        previous = previous[previous.index < day].iloc[-1]
+        columns = {}
+        for t in tickers:
+            rng = np.random.default_rng([self._seed(t), day.toordinal()])
+            columns[t] = previous[t] * np.exp(np.cumsum(rng.normal(0, 0.001, len(times))))
+        bars = pd.DataFrame(columns, index=times)
+        if until is not None:
+            bars = bars[bars.index <= pd.Timestamp(until)]
+        return bars
+
+    def history(self, tickers, period=None, start=None, interval="1d", **kwargs):
+        self._request()
+        if interval.endswith("m"):
+            # 分足は開始日から当日まで、現在時刻までのバーを東京時間で返す
+            now = pd.Timestamp.now(tz="Asia/Tokyo").tz_localize(None)
+            days = pd.bdate_range(pd.Timestamp(start), self.today)
+            closes = pd.concat([self.intraday(tickers, day, interval, until=now) for day in days])
+            closes.index = closes.index.tz_localize("Asia/Tokyo")
+        else:
+            closes = self.closes(tickers, period, start)
+        return pd.concat({"Close": closes, "Open": closes}, axis=1)
+
+    def info(self, ticker):
+        self._request()
+        rng = np.random.default_rng(self._seed(ticker))
+        return {
+            "forwardPE": float(rng.uniform(5, 40)),
+            "trailingPE": float(rng.uniform(5, 40)),
+            "priceToBook": float(rng.uniform(0.3, 5)),
+            "priceToSalesTrailing12Months": float(rng.uniform(0.2, 5)),
+            "returnOnEquity": float(rng.uniform(-0.05, 0.25)),
+            "operatingMargins": float(rng.uniform(0, 0.3)),
+            "profitMargins": float(rng.uniform(0, 0.2)),
+            "revenueGrowth": float(rng.uniform(-0.1, 0.2)),
+            "earningsGrowth": float(rng.uniform(-0.2, 0.3)),
+            "dividendYield": float(rng.uniform(0, 0.05)),
+            "payoutRatio": float(rng.uniform(0, 0.8)),
+            "debtToEquity": float(rng.uniform(0, 200)),
+            "currentRatio": float(rng.uniform(0.5, 3)),
+            "marketCap": float(rng.uniform(1e10, 5e13)),
+            "freeCashflow": float(rng.normal(1e10, 3e10)),
+        }
+
+    def balance_sheet(self, ticker):
+        self._request()
+        rng = np.random.default_rng(self._seed(ticker))
+        return pd.DataFrame(
+            {self.today - pd.DateOffset(years=1): [rng.uniform(2e11, 8e11), 1e12]},
+            index=["Stockholders Equity", "Total Assets"],
+        )
+
+    def income_stmt(self, ticker):
+        self._request()
+        rng = np.random.default_rng(self._seed(ticker))
+        years = [self.today - pd.DateOffset(years=i) for i in range(1, 5)]
+        return pd.DataFrame([rng.uniform(1e10, 5e10, len(years))], index=["Operating Income"], columns=years)
+
+    # --- yfinance への差し込み ---
+    @contextlib.contextmanager
+    def installed(self):
+        """with ブロックの間だけ yfinance の Tickers / download / Ticker をフェイクに置き換える"""
+        fake = self
+
+        class Tickers:
+            def __init__(self, tickers):
+                self.tickers = tickers.split() if isinstance(tickers, str) else list(tickers)
+
+            def history(self, period=None, start=None, interval="1d", **kwargs):
+                return fake.history(self.tickers, period, start, interval)
+
+        class Ticker:
+            def __init__(self, ticker):
+                self.ticker = ticker
+
+            info = property(lambda self: fake.info(self.ticker))
+            balance_sheet = property(lambda self: fake.balance_sheet(self.ticker))
+            income_stmt = property(lambda self: fake.income_stmt(self.ticker))
+
+        def download(tickers, period=None, start=None, interval="1d", **kwargs):
+            tickers = tickers.split() if isinstance(tickers, str) else list(tickers)
+            return fake.history(tickers, period, start, interval)
+
+        saved = yf.Tickers, yf.download, yf.Ticker
+        yf.Tickers, yf.download, yf.Ticker = Tickers, download, Ticker
+        try:
+            yield self
+        finally:
+            yf.Tickers, yf.download, yf.Ticker = saved
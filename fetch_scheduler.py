@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Yahooへのリクエストを一元管理するスケジューラ
+
+トークンバケットで流量を制限し、レート制限（429）時はジッター付き指数バックオフで再試行する。
+同じキーのリクエストが実行中なら結果を共有し、制限中は直近の取得結果があればそれを返す
+（max_stale_age 秒より古い取得結果は返さない）。
+時計・sleep・乱数は差し替え可能なので、429を返すローカルのフェイクに対して動作を確認できる。
+"""
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class RateLimitedError(RuntimeError):
+    """レート制限が解除されず、返せる取得済みデータもない場合に送出"""
+
+
+def is_rate_limit_error(exc, error_types=()):
+    """例外がレート制限（HTTP 429）によるものか判定する"""
+    if error_types and isinstance(exc, error_types):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status == 429 or "Too Many Requests" in str(exc)
+
+
+def _yfinance_rate_limit_errors():
+    # yfinance は取得時に読み込むので、まだ読み込まれていなければその例外が送出されることもない
+    yf = sys.modules.get("yfinance")
+    error = getattr(getattr(yf, "exceptions", None), "YFRateLimitError", None)
+    return (error,) if error is not None else ()
+
+
+class TokenBucket:
+    """毎秒 rate 個のトークンを capacity まで貯め、1リクエストごとに1個消費する"""
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら新たに実行せず、その完了を待って結果を共有する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class FetchScheduler:
+    def __init__(
+        self,
+        rate=4.0,
+        burst=8,
+        max_retries=3,
+        base_delay=1.0,
+        max_delay=30.0,
+        cooldown=60.0,
+        max_stale=256,
+        max_stale_age=6 * 3600.0,
+        rate_limit_errors=(),
+        clock=time.monotonic,
+        sleep=time.sleep,
+        rng=None,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cooldown = cooldown
+        self.max_stale = max_stale
+        self.max_stale_age = max_stale_age
+        self.rate_limit_errors = tuple(rate_limit_errors)
+        self._clock = clock
+        self._sleep = sleep
+        self._rng = rng or random.Random()
+        self._bucket = TokenBucket(rate, burst, clock, sleep)
+        self._flight = SingleFlight()
+        self._stale = OrderedDict()
+        self._lock = threading.Lock()
+        self._limited_until = 0.0
+        self.stats = {"requests": 0, "rate_limited": 0, "retries": 0, "stale_served": 0}
+
+    def set_rate(self, rate, burst=None):
+        """流量制限（毎秒のリクエスト数とバースト数）を変更する"""
+        self._bucket = TokenBucket(rate, burst or self._bucket.capacity, self._clock, self._sleep)
+
+    @property
+    def limited(self):
+        """直近にレート制限を受け、クールダウン中かどうか"""
+        return self._clock() < self._limited_until
+
+    def call(self, key, fn, *args, keep_stale=True, **kwargs):
+        """fn(*args, **kwargs) を流量制限・再試行付きで実行する
+
+        key が同じ呼び出しが実行中ならその結果を共有する。
+        keep_stale=True の場合は成功した結果を保持し、制限中の呼び出しにはそれを返す。
+        """
+        return self._flight.do(key, lambda: self._call(key, fn, args, kwargs, keep_stale))
+
+    def _call(self, key, fn, args, kwargs, keep_stale):
+        if self.limited:
+            stale = self._get_stale(key)
+            if stale is not _MISSING:
+                self._count("stale_served")
+                return stale
+
+        for attempt in range(self.max_retries + 1):
+            self._bucket.acquire()
+            self._count("requests")
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e, self.rate_limit_errors + _yfinance_rate_limit_errors()):
+                    raise
+                self._count("rate_limited")
+                self._limited_until = self._clock() + self.cooldown
+                stale = self._get_stale(key)
+                if stale is not _MISSING:
+                    self._count("stale_served")
+                    return stale
+                if attempt == self.max_retries:
+                    raise RateLimitedError(f"YFinanceのレート制限が解除されません: {key}") from e
+                self._count("retries")
+                self._sleep(self._backoff(attempt))
+                continue
+
+            self._limited_until = 0.0
+            if keep_stale:
+                self._put_stale(key, result)
+            return result
+
+    def _backoff(self, attempt):
+        # Full Jitter: 0 〜 min(上限, 基準 × 2^attempt) の一様乱数
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _get_stale(self, key):
+        with self._lock:
+            entry = self._stale.get(key)
+            if entry is None:
+                return _MISSING
+            stored, result = entry
+            if self._clock() - stored > self.max_stale_age:
+                del self._stale[key]
+                return _MISSING
+            return result
+
+    def _put_stale(self, key, result):
+        with self._lock:
+            self._stale[key] = (self._clock(), result)
+            self._stale.move_to_end(key)
+            while len(self._stale) > self.max_stale:
+                self._stale.popitem(last=False)
+
+
+# アプリ全体（全セッション）で共有するスケジューラ
+scheduler = FetchScheduler()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""財務データ（Ticker.info と決算書）の取得と日次スナップショットの保存"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from data_cache import FUNDAMENTALS_POLICY, cached
+from fetch_scheduler import RateLimitedError, scheduler
+from instrumentation import stage
+from market_data import STORE_DIR, atomic_write, file_lock
+
+# 財務データ取得の同時実行数の上限
+FUNDAMENTALS_MAX_WORKERS = 8
+
+# Ticker.info から取り出す項目
+INFO_FIELDS = [
+    "forwardPE",
+    "trailingPE",
+    "priceToBook",
+    "priceToSalesTrailing12Months",
+    "returnOnEquity",
+    "operatingMargins",
+    "profitMargins",
+    "revenueGrowth",
+    "earningsGrowth",
+    "dividendYield",
+    "payoutRatio",
+    "debtToEquity",
+    "currentRatio",
+    "marketCap",
+    "freeCashflow",
+]
+
+# 決算書から計算する項目
+STATEMENT_FIELDS = ["equityRatio", "operatingIncomeGrowthYears"]
+
+# スナップショットの列（statements は決算書の項目も取得したかどうか）
+SNAPSHOT_COLUMNS = ["date"] + INFO_FIELDS + STATEMENT_FIELDS + ["statements", "fetchedAt"]
+
+
+def fetch_info(ticker):
+    """1銘柄分の財務データを取得し、(info, エラーメッセージ) を返す"""
+    import yfinance as yf
+
+    try:
+        with stage("yahoo.info"):
+            # 前回の値はスナップショットに残るので、スケジューラ側では保持しない
+            # （制限中に古い値を当日のスナップショットとして記録しないため）
+            info = scheduler.call(("info", ticker), lambda: yf.Ticker(ticker).info, keep_stale=False)
+    except RateLimitedError:
+        return None, f"{ticker} の財務データはYFinanceの制限により取得できませんでした"
+    except Exception as e:
+        return None, f"{ticker} の財務データ取得中に例外が発生しました: {e}"
+    if not info:
+        return None, f"{ticker} の財務データが空です（データなし）"
+    return info, None
+
+
+def fetch_statements(ticker):
+    """貸借対照表と損益計算書から自己資本比率と営業利益の連続増益年数を求め、(値, エラーメッセージ) を返す
+
+    決算書に該当の行がない項目は値に含めない。決算書そのものを取得できなかった場合はエラーを返す。
+    """
+    import yfinance as yf
+
+    ticker_obj = yf.Ticker(ticker)
+    try:
+        balance_sheet = scheduler.call(("balance_sheet", ticker), lambda: ticker_obj.balance_sheet, keep_stale=False)
+        income_stmt = scheduler.call(("income_stmt", ticker), lambda: ticker_obj.income_stmt, keep_stale=False)
+    except RateLimitedError:
+        return {}, f"{ticker} の決算書はYFinanceの制限により取得できませんでした"
+    except Exception as e:
+        return {}, f"{ticker} の決算書取得中に例外が発生しました: {e}"
+
+    values = {}
+    try:
+        latest = balance_sheet.iloc[:, 0]
+        values["equityRatio"] = latest["Stockholders Equity"] / latest["Total Assets"]
+    except (AttributeError, IndexError, KeyError):
+        pass
+    try:
+        # 古い年度から新しい年度の順に並べ、直近から何年続けて増益しているかを数える
+        operating_income = income_stmt.loc["Operating Income"].dropna().sort_index()
+        growth_years = 0
+        for diff in operating_income.diff().dropna().iloc[::-1]:
+            if diff <= 0:
+                break
+            growth_years += 1
+        values["operatingIncomeGrowthYears"] = growth_years
+    except (AttributeError, KeyError):
+        pass
+    return values, None
+
+
+def fetch_fundamentals(ticker, with_statements=False):
+    """1銘柄分の行と、エラーメッセージを返す
+
+    決算書だけを取得できなかった場合は財務データの行とエラーの両方を返す
+    （行の statements は False のままなので、次回に決算書を取り直す）。
+    """
+    info, error = fetch_info(ticker)
+    if error:
+        return None, error
+    row = {field: info.get(field) for field in INFO_FIELDS}
+    row["statements"] = False
+    if with_statements:
+        values, error = fetch_statements(ticker)
+        row.update(values)
+        row["statements"] = error is None
+    return row, error
+
+
+class SnapshotStore:
+    """財務データのスナップショット（追記のみ、銘柄ごとに1日1行）
+
+    snapshots/日付.parquet にその日の全銘柄分、latest.parquet に銘柄ごとの最新行、
+    changes/日付.parquet に前回のスナップショットから値が変わった項目を記録する。
+    追記は append.lock でプロセス間でも排他する（アプリと precompute.py の同時追記）。
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    def _day_path(self, kind, day):
+        return self.root / kind / f"{day.strftime('%Y-%m-%d')}.parquet"
+
+    @property
+    def _latest_path(self):
+        return self.root / "latest.parquet"
+
+    def latest(self):
+        """銘柄ごとの最新のスナップショット（ticker をインデックスとする表）"""
+        if not self._latest_path.exists():
+            return pd.DataFrame(columns=SNAPSHOT_COLUMNS).rename_axis("ticker")
+        return pd.read_parquet(self._latest_path)
+
+    def history(self, tickers, field, day=None):
+        """指定項目の日付×ティッカーの推移
+
+        前日までのスナップショットは書き換わらないのでキャッシュし、当日分だけを読み直す。
+        """
+        day = (pd.Timestamp.now() if day is None else day).normalize()
+        tickers = tuple(tickers)
+        frames = [_past_history(self.root, tickers, field, day)]
+        path = self._day_path("snapshots", day)
+        if path.exists():
+            frames.append(_read_history(path, tickers, field))
+        frames = [f for f in frames if not f.empty]
+        if not frames:
+            return pd.DataFrame()
+        data = pd.concat(frames, ignore_index=True)
+        return data.pivot(index="date", columns="ticker", values=field).sort_index()
+
+    def changes(self, day):
+        """指定日に記録された変化（ticker / field / old / new）"""
+        path = self._day_path("changes", day)
+        if not path.exists():
+            return pd.DataFrame(columns=["ticker", "field", "old", "new"])
+        return pd.read_parquet(path)
+
+    def append(self, table, fetched_at):
+        """取得した財務データをその日のスナップショットとして追記し、前回からの変化を返す"""
+        table = table.assign(date=fetched_at.normalize(), fetchedAt=fetched_at)[SNAPSHOT_COLUMNS]
+        for kind in ("snapshots", "changes"):
+            (self.root / kind).mkdir(parents=True, exist_ok=True)
+        # precompute.py など別のプロセスも同じストアに追記するので、プロセス間でも排他する
+        with self._lock, file_lock(self.root / "append.lock"):
+            latest = self.latest()
+            previous = latest.reindex(table.index.intersection(latest.index))
+            changes = _diff(previous, table)
+            table = _carry_statements(previous, table)
+
+            _merge_rows(self._day_path("snapshots", fetched_at), table)
+            _merge_rows(self._latest_path, table)
+            if not changes.empty:
+                path = self._day_path("changes", fetched_at)
+                if path.exists():
+                    changes = pd.concat([pd.read_parquet(path), changes], ignore_index=True)
+                atomic_write(changes, path)
+        return changes
+
+
+def _read_history(path, tickers, field):
+    data = pd.read_parquet(path, columns=["date", field]).reset_index()
+    return data[data["ticker"].isin(tickers)]
+
+
+@cached(FUNDAMENTALS_POLICY)
+def _past_history(root, tickers, field, day):
+    """day より前のスナップショットから指定項目を集める（縦持ち）"""
+    paths = [p for p in sorted((root / "snapshots").glob("*.parquet")) if pd.Timestamp(p.stem) < day]
+    frames = [_read_history(p, tickers, field) for p in paths]
+    if not frames:
+        return pd.DataFrame(columns=["ticker", "date", field])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _diff(old, new):
+    fields = INFO_FIELDS + STATEMENT_FIELDS
+    with_statements = new.loc[old.index, "statements"].fillna(False).astype(bool)
+    old = old[fields].astype(float)
+    new = new.loc[old.index, fields].astype(float)
+    # 両方NaNは変化なし、片方だけNaNは変化ありとみなす
+    changed = (old != new) & ~(old.isna() & new.isna())
+    # 決算書を取得しなかった行は、決算書の項目を比べない
+    changed.loc[~with_statements, STATEMENT_FIELDS] = False
+    changed = changed.stack()
+    changed = changed[changed].index
+    return pd.DataFrame({
+        "ticker": changed.get_level_values(0),
+        "field": changed.get_level_values(1),
+        "old": [old.at[t, f] for t, f in changed],
+        "new": [new.at[t, f] for t, f in changed],
+    })
+
+
+def _carry_statements(previous, table):
+    # 決算書を取得しなかった行は、前回までの決算書の項目と取得済みフラグを引き継ぐ
+    plain = previous.index[~table.loc[previous.index, "statements"].fillna(False).astype(bool)]
+    if plain.empty:
+        return table
+    table = table.copy()
+    columns = STATEMENT_FIELDS + ["statements"]
+    table.loc[plain, columns] = previous.loc[plain, columns].to_numpy()
+    table["statements"] = table["statements"].fillna(False).astype(bool)
+    return table
+
+
+def _merge_rows(path, rows):
+    # 同じ銘柄の行は置き換え、それ以外の行は残す
+    if path.exists():
+        existing = pd.read_parquet(path)
+        rows = pd.concat([existing[~existing.index.isin(rows.index)], rows])
+    atomic_write(rows, path)
+
+
+snapshot_store = SnapshotStore(STORE_DIR / "fundamentals")
+
+
+def fetched_all(result):
+    """(表, エラーのリスト, ...) の戻り値にエラーがないか（エラーを含む結果はキャッシュせず、次回に取り直す）"""
+    return not result[1]
+
+
+@cached(FUNDAMENTALS_POLICY, keep=fetched_all)
+def load_fundamentals(tickers, with_statements=False, max_workers=FUNDAMENTALS_MAX_WORKERS):
+    """ティッカー×指標の財務データ表と、銘柄ごとのエラーメッセージのリストを返す
+
+    当日のスナップショットがある銘柄はストアから読み、ない銘柄だけをスレッドプールで並列に取得して
+    スナップショットに追記する。取得に失敗した銘柄は過去のスナップショットがあればそれを使い、
+    なければ表に含めない（いずれもエラーとして返す）。表には取得日時（fetchedAt）の列も付く。
+    with_statements=True の場合は決算書から計算する項目（STATEMENT_FIELDS）も取得する。
+    決算書だけを取得できなかった銘柄は財務データを追記してエラーを返し、次回に決算書を取り直す。
+    """
+    tickers = list(tickers)
+    now = pd.Timestamp.now()
+
+    # 当日のスナップショットがある銘柄はローカルから読み、それ以外だけを取得する
+    latest = snapshot_store.latest().reindex(tickers).dropna(subset=["fetchedAt"])
+    fresh = latest["date"] == now.normalize()
+    if with_statements:
+        fresh &= latest["statements"].astype(bool)
+    stale = [t for t in tickers if t not in latest.index[fresh]]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stale) or 1))) as executor:
+        results = list(executor.map(lambda t: fetch_fundamentals(t, with_statements), stale))
+
+    rows = {}
+    errors = []
+    for t, (row, error) in zip(stale, results):
+        if error:
+            errors.append(error)
+        if row is not None:
+            rows[t] = row
+
+    if rows:
+        fields = INFO_FIELDS + STATEMENT_FIELDS
+        fetched = pd.DataFrame.from_dict(rows, orient="index", columns=fields + ["statements"])
+        fetched[fields] = fetched[fields].apply(pd.to_numeric, errors="coerce")
+        fetched["statements"] = fetched["statements"].astype(bool)
+        fetched.index.name = "ticker"
+        snapshot_store.append(fetched, now)
+        latest = snapshot_store.latest().reindex(tickers).dropna(subset=["fetchedAt"])
+
+    # 取得に失敗した銘柄も、過去のスナップショットがあればそれを使う
+    columns = INFO_FIELDS + (STATEMENT_FIELDS if with_statements else []) + ["fetchedAt"]
+    table = latest[columns].copy()
+    table.index.name = "ticker"
+    return table, errors
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""ユニバース全銘柄の株価履歴をローカルストアに取り込むバッチ
+
+    python ingest.py --period 20y --batch-size 50 --workers 2 --rate 2
+
+ユニバースをバッチに分けて並列に取得し、完了したバッチをチェックポイントに記録する。
+途中で止まった場合は同じ引数で再実行すると未完了のバッチから再開する。
+定期実行する場合は、アプリ側を STOCK_TAIL_REFRESH=0 で起動すると閲覧時にYahooへ問い合わせなくなる。
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+
+from fetch_scheduler import RateLimitedError, scheduler
+from market_data import DOWNLOAD_CHUNK_SIZE, price_store, update_store
+from universe import UNIVERSE_PATH, load_universe
+
+logger = logging.getLogger("ingest")
+
+
+class Checkpoint:
+    """完了した銘柄を記録するファイル（ユニバース・期間・実行日が変わると使わない）"""
+
+    def __init__(self, path, run):
+        self.path = path
+        self.run = run
+        self.done = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if saved.get("run") == self.run:
+            self.done = set(saved["done"])
+
+    def mark(self, tickers):
+        with self._lock:
+            self.done.update(tickers)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"run": self.run, "done": sorted(self.done)}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+
+def ingest(universe_path, period, batch_size=DOWNLOAD_CHUNK_SIZE, workers=2, market=None,
+           restart=False, store=price_store):
+    """ユニバースの全銘柄（と日経平均）をストアに取り込み、失敗したバッチ数を返す"""
+    tickers = list(load_universe(universe_path, market)["ticker"]) + ["^N225"]
+
+    run = {"universe": str(universe_path), "market": market, "period": period,
+           "date": datetime.date.today().isoformat()}
+    checkpoint = Checkpoint(store.root.parent / "ingest_checkpoint.json", run)
+    if not restart:
+        checkpoint.load()
+
+    pending = [t for t in tickers if t not in checkpoint.done]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    logger.info("%d銘柄中%d銘柄を%dバッチで取得します", len(tickers), len(pending), len(batches))
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            # 取り込みでは末尾の差分も必ず取り直す
+            executor.submit(update_store, batch, period, store, datetime.timedelta(0), True): batch
+            for batch in batches
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            batch = futures[future]
+            try:
+                future.result()
+            except CancelledError:
+                # レート制限で取り消した未着手のバッチ（チェックポイントに残らないので再実行で取得する）
+                continue
+            except RateLimitedError:
+                failed += 1
+                logger.warning("レート制限のため中断します（再実行すると続きから再開します）")
+                for f in futures:
+                    f.cancel()
+                continue
+            except Exception:
+                failed += 1
+                logger.exception("バッチの取得に失敗しました: %s ... %s", batch[0], batch[-1])
+                continue
+            checkpoint.mark(batch)
+            logger.info("[%d/%d] %s ... %s", done, len(batches), batch[0], batch[-1])
+
+    if failed == 0:
+        checkpoint.clear()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ユニバース全銘柄の株価履歴をローカルストアに取り込む")
+    parser.add_argument("--universe", default=UNIVERSE_PATH, help="ユニバースファイル（CSV / JSON）")
+    parser.add_argument("--market", help="市場区分で絞り込む（例: プライム）")
+    parser.add_argument("--period", default="20y", help="取得期間（yfinance形式）")
+    parser.add_argument("--batch-size", type=int, default=DOWNLOAD_CHUNK_SIZE, help="1リクエストあたりの銘柄数")
+    parser.add_argument("--workers", type=int, default=2, help="同時に実行するバッチ数")
+    parser.add_argument("--rate", type=float, default=2.0, help="毎秒のリクエスト数の上限")
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から取得する")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    scheduler.set_rate(args.rate, burst=max(1, args.workers))
+    failed = ingest(args.universe, args.period, args.batch_size, args.workers, args.market, args.restart)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""処理段階ごとの計測（所要時間・処理行数・キャッシュのヒット/ミス・データ量）
+
+    with stage("comparison.melt") as timing:
+        data = comparison_long_data(...)
+        timing.observe(data)
+
+計測結果はプロセス全体で段階ごとに集計し（p50 / p95 を含む）、Prometheus のテキスト形式で出力できる
+（環境変数 STOCK_METRICS_FILE を指定すると export_metrics() でそのファイルに書き出す。
+node_exporter の textfile collector などで収集する想定）。
+各段階の記録はロガー "stock.perf" に JSON の1行として出力するので、ロギングの設定で構造化ログとして集められる。
+実行中のスクリプトごとの記録は current_run() で取り出せる（並列実行のフラグメントの記録も含む）。
+最初の意味のある表示までの時間は record_first_paint() で記録し、プロセスで最初の実行（コールドスタート）と
+それ以降を別の段階として集計する。
+"""
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from data_cache import estimate_size, thread_cache_counts
+
+logger = logging.getLogger("stock.perf")
+
+# 段階ごとに保持する所要時間のサンプル数（パーセンタイルの計算に使う）
+MAX_SAMPLES = 512
+
+# Prometheus 形式の書き出し先（未指定なら書き出さない）
+METRICS_FILE = os.environ.get("STOCK_METRICS_FILE")
+
+# 実行中のスクリプトの記録。並列実行のフラグメントはコンテキストを引き継ぐので同じ記録に追加される
+_run = contextvars.ContextVar("stock_perf_run", default=None)
+_cold = contextvars.ContextVar("stock_perf_cold", default=False)
+_run_count = itertools.count()
+
+
+class StageRecord:
+    __slots__ = ("name", "seconds", "rows", "bytes", "cache_hits", "cache_misses")
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.rows = None
+        self.bytes = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def observe(self, value, rows=None):
+        """処理したデータの行数とおおよそのバイト数を記録する（DataFrame・Series・dict・list）"""
+        if rows is None:
+            if isinstance(value, dict):
+                rows = sum(len(v) for v in value.values() if hasattr(v, "__len__"))
+            elif hasattr(value, "__len__"):
+                rows = len(value)
+        self.rows = (self.rows or 0) + (rows or 0)
+        self.bytes = (self.bytes or 0) + estimate_size(value)
+        return value
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _Totals:
+    def __init__(self):
+        self.samples = deque(maxlen=MAX_SAMPLES)
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+class StageRecorder:
+    """段階ごとの計測結果をプロセス全体で集計する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def add(self, record):
+        with self._lock:
+            totals = self._totals.setdefault(record.name, _Totals())
+            totals.samples.append(record.seconds)
+            totals.count += 1
+            totals.seconds += record.seconds
+            totals.rows += record.rows or 0
+            totals.bytes += record.bytes or 0
+            totals.cache_hits += record.cache_hits
+            totals.cache_misses += record.cache_misses
+
+    def summary(self):
+        """段階ごとの件数・p50 / p95（秒）・合計"""
+        with self._lock:
+            items = [(name, t, np.array(t.samples)) for name, t in self._totals.items()]
+        return [{
+            "stage": name,
+            "count": t.count,
+            "p50": float(np.percentile(samples, 50)),
+            "p95": float(np.percentile(samples, 95)),
+            "seconds": t.seconds,
+            "rows": t.rows,
+            "bytes": t.bytes,
+            "cache_hits": t.cache_hits,
+            "cache_misses": t.cache_misses,
+        } for name, t, samples in sorted(items, key=lambda item: item[0])]
+
+    def prometheus(self):
+        """Prometheus のテキスト形式（summary と counter）"""
+        lines = [
+            "# HELP stock_stage_seconds Wall time of each pipeline stage.",
+            "# TYPE stock_stage_seconds summary",
+        ]
+        summary = self.summary()
+        for s in summary:
+            label = f'stage="{_escape(s["stage"])}"'
+            lines += [
+                f'stock_stage_seconds{{{label},quantile="0.5"}} {s["p50"]:.6f}',
+                f'stock_stage_seconds{{{label},quantile="0.95"}} {s["p95"]:.6f}',
+                f"stock_stage_seconds_sum{{{label}}} {s['seconds']:.6f}",
+                f"stock_stage_seconds_count{{{label}}} {s['count']}",
+            ]
+        for metric, key, help_text in (
+            ("stock_stage_rows_total", "rows", "Rows processed by each stage."),
+            ("stock_stage_bytes_total", "bytes", "Approximate payload bytes handled by each stage."),
+            ("stock_stage_cache_hits_total", "cache_hits", "Cache hits inside each stage."),
+            ("stock_stage_cache_misses_total", "cache_misses", "Cache misses inside each stage."),
+        ):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{_escape(s["stage"])}"}} {s[key]}' for s in summary]
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+recorder = StageRecorder()
+
+
+@contextmanager
+def stage(name):
+    """with ブロックの所要時間と、その間のキャッシュのヒット/ミス（同じスレッド内）を記録する"""
+    record = StageRecord(name)
+    hits, misses = thread_cache_counts()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        end_hits, end_misses = thread_cache_counts()
+        record.cache_hits = end_hits - hits
+        record.cache_misses = end_misses - misses
+        _finish(record)
+
+
+def record_elapsed(name, since):
+    """since（time.perf_counter() の値）からの経過時間を段階 name として記録する"""
+    record = StageRecord(name)
+    record.seconds = time.perf_counter() - since
+    _finish(record)
+    return record
+
+
+def record_first_paint(since):
+    """実行の開始から最初の意味のある表示（選択欄と最初のチャート）までの時間を記録する
+
+    プロセスで最初の実行はモジュールの読み込みを含むので startup.first_paint.cold として分ける。
+    """
+    return record_elapsed(f"startup.first_paint.{'cold' if _cold.get() else 'warm'}", since)
+
+
+def _finish(record):
+    recorder.add(record)
+    run = _run.get()
+    if run is not None:
+        run.append(record)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(record.as_dict(), ensure_ascii=False))
+
+
+def export_metrics(path=METRICS_FILE):
+    """集計結果を Prometheus のテキスト形式でファイルに書き出す（path が None なら何もしない）"""
+    if not path:
+        return
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(recorder.prometheus())
+    os.replace(tmp, path)
+
+
+def begin_run():
+    """以降に記録する段階を、新しい実行の記録として集め始める（プロセスで最初の実行はコールドスタート）"""
+    _run.set([])
+    _cold.set(next(_run_count) == 0)
+
+
+def current_run():
+    """begin_run() 以降に記録した段階"""
+    return list(_run.get() or [])
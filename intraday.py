@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""場中モード: 分足を一定間隔で取得し、読み込み済みの終値に新しいバーだけを追記する
+
+    feed = IntradayFeed(closes, default_source(), benchmark="^N225")
+    delta = feed.poll()  # 前回から変わった末尾の行（終値・騰落率・ピア平均）
+
+騰落率とピア平均は追記した行だけを計算する（騰落率の基準は読み込み済みの期間の初日）。
+取得元は poll(tickers, since) で since 以降のバーを返すオブジェクトで差し替えられる。
+環境変数 STOCK_INTRADAY_REPLAY に記録済みのティック（Parquet / CSV）を指定すると、
+Yahooの代わりにそれを1回の取得ごとに少しずつ流す（動作確認用）。
+"""
+import datetime
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import pandas as pd
+
+from analytics import peer_averages
+from fetch_scheduler import scheduler
+from instrumentation import stage
+
+# 取得間隔（秒）と分足の間隔（yfinance形式）
+INTRADAY_INTERVAL = float(os.environ.get("STOCK_INTRADAY_INTERVAL", "60"))
+BAR_INTERVAL = os.environ.get("STOCK_INTRADAY_BAR", "5m")
+
+# 記録済みのティックを流す場合のファイルと、1回の取得で進める本数
+REPLAY_PATH = os.environ.get("STOCK_INTRADAY_REPLAY")
+REPLAY_STEP = int(os.environ.get("STOCK_INTRADAY_REPLAY_STEP", "1"))
+
+# 東証の立会時間（前場・後場、祝日は考慮しない）
+MARKET_TZ = "Asia/Tokyo"
+MARKET_SESSIONS = (
+    (datetime.time(9, 0), datetime.time(11, 30)),
+    (datetime.time(12, 30), datetime.time(15, 30)),
+)
+
+
+def market_now():
+    """東京時間の現在時刻（タイムゾーンなし）"""
+    return pd.Timestamp.now(tz=MARKET_TZ).tz_localize(None)
+
+
+def is_market_open(now=None):
+    now = market_now() if now is None else now
+    if now.weekday() >= 5:
+        return False
+    return any(start <= now.time() < end for start, end in MARKET_SESSIONS)
+
+
+# --- 取得元 ---
+class YahooQuoteSource:
+    """Yahooの分足の終値"""
+
+    def __init__(self, interval=BAR_INTERVAL):
+        self.interval = interval
+
+    def is_open(self):
+        return is_market_open()
+
+    def poll(self, tickers, since):
+        import yfinance as yf
+
+        tickers = list(tickers)
+        key = ("intraday", tuple(tickers), self.interval, str(since))
+        with stage("yahoo.intraday") as timing:
+            data = scheduler.call(
+                key,
+                lambda: yf.Tickers(tickers).history(start=since.date(), interval=self.interval),
+                keep_stale=False,
+            )
+            if data is not None:
+                timing.observe(data)
+        if data is None or data.empty:
+            return pd.DataFrame(columns=tickers, dtype=float)
+        if isinstance(data.columns, pd.MultiIndex):
+            closes = data["Close"]
+        else:
+            closes = data[["Close"]].set_axis(tickers[:1], axis=1)
+        if closes.index.tz is not None:
+            closes.index = closes.index.tz_convert(MARKET_TZ).tz_localize(None)
+        closes.index.name = "Date"
+        return closes[closes.index >= since]
+
+
+class ReplaySource:
+    """記録済みのティックを1回の poll ごとに step 本ずつ流す
+
+    ticks は日時×ティッカーの終値か、Date・Ticker・Close 列の縦持ちの表。
+    """
+
+    def __init__(self, ticks, step=REPLAY_STEP):
+        if {"Date", "Ticker", "Close"} <= set(ticks.columns):
+            ticks = ticks.pivot(index="Date", columns="Ticker", values="Close")
+        self.ticks = ticks.sort_index()
+        self.step = step
+        self.position = 0
+
+    @classmethod
+    def from_file(cls, path, step=REPLAY_STEP):
+        path = Path(path)
+        if path.suffix == ".csv":
+            return cls(pd.read_csv(path, parse_dates=["Date"]), step)
+        return cls(pd.read_parquet(path), step)
+
+    def is_open(self):
+        return self.position < len(self.ticks)
+
+    def poll(self, tickers, since):
+        self.position = min(self.position + self.step, len(self.ticks))
+        released = self.ticks.iloc[:self.position]
+        return released.loc[released.index >= since, [t for t in tickers if t in released.columns]]
+
+
+def write_ticks(ticks, path):
+    """日時×ティッカーの終値を ReplaySource で読める縦持ちの表として保存する"""
+    path = Path(path)
+    long = ticks.rename_axis(index="Date", columns="Ticker").stack().rename("Close").reset_index()
+    if path.suffix == ".csv":
+        long.to_csv(path, index=False)
+    else:
+        long.to_parquet(path, index=False)
+
+
+def default_source():
+    if REPLAY_PATH:
+        return ReplaySource.from_file(REPLAY_PATH)
+    return YahooQuoteSource()
+
+
+# --- 差分更新 ---
+@dataclass(frozen=True)
+class IntradayDelta:
+    """1回の取得で変わった末尾の行（start の行は更新、それより後は追加）"""
+
+    start: pd.Timestamp             # 変わった最初の行の日時（変化がなければ None）
+    closes: pd.DataFrame            # start 以降の終値
+    returns: pd.DataFrame           # start 以降の騰落率（%）
+    peer_averages: pd.DataFrame     # start 以降のピア平均（%）
+
+    @property
+    def empty(self):
+        return self.start is None
+
+
+class IntradayFeed:
+    """読み込み済みの終値に場中のバーを追記し、騰落率とピア平均を追記した行だけ計算する
+
+    当日分の日足（途中値）は分足で取り直すので除く。欠損は直前の値で埋める。
+    benchmark（日経平均）の列は騰落率だけを計算し、ピア平均には含めない。
+    """
+
+    def __init__(self, closes, source, benchmark=None, now=None):
+        today = (market_now() if now is None else now).normalize()
+        self.closes = closes[closes.index < today]
+        self.tickers = list(closes.columns)
+        self.peers = [t for t in self.tickers if t != benchmark]
+        self.source = source
+        self.base = self.closes.bfill().iloc[0] if len(self.closes) else None
+        self.returns = self._returns(self.closes)
+        self.peer_averages = peer_averages(self.returns[self.peers])
+        self.since = today
+        self.bars = 0
+
+    def _returns(self, closes):
+        if self.base is None:
+            return closes.iloc[:0]
+        return (closes / self.base - 1) * 100
+
+    def poll(self):
+        bars = self.source.poll(self.tickers, self.since)
+        bars = bars.reindex(columns=self.tickers)
+        bars = bars[bars.index >= self.since].dropna(how="all").sort_index()
+        if bars.empty:
+            empty = self.closes.iloc[:0]
+            return IntradayDelta(None, empty, self.returns.iloc[:0], self.peer_averages.iloc[:0])
+
+        # 最後のバーは途中値なので、取り直した行以降を置き換える
+        start = bars.index[0]
+        kept = self.closes.index < start
+        previous = self.closes[kept].iloc[-1:]
+        closes = pd.concat([previous, bars]).ffill().iloc[len(previous):]
+        if self.base is None:
+            self.base = closes.bfill().iloc[0]
+        returns = self._returns(closes)
+        peers = peer_averages(returns[self.peers])
+
+        self.bars += len(closes) - (~kept).sum()
+        self.closes = pd.concat([self.closes[kept], closes])
+        self.returns = pd.concat([self.returns[kept], returns])
+        self.peer_averages = pd.concat([self.peer_averages[kept], peers])
+        self.since = closes.index[-1]
+        return IntradayDelta(start, closes, returns, peers)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""株価・騰落率・財務データのローダー
+
+Streamlit に依存しないので、アプリ（app.py）と事前計算バッチ（precompute.py）の両方から使う。
+事前計算済みの騰落率があればそれを返し、なければ株価から計算する。
+"""
+import datetime
+import json
+import os
+import shutil
+import uuid
+
+import pandas as pd
+
+from analytics import risk_metrics
+from data_cache import FUNDAMENTALS_POLICY, PRICE_POLICY, cached
+from fundamentals import fetched_all, load_fundamentals
+from market_data import STORE_DIR, canonical_tickers, history_period, load_closes, price_store, slice_period
+from universe import load_universe
+
+# 事前計算結果を使う期限（環境変数 STOCK_PRECOMPUTED_MAX_AGE で時間単位で変更可能）
+PRECOMPUTED_MAX_AGE = datetime.timedelta(hours=float(os.environ.get("STOCK_PRECOMPUTED_MAX_AGE", "24")))
+
+
+class PrecomputedStore:
+    """期間×セクターごとの騰落率（%）を保存する（版/returns/期間/セクターコード.parquet）
+
+    事前計算は1回ごとに新しい版のディレクトリに書き、全て書き終えたら manifest.json を差し替えて
+    その版に切り替える。途中で失敗した版は使われない（読み出し中の古い版は1つ前まで残す）。
+    manifest.json の generated が PRECOMPUTED_MAX_AGE より古い場合は使わない。
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, version, period, key):
+        return self.root / version / "returns" / period / f"{key}.parquet"
+
+    @property
+    def _manifest_path(self):
+        return self.root / "manifest.json"
+
+    def manifest(self):
+        try:
+            with open(self._manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def generated(self):
+        """事前計算の完了日時（使える結果がなければ None）"""
+        manifest = self.manifest()
+        generated = manifest.get("generated")
+        if generated is None or "version" not in manifest:
+            return None
+        generated = pd.Timestamp(generated)
+        if pd.Timestamp.now() - generated > PRECOMPUTED_MAX_AGE:
+            return None
+        return generated
+
+    def read(self, tickers, period, key):
+        """保存済みの騰落率から tickers の列を返す（揃わない場合は None）"""
+        if self.generated() is None:
+            return None
+        try:
+            # 読んでいる間に次の版へ切り替わり、古い版が消されていることもある
+            returns = pd.read_parquet(self._path(self.manifest()["version"], period, key))
+        except (FileNotFoundError, KeyError):
+            return None
+        if not set(tickers) <= set(returns.columns):
+            return None
+        return returns[list(tickers)]
+
+    def begin(self):
+        """新しい版を作り、その名前を返す（commit するまで read からは見えない）"""
+        version = f"v{pd.Timestamp.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+        (self.root / version).mkdir(parents=True)
+        return version
+
+    def write(self, version, period, key, returns):
+        path = self._path(version, period, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        returns.to_parquet(path)
+
+    def commit(self, version, generated, periods):
+        """manifest.json を差し替えて version に切り替え、2つ前より古い版を消す"""
+        previous = self.manifest().get("version")
+        tmp = self._manifest_path.with_name(f"manifest.{version}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": version, "generated": generated.isoformat(), "periods": list(periods)},
+                f, ensure_ascii=False,
+            )
+        os.replace(tmp, self._manifest_path)
+        for path in self.root.iterdir():
+            if path.is_dir() and path.name not in (version, previous):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def discard(self, version):
+        """書きかけの版を消す"""
+        shutil.rmtree(self.root / version, ignore_errors=True)
+
+
+precomputed_store = PrecomputedStore(STORE_DIR / "precomputed")
+
+# 日経平均の保存キー
+NIKKEI_KEY = "N225"
+
+
+def returns_from(data):
+    """期間の初日（期間の途中で上場した銘柄はその銘柄の最初の終値）を基準にした騰落率（%）"""
+    return (data / data.bfill().iloc[0] - 1) * 100
+
+
+def sector_key(tickers):
+    """銘柄が全て同じセクターなら、事前計算結果の保存キー（セクターコード）を返す"""
+    universe = load_universe()
+    codes = set(universe.loc[universe["ticker"].isin(tickers), "sector_code"])
+    if len(codes) != 1 or universe["ticker"].isin(tickers).sum() != len(set(tickers)):
+        return None
+    return codes.pop()
+
+
+# --- 株価 ---
+@cached(PRICE_POLICY)
+def load_history(tickers, period):
+    # ローカルストアを優先し、不足分だけYahooから取得
+    # 欠損はストア側で前の値で埋めてあり、共有の株価行列のビューのまま返す
+    data = load_closes(tickers, period)
+    if data.empty:
+        raise RuntimeError("YFinance returned no data.")
+    return data.dropna(how="all", axis=1)
+
+
+@cached(PRICE_POLICY)
+def load_period_data(tickers, period):
+    # 取得は期間を包含する履歴1回にまとめ、表示期間はメモリ上で切り出す
+    data = load_history(tickers, history_period(period))
+    return slice_period(data, period).dropna(how="all", axis=1)
+
+
+def load_data(tickers, period):
+    # キャッシュキーは銘柄の並び順に依存させず、列は選択順に並べ直す
+    data = load_period_data(canonical_tickers(tickers), period)
+    columns = [t for t in tickers if t in data.columns]
+    # 並び順が同じなら株価行列のビューのまま返す
+    return data if columns == list(data.columns) else data[columns]
+
+
+@cached(PRICE_POLICY)
+def load_nikkei_history(period):
+    return load_closes(["^N225"], period)["^N225"]
+
+
+@cached(PRICE_POLICY)
+def load_nikkei(period):
+    return slice_period(load_nikkei_history(history_period(period)), period)
+
+
+# --- 騰落率（事前計算済みの結果を優先） ---
+@cached(PRICE_POLICY)
+def load_period_returns(tickers, period):
+    key = sector_key(tickers)
+    returns = precomputed_store.read(tickers, period, key) if key is not None else None
+    if returns is None:
+        returns = returns_from(load_period_data(tickers, period))
+    return returns
+
+
+def load_returns(tickers, period):
+    """銘柄ごとの騰落率（%）。列は選択順に並べる"""
+    returns = load_period_returns(canonical_tickers(tickers), period)
+    return returns[[t for t in tickers if t in returns.columns]]
+
+
+@cached(PRICE_POLICY)
+def load_nikkei_returns(period):
+    returns = precomputed_store.read([NIKKEI_KEY], period, NIKKEI_KEY)
+    if returns is None:
+        return returns_from(load_nikkei(period))
+    return returns[NIKKEI_KEY].rename("^N225")
+
+
+# --- 保存済みのデータだけを使う読み込み（Yahooには問い合わせない。エクスポート用） ---
+def stored_period_returns(tickers, period, key=None):
+    """事前計算済みの結果か、ストアの株価から計算した騰落率（%）。どちらにもない銘柄は含めない"""
+    returns = precomputed_store.read(tickers, period, key) if key is not None else None
+    if returns is None:
+        closes = slice_period(price_store.read(tickers), period).dropna(how="all", axis=1)
+        returns = returns_from(closes) if not closes.empty else closes
+    return returns
+
+
+def stored_nikkei(period):
+    """ストアにある日経平均の終値（なければ空のSeries）"""
+    closes = price_store.read(["^N225"])
+    if "^N225" not in closes.columns:
+        return pd.Series(dtype=float, name="^N225")
+    return slice_period(closes["^N225"], period)
+
+
+def stored_nikkei_returns(period):
+    returns = precomputed_store.read([NIKKEI_KEY], period, NIKKEI_KEY)
+    if returns is None:
+        closes = stored_nikkei(period)
+        return returns_from(closes) if not closes.empty else closes
+    return returns[NIKKEI_KEY].rename("^N225")
+
+
+# --- リスク指標（銘柄の組×表示期間ごとに全窓をまとめて計算） ---
+@cached(PRICE_POLICY)
+def load_risk_metrics(tickers, period):
+    history = history_period(period)
+    return risk_metrics(load_history(tickers, history), load_nikkei_history(history), period)
+
+
+# --- 財務データ ---
+@cached(FUNDAMENTALS_POLICY, keep=fetched_all)
+def load_shareholder_metrics(tickers):
+    """株主向け指標の表示用の表・銘柄ごとのエラーメッセージ・データ取得日時を返す"""
+    # 銘柄ごとの取得は並列化され、エラーは銘柄単位で集めて呼び出し側で表示する
+    table, errors = load_fundamentals(tickers)
+    df = shareholder_table(table)
+
+    # 保存済みスナップショットの取得日時（最も古いもの）
+    fetched_at = table["fetchedAt"].min() if not table.empty else None
+
+    return df, errors, fetched_at
+
+
+def shareholder_table(table):
+    """財務データ（ティッカーをインデックスとする表）から株主向け指標の表示用の表を作る"""
+    names = load_universe().set_index("ticker")
+    names = names["code"] + " " + names["name"]
+
+    data = []
+
+    for t in table.index:
+        info = table.loc[t].dropna().to_dict()
+
+        market_cap_trillion = info.get("marketCap", 0) / 1e12 if info.get("marketCap") else None
+
+        # 配当利回り（%）は、yfinanceの戻り値（比率）に100を掛けてパーセント表示に修正
+        dividend_yield_percent = info.get("dividendYield", 0) * 100 if info.get("dividendYield") else None
+
+        data.append({
+            "銘柄": names.get(t, t),
+            "PER（予想）": info.get("forwardPE"),
+            "PBR": info.get("priceToBook"),
+            "PSR": info.get("priceToSalesTrailing12Months"),
+            "ROE（%）": info.get("returnOnEquity", 0) * 100 if info.get("returnOnEquity") else None,
+            "営業利益率（%）": info.get("operatingMargins", 0) * 100 if info.get("operatingMargins") else None,
+            "純利益率（%）": info.get("profitMargins", 0) * 100 if info.get("profitMargins") else None,
+            "売上成長率（%）": info.get("revenueGrowth", 0) * 100 if info.get("revenueGrowth") else None,
+            "利益成長率（%）": info.get("earningsGrowth", 0) * 100 if info.get("earningsGrowth") else None,
+
+            "配当利回り（%）": dividend_yield_percent, # 修正後の値を使用
+
+            "配当性向（%）": info.get("payoutRatio", 0) * 100 if info.get("payoutRatio") else None,
+            "負債比率（D/E）": info.get("debtToEquity"),
+            "流動比率": info.get("currentRatio"),
+            "時価総額（兆円）": market_cap_trillion,
+        })
+
+    return pd.DataFrame(data)
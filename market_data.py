@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""株価履歴の取得とローカル保存（Parquet）"""
+import contextlib
+import datetime
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from fetch_scheduler import RateLimitedError, SingleFlight, scheduler
+from instrumentation import stage
+from universe import load_universe
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間のロックをかけない
+    fcntl = None
+
+# 保存先ディレクトリ（環境変数 STOCK_STORE_DIR で変更可能）
+STORE_DIR = Path(os.environ.get("STOCK_STORE_DIR", Path(__file__).resolve().parent / "store"))
+
+# 履歴データの取得期間（表示期間はこのいずれかから切り出す）
+HISTORY_PERIODS = ["5y", "20y"]
+
+# 一度のリクエストで取得する銘柄数
+DOWNLOAD_CHUNK_SIZE = 50
+
+# 保存済み銘柄の末尾を再取得する間隔（場中の当日バーを更新するため）
+TAIL_REFRESH_INTERVAL = datetime.timedelta(minutes=15)
+
+# 読み込み時に末尾の差分を取得するか（ingest.py で定期的に更新する運用では 0 にする）
+TAIL_REFRESH_ON_READ = os.environ.get("STOCK_TAIL_REFRESH", "1") != "0"
+
+# ストア全銘柄の終値をまとめた float32 行列の使い方（環境変数 STOCK_PRICE_MATRIX で変更可能）
+#   "mmap": ファイルをメモリマップして複数プロセスで共有 / "memory": プロセス内に読み込む / "off": 使わない
+PRICE_MATRIX_MODE = os.environ.get("STOCK_PRICE_MATRIX", "mmap")
+
+
+# --- 期間文字列の変換 ---
+def period_offset(period):
+    """yfinance形式の期間（"5d", "1mo", "3y" など）をDateOffsetに変換"""
+    n = int(period.rstrip("dmoy"))
+    if period.endswith("mo"):
+        return pd.DateOffset(months=n)
+    if period.endswith("y"):
+        return pd.DateOffset(years=n)
+    return pd.DateOffset(days=n)
+
+
+def history_period(period):
+    """指定期間を包含する最小の取得期間を返す"""
+    ref = pd.Timestamp("2000-01-01")
+    for p in HISTORY_PERIODS:
+        if ref - period_offset(p) <= ref - period_offset(period):
+            return p
+    return period
+
+
+def slice_period(data, period):
+    """取得済みの履歴から直近の期間分を切り出す（"5d" などの日数指定は営業日数として扱う）"""
+    if data.empty:
+        return data
+    if period.endswith("d"):
+        return data.iloc[-int(period[:-1]):]
+    start = data.index[-1] - period_offset(period)
+    # 行の範囲指定で切り出し、元データのビューのまま返す
+    return data.iloc[data.index.searchsorted(start):]
+
+
+# --- Yahooからの取得 ---
+def download_closes(tickers, period=None, start=None):
+    """終値を日付×ティッカーのDataFrameで取得する（periodかstartのどちらかを指定）"""
+    tickers = list(tickers)
+    # yfinance は読み込みが重いので、実際に取得するときに読み込む（起動を速くする）
+    import yfinance as yf
+
+    kwargs = {"start": start} if start is not None else {"period": period}
+    key = ("history", tuple(tickers), period, None if start is None else str(start))
+    # 価格はストアが直近値を保持するので、スケジューラ側では保持しない
+    with stage("yahoo.history") as timing:
+        data = scheduler.call(key, lambda: yf.Tickers(tickers).history(**kwargs), keep_stale=False)
+        if data is not None:
+            timing.observe(data)
+    if data is None:
+        raise RuntimeError("YFinance returned no data.")
+    # 複数カラムがある場合は"Close"を選択、1銘柄の場合は列名をティッカーにする
+    if isinstance(data.columns, pd.MultiIndex):
+        data = data["Close"]
+    else:
+        data = data[["Close"]].set_axis(tickers[:1], axis=1)
+    if data.index.tz is not None:
+        data.index = data.index.tz_localize(None)
+    data.index = data.index.normalize()
+    data.index.name = "Date"
+    return data.dropna(how="all", axis=1)
+
+
+# --- ローカルストア ---
+class PriceStore:
+    """ティッカーごとの終値を1ファイルずつParquetで保持するストア
+
+    coverage.json には銘柄ごとの保存範囲（要求した開始日・最終バー・最終更新時刻・最終確認時刻）を記録する。
+    coverage.json の読み書きは coverage.lock でプロセス間でも排他する（ingest.py とアプリの同時更新）。
+    """
+
+    def __init__(self, root, matrix_mode=PRICE_MATRIX_MODE):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+        self.matrix = PriceMatrix(self, mmap=matrix_mode == "mmap") if matrix_mode != "off" else None
+
+    def _path(self, ticker):
+        return self.root / f"{ticker.replace('^', '_')}.parquet"
+
+    @property
+    def _manifest_path(self):
+        return self.root / "coverage.json"
+
+    def coverage(self):
+        try:
+            with open(self._manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def read(self, tickers, start=None):
+        """終値を日付×ティッカーで返す
+
+        欠損は前の値で埋めるが、各銘柄の最後のバーより後は埋めない（行列を使う場合は float32 のビュー）。
+        """
+        if self.matrix is not None:
+            return self.matrix.read(tickers, start)
+        series = {}
+        for t in tickers:
+            path = self._path(t)
+            if not path.exists():
+                continue
+            s = pd.read_parquet(path)["Close"]
+            if start is not None:
+                s = s[s.index >= start]
+            series[t] = s
+        if not series:
+            return pd.DataFrame()
+        data = pd.concat(series, axis=1).sort_index()
+        data.index.name = "Date"
+        return _fill_within(data, data.isna().to_numpy())
+
+    def read_all(self, tickers):
+        """保存済みの終値をティッカーごとのSeriesで返す"""
+        series = {}
+        for t in tickers:
+            path = self._path(t)
+            if path.exists():
+                series[t] = pd.read_parquet(path)["Close"]
+        return series
+
+    def write(self, closes, checked, covered_from=None):
+        """取得した終値を既存データにマージして保存し、保存範囲を更新する"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock, file_lock(self.root / "coverage.lock"):
+            coverage = self.coverage()
+            for t in closes.columns:
+                new = closes[t].dropna()
+                if new.empty:
+                    continue
+                path = self._path(t)
+                old = pd.read_parquet(path)["Close"] if path.exists() else None
+                if old is not None:
+                    # 重複する日付は新しく取得した値で上書き
+                    new = pd.concat([old[~old.index.isin(new.index)], new]).sort_index()
+
+                entry = coverage.get(t, {})
+                # 値が変わったときだけ書き直す（updated は行列の作り直しの判定に使う）
+                if old is None or not new.equals(old):
+                    atomic_write(new.rename("Close").to_frame(), path)
+                    entry["updated"] = checked.isoformat()
+                if covered_from is not None:
+                    entry["start"] = covered_from.strftime("%Y-%m-%d")
+                entry["end"] = new.index[-1].strftime("%Y-%m-%d")
+                entry["checked"] = checked.isoformat()
+                coverage[t] = entry
+            _atomic_write_json(coverage, self._manifest_path, indent=1)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """ロックファイルに flock をかけ、同じストアを更新する他のプロセスと排他する"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _temp_path(path):
+    # 同じファイルを書く他のプロセス・スレッドと一時ファイルが重ならないようにする
+    return path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+
+
+def atomic_write(frame, path):
+    """一時ファイルに書いてから置き換え、読み手に書きかけの Parquet を見せない"""
+    tmp = _temp_path(path)
+    try:
+        frame.to_parquet(tmp)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _atomic_write_json(data, path, **kwargs):
+    tmp = _temp_path(path)
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, **kwargs)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _ranges(coverage):
+    # 行列の作り直しの判定に使う保存範囲（最終確認時刻だけの変化では作り直さない）
+    return {t: {k: e.get(k) for k in ("start", "end", "updated")} for t, e in coverage.items()}
+
+
+class PriceMatrix:
+    """ストア全銘柄の終値を1つの日付×ティッカーの float32 行列として共有する
+
+    列はユニバースのセクター順（セクター内はティッカー順）に並べるので、セクター内の銘柄の組は
+    連続した列になり、読み出しは行列のビュー（コピーなし）で済む。
+    行列には銘柄にバーがない日を NaN のまま持ち、読み出した銘柄のバーの間の欠損だけを読み出し時に
+    前の値で埋める（ストアから直接読んだ場合と同じ結果になり、他の銘柄の更新に左右されない）。
+    行列は matrix-<版>.npy とそれを指す matrix.json としてストアに保存し、mmap=True ならメモリマップして使う
+    （同じストアを読む全プロセスでページキャッシュを共有する）。版ごとに別のファイルに書くので、
+    作り直している間も他のプロセスは古い版を読める。
+    ストアが更新されると、保存範囲（coverage.json）が変わった銘柄の列と増えた日付の行だけを差し替えた
+    行列をすぐに使い、新しい版のファイルはバックグラウンドで書く。
+    """
+
+    def __init__(self, store, mmap=True):
+        self.store = store
+        self.mmap = mmap
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._coverage = None
+        self._dates = pd.DatetimeIndex([], name="Date")
+        self._columns = {}
+        self._values = np.empty((0, 0), dtype=np.float32)
+
+    @property
+    def _meta_path(self):
+        return self.store.root / "matrix.json"
+
+    @property
+    def nbytes(self):
+        return self._values.nbytes
+
+    def read(self, tickers, start=None):
+        dates, columns, values = self._current()
+        names = [t for t in tickers if t in columns]
+        positions = [columns[t] for t in names]
+        first = dates.searchsorted(start) if start is not None else 0
+        if positions and positions == list(range(positions[0], positions[0] + len(positions))):
+            block = values[first:, positions[0]:positions[0] + len(positions)]
+        else:
+            block = values[first:][:, positions]
+        data = pd.DataFrame(block, index=dates[first:], columns=names, copy=False)
+        missing = np.isnan(block)
+        # 読み出した銘柄のどれにもバーがない日の行は除く（ない場合はビューのまま）
+        empty = missing.all(axis=1) if names else np.ones(len(block), dtype=bool)
+        if empty.any():
+            data = data[~empty]
+            missing = missing[~empty]
+        return _fill_within(data, missing)
+
+    def flush(self):
+        """バックグラウンドで書いている版のファイルを書き終えるまで待つ"""
+        writer = self._writer
+        if writer is not None:
+            writer.join()
+
+    def _current(self):
+        coverage = _ranges(self.store.coverage())
+        with self._lock:
+            if coverage != self._coverage:
+                self._refresh(coverage)
+            return self._dates, self._columns, self._values
+
+    def _refresh(self, coverage):
+        # 他のプロセスが作った最新の行列があればそれを使う。古い版でも、手元に行列がなければ差し替えの元にする
+        meta = self._load_meta()
+        if meta is not None and (meta["coverage"] == coverage or self._coverage is None):
+            values = self._load_values(meta)
+            if values is not None:
+                self._set(meta, values)
+                if meta["coverage"] == coverage:
+                    return
+
+        meta, values = self._patched(coverage)
+        self._set(meta, values)
+        self._writer = threading.Thread(target=self._save, args=(meta, values), name="price-matrix-writer")
+        self._writer.start()
+
+    def _patched(self, coverage):
+        # 保存範囲が変わっていない銘柄は現在の行列から取り、変わった銘柄だけストアから読んで列を差し替える
+        base = self._coverage or {}
+        kept = [t for t in self._columns if base.get(t) == coverage.get(t) and t in coverage]
+        series = self.store.read_all([t for t in coverage if t not in kept])
+        tickers = _matrix_order(kept + list(series))
+
+        dates = pd.DatetimeIndex(
+            np.concatenate([self._dates.to_numpy()] + [s.index.to_numpy() for s in series.values()])
+        ).unique().sort_values()
+        columns = {t: i for i, t in enumerate(tickers)}
+        values = np.full((len(dates), len(tickers)), np.nan, dtype=np.float32)
+        if kept:
+            rows = dates.get_indexer(self._dates)
+            values[np.ix_(rows, [columns[t] for t in kept])] = self._values[:, [self._columns[t] for t in kept]]
+        for t, s in series.items():
+            values[dates.get_indexer(s.index), columns[t]] = s.to_numpy(dtype=np.float32)
+
+        # どの銘柄にもバーがなくなった日の行は除く
+        keep = ~np.isnan(values).all(axis=1)
+        if not keep.all():
+            values, dates = values[keep], dates[keep]
+        meta = {
+            "values": f"matrix-{uuid.uuid4().hex}.npy",
+            "shape": list(values.shape),
+            "dates": [d.strftime("%Y-%m-%d") for d in dates],
+            "tickers": tickers,
+            "coverage": coverage,
+        }
+        return meta, values
+
+    def _save(self, meta, values):
+        with self._write_lock:
+            # 書き始める前に次の版に差し替わっていれば、この版は書かない
+            if self._coverage is not meta["coverage"]:
+                return
+            self.store.root.mkdir(parents=True, exist_ok=True)
+            npy_path = self.store.root / meta["values"]
+            # 新しい版のファイルを書き終えてから matrix.json を差し替える
+            with open(npy_path, "wb") as f:
+                np.save(f, values)
+            _atomic_write_json(meta, self._meta_path)
+            self._remove_old_versions(npy_path)
+            if self.mmap:
+                loaded = np.load(npy_path, mmap_mode="r")
+                with self._lock:
+                    if self._coverage is meta["coverage"]:
+                        self._values = loaded
+
+    def _load_meta(self):
+        try:
+            with open(self._meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return meta if "values" in meta else None
+
+    def _load_values(self, meta):
+        # 参照先の版が消されていたり、形が matrix.json と合わなければ作り直す
+        try:
+            values = np.load(self.store.root / meta["values"], mmap_mode="r" if self.mmap else None)
+        except (FileNotFoundError, ValueError):
+            return None
+        if list(values.shape) != meta["shape"]:
+            return None
+        return values
+
+    def _remove_old_versions(self, current):
+        # メモリマップ中のファイルも削除できる（Windows では使用中なら残し、次回に消す）
+        for path in self.store.root.glob("matrix-*.npy"):
+            if path != current:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def _set(self, meta, values):
+        self._coverage = meta["coverage"]
+        self._dates = pd.DatetimeIndex(meta["dates"], name="Date")
+        self._columns = {t: i for i, t in enumerate(meta["tickers"])}
+        self._values = values
+
+
+def _fill_within(data, missing):
+    """銘柄ごとに最初と最後のバーの間の欠損を前の値で埋める（欠損がなければそのまま返す）
+
+    最後のバーより後は埋めないので、上場廃止や未更新の銘柄に平らな値を作らない。
+    """
+    if not missing.any():
+        return data
+    valid = ~missing
+    after_first = np.logical_or.accumulate(valid, axis=0)
+    before_last = np.logical_or.accumulate(valid[::-1], axis=0)[::-1]
+    if not (missing & after_first & before_last).any():
+        return data
+    return data.ffill().where(before_last)
+
+
+def _matrix_order(tickers):
+    # ユニバースのセクターコード順・ティッカー順（ユニバース外の銘柄は最後）
+    try:
+        universe = load_universe()
+        sector_code = dict(zip(universe["ticker"], universe["sector_code"]))
+    except (OSError, KeyError, ValueError):
+        sector_code = {}
+    return sorted(tickers, key=lambda t: (t not in sector_code, sector_code.get(t, ""), t))
+
+
+price_store = PriceStore(STORE_DIR / "prices")
+
+
+# セッションをまたいで同じ取得処理を1回にまとめる
+_flight = SingleFlight()
+
+
+def canonical_tickers(tickers):
+    """順序や重複に依存しないキャッシュキー用のティッカー列"""
+    return tuple(sorted(set(tickers)))
+
+
+def load_closes(tickers, period, store=price_store):
+    """ストアを優先して終値を読み込む
+
+    未保存の銘柄や保存範囲が足りない銘柄は期間全体を取得し、
+    保存済みの銘柄は最終バー以降の差分だけを取得して追記する。
+    同じ銘柄集合・期間の読み込みが実行中なら、その結果を待って共有する。
+    """
+    key = (canonical_tickers(tickers), period, str(store.root))
+    data = _flight.do(key, lambda: _load_closes(key[0], period, store))
+    return data[[t for t in tickers if t in data.columns]]
+
+
+def _load_closes(tickers, period, store):
+    tail_interval = TAIL_REFRESH_INTERVAL if TAIL_REFRESH_ON_READ else None
+    start = update_store(tickers, period, store, tail_interval=tail_interval)
+    return store.read(tickers, start)
+
+
+def update_store(tickers, period, store=price_store, tail_interval=TAIL_REFRESH_INTERVAL, strict=False):
+    """ストアに期間分の終値をそろえ、読み出しに使う開始日を返す
+
+    未保存の銘柄や保存範囲が足りない銘柄は期間全体を取得し、最終確認から tail_interval 以上
+    経った銘柄は最終バー以降の差分だけを取得して追記する（None なら差分は取得しない）。
+    strict=False の場合、差分取得がレート制限に当たっても保存済みのデータで続行する。
+    """
+    now = pd.Timestamp.now()
+    start = now.normalize() - period_offset(period)
+    coverage = store.coverage()
+
+    full, tail = [], []
+    for t in tickers:
+        entry = coverage.get(t)
+        if entry is None or "start" not in entry or pd.Timestamp(entry["start"]) > start:
+            full.append(t)
+        elif tail_interval is not None and now - pd.Timestamp(entry["checked"]) >= tail_interval:
+            tail.append(t)
+
+    # 銘柄数が多い場合は DOWNLOAD_CHUNK_SIZE ずつ取得し、取得できた分から保存する
+    for chunk in _chunks(full):
+        store.write(download_closes(chunk, period=period), checked=now, covered_from=start)
+    for chunk in _chunks(tail):
+        # 最終バー当日から取り直し、場中の途中値も更新する
+        since = min(pd.Timestamp(coverage[t]["end"]) for t in chunk)
+        try:
+            store.write(download_closes(chunk, start=since), checked=now)
+        except RateLimitedError:
+            if strict:
+                raise
+            # 制限中は保存済みのデータをそのまま使う
+            break
+
+    return start
+
+
+def _chunks(tickers, size=DOWNLOAD_CHUNK_SIZE):
+    return [tickers[i:i + size] for i in range(0, len(tickers), size)]
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""全セクター×全表示期間の騰落率を事前計算してストアに書き込むバッチ
+
+    python precompute.py --rate 2
+
+東証の大引け後などに定期実行すると、アプリは事前計算済みの騰落率と財務データのスナップショットを
+読むだけになり、その日最初の閲覧者がダウンロードを待たずに済む。
+株価の取り込みは ingest.py と同じ処理で行い、騰落率は取り込み済みのストアの株価だけから計算する
+（--skip-ingest の場合も含めて、騰落率の計算中にYahooへは問い合わせない）。
+結果は新しい版に書き、全て成功したときだけ切り替える。
+アプリ側は STOCK_TAIL_REFRESH=0 で起動すると閲覧時にYahooへ問い合わせなくなる。
+"""
+import argparse
+import logging
+import sys
+
+import pandas as pd
+
+from fetch_scheduler import scheduler
+from fundamentals import load_fundamentals
+from ingest import ingest
+from loaders import NIKKEI_KEY, precomputed_store, returns_from, stored_nikkei, stored_period_returns
+from market_data import DOWNLOAD_CHUNK_SIZE, HISTORY_PERIODS
+from universe import UNIVERSE_PATH, load_universe
+
+logger = logging.getLogger("precompute")
+
+# 事前計算する期間（app.py の period_map と同じ）
+PERIODS = ["5d", "1mo", "3mo", "6mo", "1y", "3y", "5y", "10y", "20y"]
+
+
+def precompute(universe_path=UNIVERSE_PATH, periods=PERIODS, market=None, store=precomputed_store):
+    """セクターごと・期間ごとの騰落率と日経平均の騰落率を新しい版に書き込み、失敗した件数を返す
+
+    1件も失敗しなかったときだけ新しい版に切り替える（失敗した場合は前回の結果を使い続ける）。
+    """
+    universe = load_universe(universe_path, market)
+    version = store.begin()
+    failed = 0
+    for period in periods:
+        try:
+            closes = stored_nikkei(period)
+            if closes.empty:
+                raise ValueError("ストアに日経平均の株価がありません")
+            store.write(version, period, NIKKEI_KEY, returns_from(closes).to_frame(NIKKEI_KEY))
+        except Exception:
+            failed += 1
+            logger.exception("日経平均の騰落率を計算できませんでした: %s", period)
+
+        for sector_code, group in universe.groupby("sector_code", sort=False):
+            try:
+                # 事前計算済みの結果（前回の版）は使わず、ストアの株価から計算する
+                returns = stored_period_returns(list(group["ticker"]), period)
+                if returns.empty:
+                    raise ValueError("ストアに株価がありません")
+                store.write(version, period, sector_code, returns)
+            except Exception:
+                failed += 1
+                logger.exception("騰落率を計算できませんでした: %s %s", group["sector"].iloc[0], period)
+        logger.info("%s の騰落率を書き込みました", period)
+
+    # 財務データは当日のスナップショットとして保存される（決算書の項目も含めて取得する）
+    _, errors = load_fundamentals(tuple(universe["ticker"]), with_statements=True)
+    for error in errors:
+        logger.warning(error)
+
+    if failed == 0:
+        store.commit(version, pd.Timestamp.now(), periods)
+    else:
+        store.discard(version)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="全セクター×全表示期間の騰落率を事前計算してストアに書き込む")
+    parser.add_argument("--universe", default=UNIVERSE_PATH, help="ユニバースファイル（CSV / JSON）")
+    parser.add_argument("--market", help="市場区分で絞り込む（例: プライム）")
+    parser.add_argument("--batch-size", type=int, default=DOWNLOAD_CHUNK_SIZE, help="1リクエストあたりの銘柄数")
+    parser.add_argument("--workers", type=int, default=2, help="株価取り込みで同時に実行するバッチ数")
+    parser.add_argument("--rate", type=float, default=2.0, help="毎秒のリクエスト数の上限")
+    parser.add_argument("--skip-ingest", action="store_true", help="株価の取り込みを省略し、ストアの株価だけで計算する")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    scheduler.set_rate(args.rate, burst=max(1, args.workers))
+    if not args.skip_ingest:
+        # 最長の表示期間（20年）を含む履歴を取り込んでおく
+        if ingest(args.universe, HISTORY_PERIODS[-1], args.batch_size, args.workers, args.market):
+            return 1
+    failed = precompute(args.universe, market=args.market)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""「優良な割安株を見つけるチェックリスト」（README.md）によるスクリーニング
+
+財務データ表（fundamentals.load_fundamentals の戻り値）の列に対して、条件ごとの真偽マスクを
+まとめて計算する。値が取れない銘柄はその条件を満たさないものとして扱う。
+"""
+from dataclasses import dataclass
+
+import pandas as pd
+
+
+@dataclass(frozen=True)
+class ScreeningThresholds:
+    max_per: float = 15.0               # PER（予想、なければ実績）の上限
+    per_below_sector_median: bool = True  # 同業他社（セクター中央値）より低いことも求める
+    max_pbr: float = 1.0                # PBRの上限（未満）
+    min_roe: float = 8.0                # ROE（%）の下限
+    max_debt_to_equity: float = 100.0   # D/Eレシオ（%）の上限（未満）
+    min_equity_ratio: float = 40.0      # 自己資本比率（%）の下限
+    min_growth_years: int = 3           # 営業利益の連続増益年数の下限
+
+
+# 条件名（表示用）
+CRITERIA = ["低PER", "低PBR", "高ROE", "低D/E", "FCFプラス", "高自己資本比率", "持続的増益"]
+
+
+def screening_masks(fundamentals, thresholds=ScreeningThresholds(), sectors=None):
+    """銘柄×条件の真偽表を返す（sectors はティッカー→セクター名のSeries）"""
+    f = fundamentals
+    per = f["forwardPE"].where(f["forwardPE"] > 0, f["trailingPE"])
+    low_per = (per > 0) & (per <= thresholds.max_per)
+    if thresholds.per_below_sector_median and sectors is not None:
+        sector = sectors.reindex(f.index)
+        sector_median = per.where(per > 0).groupby(sector).transform("median")
+        low_per &= per < sector_median
+
+    columns = ["equityRatio", "operatingIncomeGrowthYears"]
+    equity_ratio, growth_years = (f[c] if c in f else pd.Series(float("nan"), index=f.index) for c in columns)
+
+    return pd.DataFrame({
+        "低PER": low_per,
+        "低PBR": (f["priceToBook"] > 0) & (f["priceToBook"] < thresholds.max_pbr),
+        "高ROE": f["returnOnEquity"] * 100 >= thresholds.min_roe,
+        "低D/E": (f["debtToEquity"] >= 0) & (f["debtToEquity"] < thresholds.max_debt_to_equity),
+        "FCFプラス": f["freeCashflow"] > 0,
+        "高自己資本比率": equity_ratio * 100 >= thresholds.min_equity_ratio,
+        "持続的増益": growth_years >= thresholds.min_growth_years,
+    }, index=f.index)[CRITERIA]
+
+
+def screen(fundamentals, thresholds=ScreeningThresholds(), sectors=None):
+    """条件ごとの判定と満たした条件数（スコア）を付け、スコアの高い順（同点はPBRの低い順）に並べる"""
+    masks = screening_masks(fundamentals, thresholds, sectors)
+    result = fundamentals.join(masks)
+    result["スコア"] = masks.sum(axis=1)
+    return result.sort_values(["スコア", "priceToBook"], ascending=[False, True], na_position="last")
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import sys
+from pathlib import Path
+
+# リポジトリ直下のモジュール（fetch_scheduler など）を読み込めるようにする
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
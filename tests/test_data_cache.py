@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""DataCache の期限・古い値を返しながらの取り直し・取り直し失敗時の待ち（時計は差し替える）"""
+import contextvars
+import threading
+import time
+
+import pytest
+
+import data_cache
+from data_cache import CachePolicy, DataCache, refresh_status, track_stale
+
+POLICY = CachePolicy("テスト", ttl=60, max_entries=8, max_bytes=1024**2, stale_ttl=600)
+
+
+class FakeClock:
+    """進めた分だけ進む時計"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Upstream:
+    """呼び出し回数を返すフェイク（release がセットされるまで待ち、fail が真なら失敗する）"""
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self):
+        self.release.wait(5)
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("fake upstream error")
+        return self.calls
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def cache(clock):
+    return DataCache(POLICY, clock=clock)
+
+
+def wait_refreshed(cache, key):
+    """バックグラウンドの取り直しが終わるまで待つ"""
+    deadline = time.monotonic() + 5
+    while key in cache.refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert key not in cache.refreshing
+
+
+def test_fresh_value_is_a_hit(cache, clock):
+    upstream = Upstream()
+    assert cache.get_or_compute("key", upstream) == 1
+
+    clock.now += 59
+    assert cache.get_or_compute("key", upstream) == 1
+    assert upstream.calls == 1
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 1
+    assert cache.state("key") == "fresh"
+
+
+def test_stale_value_is_served_and_refreshed_once(cache, clock):
+    upstream = Upstream()
+    cache.get_or_compute("key", upstream)
+
+    # 期限切れ後は古い値を返し、取り直しは何度アクセスしても1回だけ
+    clock.now += 61
+    upstream.release.clear()
+    assert [cache.get_or_compute("key", upstream) for _ in range(3)] == [1, 1, 1]
+    assert cache.state("key") == "refreshing"
+    assert cache.stats["stale_hits"] == 3
+    upstream.release.set()
+    wait_refreshed(cache, "key")
+
+    assert upstream.calls == 2
+    assert cache.stats["revalidations"] == 1
+    assert cache.generation == 1
+    assert cache.get_or_compute("key", upstream) == 2
+    assert cache.state("key") == "fresh"
+
+
+def test_value_past_stale_ttl_is_computed_again(cache, clock):
+    upstream = Upstream()
+    cache.get_or_compute("key", upstream)
+
+    clock.now += 60 + 601
+    assert cache.get_or_compute("key", upstream) == 2
+    assert cache.stats["expirations"] == 1
+    assert cache.stats["stale_hits"] == 0
+
+
+def test_failed_refresh_waits_before_retrying(cache, clock):
+    upstream = Upstream()
+    cache.get_or_compute("key", upstream)
+
+    clock.now += 61
+    upstream.fail = True
+    assert cache.get_or_compute("key", upstream) == 1
+    wait_refreshed(cache, "key")
+    assert cache.stats["revalidation_errors"] == 1
+    entry = cache._entries["key"]
+    assert entry.retry_at == clock.now + data_cache.REVALIDATE_RETRY_DELAY
+
+    # 待ち時間の間は古い値を返すだけで取り直さない
+    upstream.fail = False
+    clock.now += data_cache.REVALIDATE_RETRY_DELAY - 1
+    assert cache.get_or_compute("key", upstream) == 1
+    assert not cache.refreshing
+    assert upstream.calls == 2
+
+    clock.now += 1
+    cache.get_or_compute("key", upstream)
+    wait_refreshed(cache, "key")
+    assert upstream.calls == 3
+    assert cache.get_or_compute("key", upstream) == 3
+
+
+def test_kept_values_only(cache):
+    upstream = Upstream()
+    assert cache.get_or_compute("key", upstream, keep=lambda value: value > 1) == 1
+    assert "key" not in cache._entries
+    assert cache.get_or_compute("key", upstream, keep=lambda value: value > 1) == 2
+    assert cache.get_or_compute("key", upstream, keep=lambda value: value > 1) == 2
+    assert upstream.calls == 2
+
+
+def test_refresh_status_counts_refreshing_and_updated(cache, clock):
+    first, second = Upstream(), Upstream()
+    cache.get_or_compute("first", first)
+    cache.get_or_compute("second", second)
+    clock.now += 61
+
+    def run():
+        served = track_stale()
+        first.release.clear()
+        # 同じキーを何度返しても1件と数える
+        cache.get_or_compute("first", first)
+        cache.get_or_compute("first", first)
+        cache.get_or_compute("second", second)
+        wait_refreshed(cache, "second")
+        assert refresh_status(served) == (1, 1)
+
+        first.release.set()
+        wait_refreshed(cache, "first")
+        assert refresh_status(served) == (0, 2)
+
+    # track_stale の記録は実行ごとなので、他のテストに残らないよう別のコンテキストで確かめる
+    contextvars.copy_context().run(run)
+    assert cache.stats["revalidations"] == 2
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""FetchScheduler のバックオフ・制限中の取得済みデータ・結果の共有（時計と sleep は差し替える）"""
+import random
+import threading
+import time
+
+import pytest
+
+from fake_yfinance import FakeRateLimitError
+from fetch_scheduler import FetchScheduler, RateLimitedError
+
+
+class FakeClock:
+    """sleep した分だけ進む時計"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Upstream:
+    """最初の limited 回は429を返し、その後は呼び出し回数を返すフェイク"""
+
+    def __init__(self, limited=0):
+        self.limited = limited
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.limited:
+            raise FakeRateLimitError("Too Many Requests")
+        return self.calls
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_scheduler(clock, **kwargs):
+    options = dict(rate=1000.0, burst=1000, max_retries=3, base_delay=1.0, max_delay=8.0, cooldown=60.0)
+    options.update(kwargs)
+    return FetchScheduler(clock=clock, sleep=clock.sleep, rng=random.Random(0), **options)
+
+
+def test_retries_with_jittered_exponential_backoff(clock):
+    scheduler = make_scheduler(clock)
+    upstream = Upstream(limited=3)
+
+    assert scheduler.call("key", upstream) == 4
+    assert upstream.calls == 4
+    assert scheduler.stats["rate_limited"] == 3
+    assert scheduler.stats["retries"] == 3
+    # attempt 回目の待ち時間は 0 〜 min(上限, 基準 × 2^attempt)
+    assert len(clock.sleeps) == 3
+    for attempt, wait in enumerate(clock.sleeps):
+        assert 0 <= wait <= min(8.0, 1.0 * 2 ** attempt)
+    # 成功したらクールダウンは解除される
+    assert not scheduler.limited
+
+
+def test_raises_rate_limited_error_without_stale_data(clock):
+    scheduler = make_scheduler(clock, max_retries=2)
+    upstream = Upstream(limited=10)
+
+    with pytest.raises(RateLimitedError):
+        scheduler.call("key", upstream)
+    assert upstream.calls == 3
+    assert scheduler.limited
+
+
+def test_other_errors_are_not_retried(clock):
+    scheduler = make_scheduler(clock)
+
+    def broken():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        scheduler.call("key", broken)
+    assert scheduler.stats["retries"] == 0
+    assert clock.sleeps == []
+
+
+def test_serves_stale_result_while_limited(clock):
+    scheduler = make_scheduler(clock)
+    assert scheduler.call("key", Upstream()) == 1
+
+    # 429 を受けたら取得済みの結果を返し、クールダウン中は問い合わせずに返す
+    upstream = Upstream(limited=10)
+    assert scheduler.call("key", upstream) == 1
+    assert upstream.calls == 1
+    assert scheduler.call("key", upstream) == 1
+    assert upstream.calls == 1
+    assert scheduler.stats["stale_served"] == 2
+
+    # クールダウンが明けたら取り直す
+    clock.now += 61
+    assert scheduler.call("key", Upstream()) == 1
+    assert not scheduler.limited
+
+
+def test_stale_result_expires(clock):
+    scheduler = make_scheduler(clock, max_stale_age=3600.0, max_retries=0)
+    scheduler.call("key", Upstream())
+
+    clock.now += 3601
+    with pytest.raises(RateLimitedError):
+        scheduler.call("key", Upstream(limited=10))
+    assert scheduler.stats["stale_served"] == 0
+
+
+def test_keep_stale_false_does_not_keep_results(clock):
+    scheduler = make_scheduler(clock, max_retries=0)
+    scheduler.call("key", Upstream(), keep_stale=False)
+
+    with pytest.raises(RateLimitedError):
+        scheduler.call("key", Upstream(limited=10))
+
+
+def test_token_bucket_limits_rate(clock):
+    scheduler = make_scheduler(clock, rate=2.0, burst=1)
+    for _ in range(3):
+        scheduler.call("key", Upstream(), keep_stale=False)
+    # 1件目はバーストで即時、残り2件は 0.5 秒ずつ待つ
+    assert clock.sleeps == pytest.approx([0.5, 0.5])
+
+
+def test_coalesces_concurrent_calls_with_same_key(clock):
+    scheduler = make_scheduler(clock)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(scheduler.call("key", slow)))
+    leader.start()
+    assert started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(scheduler.call("key", slow))) for _ in range(3)]
+    for t in followers:
+        t.start()
+    # 後から来た呼び出しが実行中の呼び出しに合流するのを待ってから完了させる
+    time.sleep(0.2)
+    release.set()
+    for t in [leader, *followers]:
+        t.join(5)
+
+    assert results == ["result"] * 4
+    assert len(calls) == 1
+    assert scheduler.stats["requests"] == 1
+
+
+def test_rate_limit_is_shared_by_coalesced_calls(clock):
+    scheduler = make_scheduler(clock, max_retries=0)
+    started = threading.Event()
+    release = threading.Event()
+
+    def limited():
+        started.set()
+        release.wait(5)
+        raise FakeRateLimitError("Too Many Requests")
+
+    errors = []
+
+    def call():
+        try:
+            scheduler.call("key", limited)
+        except RateLimitedError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    time.sleep(0.2)
+    release.set()
+    for t in (leader, follower):
+        t.join(5)
+
+    assert len(errors) == 2
+    assert scheduler.stats["requests"] == 1
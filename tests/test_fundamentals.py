@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""財務データの取得失敗がキャッシュに残らず、次の呼び出しで取り直されるか（Yahooはフェイク）"""
+import multiprocessing
+
+import pandas as pd
+import pytest
+
+import fundamentals
+from fake_yfinance import FakeYahoo
+from fundamentals import INFO_FIELDS, STATEMENT_FIELDS, SnapshotStore, load_fundamentals
+from loaders import load_shareholder_metrics
+
+TICKERS = ("7203.T", "6758.T")
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = SnapshotStore(tmp_path / "fundamentals")
+    monkeypatch.setattr(fundamentals, "snapshot_store", store)
+    load_fundamentals.clear()
+    load_shareholder_metrics.clear()
+    yield store
+    load_fundamentals.clear()
+    load_shareholder_metrics.clear()
+
+
+def test_failed_fetch_is_not_cached(store):
+    fake = FakeYahoo(error_rate=1.0)
+    with fake.installed():
+        table, errors = load_fundamentals(TICKERS)
+    assert table.empty
+    assert len(errors) == len(TICKERS)
+
+    # Yahooが回復したら、次の呼び出しで取り直す
+    fake.error_rate = 0.0
+    requests = fake.stats["requests"]
+    with fake.installed():
+        table, errors = load_fundamentals(TICKERS)
+    assert errors == []
+    assert list(table.index) == list(TICKERS)
+    assert fake.stats["requests"] == requests + len(TICKERS)
+
+    # 全銘柄を取得できた結果はキャッシュする
+    with fake.installed():
+        load_fundamentals(TICKERS)
+    assert fake.stats["requests"] == requests + len(TICKERS)
+
+
+def test_failed_shareholder_metrics_are_not_cached(store):
+    fake = FakeYahoo(error_rate=1.0)
+    with fake.installed():
+        _, errors, _ = load_shareholder_metrics(TICKERS)
+    assert errors
+
+    fake.error_rate = 0.0
+    with fake.installed():
+        df, errors, fetched_at = load_shareholder_metrics(TICKERS)
+    assert errors == []
+    assert len(df) == len(TICKERS)
+    assert fetched_at is not None
+
+
+def test_statements_are_fetched_again_after_failure(store, monkeypatch):
+    fake = FakeYahoo()
+    balance_sheet = fake.balance_sheet
+    failures = {"7203.T": 1}
+
+    def flaky_balance_sheet(ticker):
+        if failures.get(ticker):
+            failures[ticker] -= 1
+            raise RuntimeError("fake upstream error")
+        return balance_sheet(ticker)
+
+    monkeypatch.setattr(fake, "balance_sheet", flaky_balance_sheet)
+    with fake.installed():
+        table, errors = load_fundamentals(TICKERS, with_statements=True)
+    # 財務データは取得でき、決算書だけが未取得として残る
+    assert list(table.index) == list(TICKERS)
+    assert len(errors) == 1 and "7203.T" in errors[0]
+    assert table.loc["7203.T", STATEMENT_FIELDS].isna().all()
+    assert not store.latest().loc["7203.T", "statements"]
+
+    # 2回目は決算書が未取得の銘柄だけを取り直す
+    requests = fake.stats["requests"]
+    with fake.installed():
+        table, errors = load_fundamentals(TICKERS, with_statements=True)
+    assert errors == []
+    assert table.loc["7203.T", STATEMENT_FIELDS].notna().all()
+    assert store.latest().loc["7203.T", "statements"]
+    # info・貸借対照表・損益計算書の3件
+    assert fake.stats["requests"] == requests + 3
+
+
+def _append_rows(root, tickers):
+    store = SnapshotStore(root)
+    for t in tickers:
+        row = pd.DataFrame([{f: 1.0 for f in INFO_FIELDS + STATEMENT_FIELDS}], index=pd.Index([t], name="ticker"))
+        store.append(row.assign(statements=False), pd.Timestamp.now())
+
+
+def test_appends_from_several_processes_keep_every_row(tmp_path):
+    root = tmp_path / "fundamentals"
+    groups = [[f"{i}{j:03d}.T" for j in range(10)] for i in range(1, 5)]
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_append_rows, args=(root, tickers)) for tickers in groups]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    store = SnapshotStore(root)
+    expected = sorted(t for tickers in groups for t in tickers)
+    assert sorted(store.latest().index) == expected
+    day = pd.read_parquet(store._day_path("snapshots", pd.Timestamp.now()))
+    assert sorted(day.index) == expected
+    # 一時ファイルが残っていない
+    assert not list(root.rglob("*.tmp"))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""場中モードの差分更新が、全期間を計算し直した結果と一致するか"""
+import numpy as np
+import pandas as pd
+import pandas.testing as tm
+
+from analytics import peer_averages
+from intraday import IntradayFeed, ReplaySource
+
+TICKERS = ["A.T", "B.T", "C.T", "^N225"]
+NOW = pd.Timestamp("2026-10-16 15:30")
+
+
+def daily_closes():
+    # 当日分の日足（途中値）は IntradayFeed が除く
+    dates = pd.bdate_range(end=NOW.normalize(), periods=20, name="Date")
+    rng = np.random.default_rng(0)
+    values = 100 * np.cumprod(1 + rng.normal(0, 0.01, (len(dates), len(TICKERS))), axis=0)
+    return pd.DataFrame(values, index=dates, columns=TICKERS)
+
+
+def intraday_ticks():
+    times = pd.date_range(NOW.normalize() + pd.Timedelta("09:00:00"), periods=12, freq="5min", name="Date")
+    rng = np.random.default_rng(1)
+    values = 100 * np.cumprod(1 + rng.normal(0, 0.002, (len(times), len(TICKERS))), axis=0)
+    ticks = pd.DataFrame(values, index=times, columns=TICKERS)
+    # 欠けたバーは直前の値で埋める
+    ticks.iloc[3, 1] = np.nan
+    return ticks
+
+
+def full_recompute(closes, ticks):
+    closes = pd.concat([closes[closes.index < NOW.normalize()], ticks]).ffill()
+    returns = (closes / closes.bfill().iloc[0] - 1) * 100
+    return closes, returns, peer_averages(returns[[t for t in TICKERS if t != "^N225"]])
+
+
+def assert_matches_full(feed, closes, ticks):
+    expected_closes, expected_returns, expected_peers = full_recompute(closes, ticks)
+    tm.assert_frame_equal(feed.closes, expected_closes, check_freq=False)
+    tm.assert_frame_equal(feed.returns, expected_returns, check_freq=False)
+    tm.assert_frame_equal(feed.peer_averages, expected_peers, check_freq=False)
+
+
+class RevisingSource:
+    """ReplaySource と同じく step 本ずつ流すが、流し終えるまでは最後のバーを途中値（1%高い値）で返す"""
+
+    def __init__(self, ticks, step):
+        self.ticks = ticks
+        self.replay = ReplaySource(ticks, step)
+
+    def is_open(self):
+        return self.replay.is_open()
+
+    def poll(self, tickers, since):
+        bars = self.replay.poll(tickers, since).copy()
+        if self.replay.is_open() and len(bars):
+            bars.iloc[-1] = bars.iloc[-1] * 1.01
+        return bars
+
+    def released(self):
+        """ここまでに流したバー（最後のバーは途中値）"""
+        bars = self.ticks.iloc[:self.replay.position].copy()
+        if self.replay.is_open() and len(bars):
+            bars.iloc[-1] = bars.iloc[-1] * 1.01
+        return bars
+
+
+def test_replay_matches_full_recompute():
+    closes, ticks = daily_closes(), intraday_ticks()
+    feed = IntradayFeed(closes, ReplaySource(ticks, step=3), benchmark="^N225", now=NOW)
+
+    previous_end = None
+    while feed.source.is_open():
+        delta = feed.poll()
+        released = ticks.iloc[:feed.source.position]
+        # 取り直した最初の行は前回の最後のバー（初回は当日の最初のバー）
+        assert delta.start == (previous_end if previous_end is not None else ticks.index[0])
+        tm.assert_frame_equal(delta.returns, feed.returns.loc[delta.start:], check_freq=False)
+        tm.assert_frame_equal(delta.peer_averages, feed.peer_averages.loc[delta.start:], check_freq=False)
+        assert_matches_full(feed, closes, released)
+        previous_end = released.index[-1]
+
+    assert feed.bars == len(ticks)
+
+
+def test_in_progress_bar_is_replaced():
+    closes, ticks = daily_closes(), intraday_ticks()
+    source = RevisingSource(ticks, step=2)
+    feed = IntradayFeed(closes, source, benchmark="^N225", now=NOW)
+
+    previous_end = None
+    while source.is_open():
+        delta = feed.poll()
+        released = source.released()
+        # 前回の途中値のバーから取り直し、確定値で置き換える
+        assert delta.start == (previous_end if previous_end is not None else ticks.index[0])
+        assert_matches_full(feed, closes, released)
+        previous_end = released.index[-1]
+
+    # 最後は確定値に置き換わり、途中値は残らない
+    assert_matches_full(feed, closes, ticks)
+    assert feed.bars == len(ticks)
+
+
+def test_poll_without_new_bars_is_empty():
+    closes, ticks = daily_closes(), intraday_ticks()
+    feed = IntradayFeed(closes, ReplaySource(ticks.iloc[:0], step=1), benchmark="^N225", now=NOW)
+
+    delta = feed.poll()
+    assert delta.empty
+    assert delta.returns.empty
+    assert_matches_full(feed, closes, ticks.iloc[:0])
+
+
+def test_ticker_listed_partway_is_rebased_on_its_first_close():
+    closes, ticks = daily_closes(), intraday_ticks()
+    # 期間の途中で上場した銘柄は、その銘柄の最初の終値を基準にする
+    closes.iloc[:5, 2] = np.nan
+    feed = IntradayFeed(closes, ReplaySource(ticks, step=len(ticks)), benchmark="^N225", now=NOW)
+    feed.poll()
+
+    assert feed.returns["C.T"].iloc[5] == 0
+    assert feed.returns["C.T"].iloc[:5].isna().all()
+    assert_matches_full(feed, closes, ticks)
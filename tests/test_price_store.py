@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""共有株価行列から読んだ終値が、ストアから直接読んだ結果と一致するか"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import pandas.testing as tm
+import pytest
+
+from market_data import PriceStore
+
+DATES = pd.bdate_range("2026-10-01", "2026-10-16", name="Date")
+CHECKED = pd.Timestamp("2026-10-16 18:00")
+
+
+def closes():
+    rng = np.random.default_rng(0)
+    values = 100 * np.cumprod(1 + rng.normal(0, 0.01, (len(DATES), 4)), axis=0)
+    data = pd.DataFrame(values, index=DATES, columns=["A.T", "B.T", "C.T", "^N225"])
+    # B は途中で上場廃止、C は途中で上場し、A は途中のバーが欠けている
+    data.loc["2026-10-14":, "B.T"] = np.nan
+    data.loc[:"2026-10-06", "C.T"] = np.nan
+    data.loc["2026-10-08", "A.T"] = np.nan
+    return data
+
+
+def make_store(root, mode, data):
+    store = PriceStore(root, matrix_mode=mode)
+    store.write(data, CHECKED)
+    return store
+
+
+@pytest.mark.parametrize("mode", ["mmap", "memory"])
+@pytest.mark.parametrize("tickers", [["A.T", "B.T", "C.T", "^N225"], ["B.T"], ["C.T", "A.T"], ["B.T", "^N225"]])
+@pytest.mark.parametrize("start", [None, pd.Timestamp("2026-10-08")])
+def test_matrix_matches_store(tmp_path, mode, tickers, start):
+    data = closes()
+    store = make_store(tmp_path, mode, data)
+    expected = PriceStore(tmp_path, matrix_mode="off").read(tickers, start)
+    result = store.read(tickers, start)
+    tm.assert_frame_equal(result, expected, check_dtype=False, check_freq=False, rtol=1e-6)
+    store.matrix.flush()
+
+
+def test_bars_after_last_close_are_not_filled(tmp_path):
+    store = make_store(tmp_path, "mmap", closes())
+    only_b = store.read(["B.T"])
+    assert len(only_b) == 9
+    assert only_b.index[-1] == pd.Timestamp("2026-10-13")
+
+    both = store.read(["A.T", "B.T"])
+    assert both.loc["2026-10-14":, "B.T"].isna().all()
+    # 途中の欠けたバーは前の値で埋める
+    assert both.loc["2026-10-08", "A.T"] == both.loc["2026-10-07", "A.T"]
+    store.matrix.flush()
+
+
+def test_only_changed_tickers_are_read_again(tmp_path, monkeypatch):
+    data = closes()
+    store = make_store(tmp_path, "memory", data)
+    store.read(["A.T"])
+    store.matrix.flush()
+
+    read = []
+    read_all = store.read_all
+    monkeypatch.setattr(store, "read_all", lambda tickers: read.extend(tickers) or read_all(tickers))
+    extra = pd.DataFrame({"C.T": [130.0]}, index=pd.DatetimeIndex(["2026-10-19"], name="Date"))
+    store.write(extra, CHECKED + pd.Timedelta(days=3))
+    result = store.read(["A.T", "B.T", "C.T", "^N225"])
+
+    assert read == ["C.T"]
+    assert result.index[-1] == pd.Timestamp("2026-10-19")
+    assert result.loc["2026-10-19", "C.T"] == 130.0
+    # 10/19 のバーがない銘柄は埋めない
+    assert result.loc["2026-10-19", ["A.T", "B.T", "^N225"]].isna().all()
+    store.matrix.flush()
+    expected = PriceStore(tmp_path, matrix_mode="off").read(["A.T", "B.T", "C.T", "^N225"])
+    tm.assert_frame_equal(PriceStore(tmp_path).read(["A.T", "B.T", "C.T", "^N225"]), expected,
+                          check_dtype=False, check_freq=False, rtol=1e-6)
+
+
+def _write_versions(root, rounds):
+    store = PriceStore(root, matrix_mode="mmap")
+    for i in range(rounds):
+        # 全銘柄を同じ値にそろえて書くので、読み手はどの版を読んでも日付ごとに同じ値を見る
+        day = DATES[-1] + pd.offsets.BDay(i + 1)
+        store.write(pd.DataFrame({t: [float(i)] for t in ["A.T", "B.T"]}, index=pd.DatetimeIndex([day], name="Date")),
+                    CHECKED + pd.Timedelta(days=i + 1))
+        store.read(["A.T", "B.T"])
+    store.matrix.flush()
+
+
+def _read_versions(root, rounds, queue):
+    store = PriceStore(root, matrix_mode="mmap")
+    try:
+        for _ in range(rounds):
+            data = store.read(["A.T", "B.T"])
+            new = data[data.index > DATES[-1]]
+            assert (new["A.T"] == new["B.T"]).all()
+            assert len(data) >= len(DATES)
+        queue.put(None)
+    except Exception as e:  # noqa: BLE001 - 子プロセスの例外を親に渡す
+        queue.put(repr(e))
+
+
+def test_readers_during_version_swaps(tmp_path):
+    data = closes()[["^N225"]].rename(columns={"^N225": "A.T"})
+    data["B.T"] = data["A.T"]
+    store = make_store(tmp_path, "mmap", data)
+    store.read(["A.T", "B.T"])
+    store.matrix.flush()
+
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    writer = context.Process(target=_write_versions, args=(tmp_path, 30))
+    readers = [context.Process(target=_read_versions, args=(tmp_path, 200, queue)) for _ in range(3)]
+    for process in [writer, *readers]:
+        process.start()
+    for process in [writer, *readers]:
+        process.join(120)
+        assert process.exitcode == 0
+    assert [queue.get(timeout=5) for _ in readers] == [None] * len(readers)
+
+    # 最後の版だけが残り、一時ファイルも残っていない
+    assert len(list(tmp_path.glob("matrix-*.npy"))) == 1
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""銘柄ユニバース（CSV / JSON）の読み込み
+
+列は ticker / code / name / sector_code / sector（market は任意）。
+JPXの上場銘柄一覧の列名（コード・銘柄名・33業種コード・33業種区分・市場・商品区分）もそのまま読める。
+"""
+import functools
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+# ユニバースファイル（環境変数 STOCK_UNIVERSE で変更可能）
+UNIVERSE_PATH = Path(os.environ.get("STOCK_UNIVERSE", Path(__file__).resolve().parent / "universe.csv"))
+
+_COLUMN_ALIASES = {
+    "コード": "code",
+    "銘柄名": "name",
+    "33業種コード": "sector_code",
+    "33業種区分": "sector",
+    "市場・商品区分": "market",
+}
+
+
+@functools.lru_cache(maxsize=4)
+def load_universe(path=UNIVERSE_PATH, market=None):
+    """ユニバースを読み込み、ファイル内の順序のまま返す（market を指定すると部分一致で絞り込む）"""
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path, encoding="utf-8") as f:
+            universe = pd.DataFrame(json.load(f))
+    else:
+        universe = pd.read_csv(path, dtype=str)
+    universe = universe.rename(columns=_COLUMN_ALIASES).astype(str)
+
+    if "ticker" not in universe:
+        universe["ticker"] = universe["code"].str.strip() + ".T"
+    if "code" not in universe:
+        universe["code"] = universe["ticker"].str.split(".").str[0]
+    if "sector_code" not in universe:
+        universe["sector_code"] = ""
+    if market is not None and "market" in universe:
+        universe = universe[universe["market"].str.contains(market, regex=False)]
+
+    columns = ["ticker", "code", "name", "sector_code", "sector"]
+    return universe[columns].drop_duplicates("ticker").reset_index(drop=True)
+
+
+def sectors_from_universe(universe):
+    """{セクター: {ティッカー: "コード 銘柄名"}} 形式（app.py の SECTORS）に変換"""
+    return {
+        sector: dict(zip(group["ticker"], group["code"] + " " + group["name"]))
+        for sector, group in universe.groupby("sector", sort=False)
+    }